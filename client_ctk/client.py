@@ -1,4 +1,3 @@
-import base64
 from io import BytesIO
 import io
 import os
@@ -11,9 +10,31 @@ import ws
 import time
 import requests
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 URL = "https://chat.solithv7247.duckdns.org/"
 # URL = "http://127.0.0.1:5000"
+# 表示に使う縮小画像の最小サイズ(メッセージ欄の画像の幅)
+THUMBNAIL_MIN_SIZE = 300
+# 表示用の画像のダウンロードを待つ秒数
+IMAGE_TIMEOUT = 10
+
+
+def fetchImage(link):
+    """画像をダウンロード(失敗したら None)"""
+    try:
+        response = requests.get(link, timeout=IMAGE_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+    except requests.RequestException as e:
+        print(f"image download failed: {e!r}")
+        return None
+
+
+def isImageReady(message):
+    """表示用の画像のダウンロードが終わったか(画像以外は常に True)"""
+    future = message.get("image_future")
+    return future is None or future.done()
 
 """基底クラス"""
 
@@ -28,6 +49,9 @@ class App(customtkinter.CTk):
 
     isConnected = False
 
+    """接続を続けたまま表示する通知"""
+    notice = None
+
     """初期化"""
 
     def __init__(self):
@@ -113,6 +137,11 @@ class App(customtkinter.CTk):
         self.FirstContact(master=self)
 
     def onError(self, message):
+        """送信の上限超過などは通知のみ(表示は部屋の画面の更新時に行う)"""
+        if not ws.isFatalError(message):
+            self.notice = message
+            return
+
         self.wsManager.offDisconnect()
 
         for widget in self.activeWidgets:
@@ -353,13 +382,30 @@ class App(customtkinter.CTk):
 
         addedMessages = []
 
+        """表示用の画像を受信処理と別のスレッドでダウンロードする"""
+        imageDownloader = ThreadPoolExecutor(4)
+
+        """過去ログ読み込みの状態"""
+        oldestId = None
+        hasMoreHistory = True
+        isLoadingHistory = False
+
+        """検索の状態"""
+        searchQuery = None
+        searchOffset = 0
+        searchPage = None
+        searchWindow = None
+
         """初期化"""
 
         def __init__(self, master, **kwargs):
             super().__init__(master, corner_radius=0, fg_color="transparent", **kwargs)
 
+            self.olderMessages = []
+
             """メッセージのイベントハンドラ登録"""
             master.wsManager.onMessage(self.onMessage)
+            master.wsManager.onHistory(self.onJoinHistory)
 
             """ウィジェット配置"""
             self.grid_rowconfigure(1, weight=1)
@@ -388,14 +434,15 @@ class App(customtkinter.CTk):
             )
             label.grid(row=0, column=1, padx=5, pady=5, columnspan=2)
 
-            space = customtkinter.CTkFrame(
+            searchButton = customtkinter.CTkButton(
                 master=navContainer,
-                corner_radius=0,
-                fg_color="transparent",
+                text="検索",
                 width=50,
                 height=50,
+                command=self.onClickSearch,
+                font=master.font,
             )
-            space.grid(row=0, column=2, padx=5, pady=5, sticky="nsew")
+            searchButton.grid(row=0, column=2, padx=5, pady=5, sticky="nsew")
 
             self.messageContainer = customtkinter.CTkScrollableFrame(
                 master=self, corner_radius=0, fg_color="transparent"
@@ -443,461 +490,649 @@ class App(customtkinter.CTk):
             self.master.activeWidgets.append(self)
 
         def onMessage(self, message):
+            self.downloadImage(message)
             self.addedMessages.append(message)
 
+        def onJoinHistory(self, page):
+            """参加時の過去ログ(新しい順)を受け取ったら、古い順にまとめて追加"""
+            self.hasMoreHistory = page["has_more"]
+            for message in page["messages"]:
+                self.downloadImage(message)
+            self.addedMessages.extend(page["messages"][::-1])
+
+        def downloadImage(self, message):
+            """画像のメッセージなら表示用の画像(縮小画像があればそちら)のダウンロードを始める
+
+            受信処理を止めないよう別スレッドで取得し、メッセージは取得が終わってから表示する。
+            """
+            if message.get("image_url"):
+                imageUrl = message["image_url"]
+                for thumbnail in message.get("thumbnails") or []:
+                    if thumbnail["size"] >= THUMBNAIL_MIN_SIZE:
+                        imageUrl = thumbnail["url"]
+                        break
+                link = re.sub("^[/\\\\]", "", imageUrl)
+                link = os.path.join(URL, link)
+                message["image_future"] = self.imageDownloader.submit(fetchImage, link)
+
+        def openImage(self, message):
+            """表示用の画像(ダウンロードできなかったら代わりの灰色の画像)"""
+            try:
+                return Image.open(BytesIO(message["image_future"].result()))
+            except OSError:
+                return Image.new("RGB", (300, 200), "gray")
+
         def updateMessages(self):
             """画面が変わったら"""
             if self.isDestroyed:
                 return
 
-            for message in self.addedMessages:
+            """過去ログを受け取っていたら先頭に追加(画像のダウンロードを待つ)"""
+            if self.olderMessages and all(map(isImageReady, self.olderMessages)):
+                self.prependMessages()
+
+            """検索結果を受け取っていたら表示"""
+            if self.searchPage is not None:
+                self.showSearchResults()
+
+            """通知を受け取っていたら表示"""
+            if self.master.notice is not None:
+                self.showNotice()
 
-                isMineMessage = message["user"] == self.master.username
+            """届いた順に表示(画像のダウンロード中のメッセージからは次の更新で)"""
+            while self.addedMessages and isImageReady(self.addedMessages[0]):
+                message = self.addedMessages.pop(0)
+                self.updateOldestId(message)
                 messageIndex = len(self.messages)
                 self.messages.append(message)
+                self.addMessageWidget(message, messageIndex)
 
-                if message.get("message"):
+            """先頭までスクロールしたら過去ログを要求"""
+            if self.messageContainer._parent_canvas.yview()[0] <= 0:
+                self.loadOlderMessages()
 
-                    if isMineMessage:
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=50,
-                        )
-                        space.grid(
-                            row=messageIndex * 2,
-                            column=0,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+            """100ms後に同じことをする"""
+            self.master.after(100, self.updateMessages)
 
-                        nameWidget = customtkinter.CTkLabel(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=f"{message["user"]} : {message["timestamp"]}",
-                            fg_color="light green",
-                            text_color="black",
-                            font=self.master.font,
-                        )
-                        nameWidget.grid(
-                            row=messageIndex * 2,
-                            column=1,
-                            padx=5,
-                            pady=(5, 1.25),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+        def addMessageWidget(self, message, messageIndex):
+            """メッセージのウィジェットを messageIndex 番目の位置に配置"""
+            isMineMessage = message["user"] == self.master.username
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=100,
-                        )
-                        space.grid(
-                            row=messageIndex * 2 + 1,
-                            column=0,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+            if message.get("message"):
 
-                        messageWidget = customtkinter.CTkButton(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=message["message"],
-                            fg_color="light green",
-                            hover_color="green",
-                            text_color="black",
-                            font=self.master.font,
-                            command=(
-                                lambda messageIndex: lambda: self.onClickMessage(
-                                    messageIndex
-                                )
-                            )(messageIndex),
-                        )
-                        messageWidget.grid(
-                            row=messageIndex * 2 + 1,
-                            column=1,
-                            padx=5,
-                            pady=(1.25, 5),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                if isMineMessage:
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=50,
+                    )
+                    space.grid(
+                        row=messageIndex * 2,
+                        column=0,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                    else:
-                        nameWidget = customtkinter.CTkLabel(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=f"{message["user"]} : {message["timestamp"]}",
-                            fg_color="white",
-                            text_color="black",
-                            font=self.master.font,
-                        )
-                        nameWidget.grid(
-                            row=messageIndex * 2,
-                            column=0,
-                            padx=5,
-                            pady=(5, 1.25),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                    nameWidget = customtkinter.CTkLabel(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=f"{message["user"]} : {message["timestamp"]}",
+                        fg_color="light green",
+                        text_color="black",
+                        font=self.master.font,
+                    )
+                    nameWidget.grid(
+                        row=messageIndex * 2,
+                        column=1,
+                        padx=5,
+                        pady=(5, 1.25),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=50,
-                        )
-                        space.grid(
-                            row=messageIndex * 2,
-                            column=2,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=100,
+                    )
+                    space.grid(
+                        row=messageIndex * 2 + 1,
+                        column=0,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                        messageWidget = customtkinter.CTkButton(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=message["message"],
-                            fg_color="white",
-                            hover_color="gray",
-                            text_color="black",
-                            font=self.master.font,
-                            command=(
-                                lambda messageIndex: lambda: self.onClickMessage(
-                                    messageIndex
-                                )
-                            )(messageIndex),
-                        )
-                        messageWidget.grid(
-                            row=messageIndex * 2 + 1,
-                            column=0,
-                            padx=5,
-                            pady=(1.25, 5),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                    messageWidget = customtkinter.CTkButton(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=message["message"],
+                        fg_color="light green",
+                        hover_color="green",
+                        text_color="black",
+                        font=self.master.font,
+                        command=(
+                            lambda messageIndex: lambda: self.onClickMessage(
+                                messageIndex
+                            )
+                        )(messageIndex),
+                    )
+                    messageWidget.grid(
+                        row=messageIndex * 2 + 1,
+                        column=1,
+                        padx=5,
+                        pady=(1.25, 5),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=100,
-                        )
-                        space.grid(
-                            row=messageIndex * 2 + 1,
-                            column=2,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                else:
+                    nameWidget = customtkinter.CTkLabel(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=f"{message["user"]} : {message["timestamp"]}",
+                        fg_color="white",
+                        text_color="black",
+                        font=self.master.font,
+                    )
+                    nameWidget.grid(
+                        row=messageIndex * 2,
+                        column=0,
+                        padx=5,
+                        pady=(5, 1.25),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                elif message.get("image"):
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=50,
+                    )
+                    space.grid(
+                        row=messageIndex * 2,
+                        column=2,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                    image = Image.open(BytesIO(base64.b64decode(message["image"])))
-                    self.images.append(image)
-                    ctkImage = customtkinter.CTkImage(
-                        Image.open(BytesIO(base64.b64decode(message["image"]))),
-                        size=(300, 300 * image.height / image.width),
+                    messageWidget = customtkinter.CTkButton(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=message["message"],
+                        fg_color="white",
+                        hover_color="gray",
+                        text_color="black",
+                        font=self.master.font,
+                        command=(
+                            lambda messageIndex: lambda: self.onClickMessage(
+                                messageIndex
+                            )
+                        )(messageIndex),
+                    )
+                    messageWidget.grid(
+                        row=messageIndex * 2 + 1,
+                        column=0,
+                        padx=5,
+                        pady=(1.25, 5),
+                        columnspan=2,
+                        sticky="nsew",
                     )
 
-                    if isMineMessage:
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=50,
-                        )
-                        space.grid(
-                            row=messageIndex * 2,
-                            column=0,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=100,
+                    )
+                    space.grid(
+                        row=messageIndex * 2 + 1,
+                        column=2,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                        nameWidget = customtkinter.CTkLabel(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=f"{message["user"]} : {message["timestamp"]}",
-                            fg_color="light green",
-                            text_color="black",
-                            font=self.master.font,
-                        )
-                        nameWidget.grid(
-                            row=messageIndex * 2,
-                            column=1,
-                            padx=5,
-                            pady=(5, 1.25),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+            elif message.get("image_url"):
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=200,
-                        )
-                        space.grid(
-                            row=messageIndex * 2 + 1,
-                            column=0,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                image = self.openImage(message)
+                self.images.append(image)
+                ctkImage = customtkinter.CTkImage(
+                    self.openImage(message),
+                    size=(300, 300 * image.height / image.width),
+                )
 
-                        messageWidget = customtkinter.CTkButton(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text="",
-                            image=ctkImage,
-                            fg_color="transparent",
-                            hover_color="green",
-                            text_color="black",
-                            font=self.master.font,
-                            command=(
-                                lambda messageIndex: lambda: self.onClickMessage(
-                                    messageIndex
-                                )
-                            )(messageIndex),
-                        )
-                        messageWidget.grid(
-                            row=messageIndex * 2 + 1,
-                            column=1,
-                            padx=5,
-                            pady=(1.25, 5),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                if isMineMessage:
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=50,
+                    )
+                    space.grid(
+                        row=messageIndex * 2,
+                        column=0,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                    else:
-                        nameWidget = customtkinter.CTkLabel(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=f"{message["user"]} : {message["timestamp"]}",
-                            fg_color="white",
-                            text_color="black",
-                            font=self.master.font,
-                        )
-                        nameWidget.grid(
-                            row=messageIndex * 2,
-                            column=0,
-                            padx=5,
-                            pady=(5, 1.25),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                    nameWidget = customtkinter.CTkLabel(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=f"{message["user"]} : {message["timestamp"]}",
+                        fg_color="light green",
+                        text_color="black",
+                        font=self.master.font,
+                    )
+                    nameWidget.grid(
+                        row=messageIndex * 2,
+                        column=1,
+                        padx=5,
+                        pady=(5, 1.25),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=50,
-                        )
-                        space.grid(
-                            row=messageIndex * 2,
-                            column=2,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=200,
+                    )
+                    space.grid(
+                        row=messageIndex * 2 + 1,
+                        column=0,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                        messageWidget = customtkinter.CTkButton(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text="",
-                            image=ctkImage,
-                            fg_color="transparent",
-                            hover_color="gray",
-                            text_color="black",
-                            font=self.master.font,
-                            command=(
-                                lambda messageIndex: lambda: self.onClickMessage(
-                                    messageIndex
-                                )
-                            )(messageIndex),
-                        )
-                        messageWidget.grid(
-                            row=messageIndex * 2 + 1,
-                            column=0,
-                            padx=5,
-                            pady=(1.25, 5),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                    messageWidget = customtkinter.CTkButton(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text="",
+                        image=ctkImage,
+                        fg_color="transparent",
+                        hover_color="green",
+                        text_color="black",
+                        font=self.master.font,
+                        command=(
+                            lambda messageIndex: lambda: self.onClickMessage(
+                                messageIndex
+                            )
+                        )(messageIndex),
+                    )
+                    messageWidget.grid(
+                        row=messageIndex * 2 + 1,
+                        column=1,
+                        padx=5,
+                        pady=(1.25, 5),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=200,
-                        )
-                        space.grid(
-                            row=messageIndex * 2 + 1,
-                            column=2,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                else:
+                    nameWidget = customtkinter.CTkLabel(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=f"{message["user"]} : {message["timestamp"]}",
+                        fg_color="white",
+                        text_color="black",
+                        font=self.master.font,
+                    )
+                    nameWidget.grid(
+                        row=messageIndex * 2,
+                        column=0,
+                        padx=5,
+                        pady=(5, 1.25),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                elif message.get("filename") and message.get("link"):
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=50,
+                    )
+                    space.grid(
+                        row=messageIndex * 2,
+                        column=2,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                    if isMineMessage:
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=50,
-                        )
-                        space.grid(
-                            row=messageIndex * 2,
-                            column=0,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                    messageWidget = customtkinter.CTkButton(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text="",
+                        image=ctkImage,
+                        fg_color="transparent",
+                        hover_color="gray",
+                        text_color="black",
+                        font=self.master.font,
+                        command=(
+                            lambda messageIndex: lambda: self.onClickMessage(
+                                messageIndex
+                            )
+                        )(messageIndex),
+                    )
+                    messageWidget.grid(
+                        row=messageIndex * 2 + 1,
+                        column=0,
+                        padx=5,
+                        pady=(1.25, 5),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                        nameWidget = customtkinter.CTkLabel(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=f"{message["user"]} : {message["timestamp"]}",
-                            fg_color="light green",
-                            text_color="black",
-                            font=self.master.font,
-                        )
-                        nameWidget.grid(
-                            row=messageIndex * 2,
-                            column=1,
-                            padx=5,
-                            pady=(5, 1.25),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=200,
+                    )
+                    space.grid(
+                        row=messageIndex * 2 + 1,
+                        column=2,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=100,
-                        )
-                        space.grid(
-                            row=messageIndex * 2 + 1,
-                            column=0,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+            elif message.get("filename") and message.get("link"):
 
-                        messageWidget = customtkinter.CTkButton(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=message["filename"],
-                            image=self.master.attachFileImage,
-                            compound="top",
-                            fg_color="light green",
-                            hover_color="green",
-                            text_color="black",
-                            font=self.master.font,
-                            command=(
-                                lambda messageIndex: lambda: self.onClickMessage(
-                                    messageIndex
-                                )
-                            )(messageIndex),
-                        )
-                        messageWidget.grid(
-                            row=messageIndex * 2 + 1,
-                            column=1,
-                            padx=5,
-                            pady=(1.25, 5),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                if isMineMessage:
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=50,
+                    )
+                    space.grid(
+                        row=messageIndex * 2,
+                        column=0,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                    else:
-                        nameWidget = customtkinter.CTkLabel(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=f"{message["user"]} : {message["timestamp"]}",
-                            fg_color="white",
-                            text_color="black",
-                            font=self.master.font,
-                        )
-                        nameWidget.grid(
-                            row=messageIndex * 2,
-                            column=0,
-                            padx=5,
-                            pady=(5, 1.25),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                    nameWidget = customtkinter.CTkLabel(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=f"{message["user"]} : {message["timestamp"]}",
+                        fg_color="light green",
+                        text_color="black",
+                        font=self.master.font,
+                    )
+                    nameWidget.grid(
+                        row=messageIndex * 2,
+                        column=1,
+                        padx=5,
+                        pady=(5, 1.25),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=50,
-                        )
-                        space.grid(
-                            row=messageIndex * 2,
-                            column=2,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=100,
+                    )
+                    space.grid(
+                        row=messageIndex * 2 + 1,
+                        column=0,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-                        messageWidget = customtkinter.CTkButton(
-                            master=self.messageContainer,
-                            corner_radius=10,
-                            text=message["filename"],
-                            image=self.master.attachFileImage,
-                            compound="top",
-                            fg_color="white",
-                            hover_color="gray",
-                            text_color="black",
-                            font=self.master.font,
-                            command=(
-                                lambda messageIndex: lambda: self.onClickMessage(
-                                    messageIndex
-                                )
-                            )(messageIndex),
-                        )
-                        messageWidget.grid(
-                            row=messageIndex * 2 + 1,
-                            column=0,
-                            padx=5,
-                            pady=(1.25, 5),
-                            columnspan=2,
-                            sticky="nsew",
-                        )
+                    messageWidget = customtkinter.CTkButton(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=message["filename"],
+                        image=self.master.attachFileImage,
+                        compound="top",
+                        fg_color="light green",
+                        hover_color="green",
+                        text_color="black",
+                        font=self.master.font,
+                        command=(
+                            lambda messageIndex: lambda: self.onClickMessage(
+                                messageIndex
+                            )
+                        )(messageIndex),
+                    )
+                    messageWidget.grid(
+                        row=messageIndex * 2 + 1,
+                        column=1,
+                        padx=5,
+                        pady=(1.25, 5),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-                        space = customtkinter.CTkFrame(
-                            master=self.messageContainer,
-                            corner_radius=0,
-                            fg_color="transparent",
-                            height=100,
-                        )
-                        space.grid(
-                            row=messageIndex * 2 + 1,
-                            column=2,
-                            padx=0,
-                            pady=0,
-                            sticky="nsew",
-                        )
+                else:
+                    nameWidget = customtkinter.CTkLabel(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=f"{message["user"]} : {message["timestamp"]}",
+                        fg_color="white",
+                        text_color="black",
+                        font=self.master.font,
+                    )
+                    nameWidget.grid(
+                        row=messageIndex * 2,
+                        column=0,
+                        padx=5,
+                        pady=(5, 1.25),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
+
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=50,
+                    )
+                    space.grid(
+                        row=messageIndex * 2,
+                        column=2,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
 
-            self.addedMessages.clear()
+                    messageWidget = customtkinter.CTkButton(
+                        master=self.messageContainer,
+                        corner_radius=10,
+                        text=message["filename"],
+                        image=self.master.attachFileImage,
+                        compound="top",
+                        fg_color="white",
+                        hover_color="gray",
+                        text_color="black",
+                        font=self.master.font,
+                        command=(
+                            lambda messageIndex: lambda: self.onClickMessage(
+                                messageIndex
+                            )
+                        )(messageIndex),
+                    )
+                    messageWidget.grid(
+                        row=messageIndex * 2 + 1,
+                        column=0,
+                        padx=5,
+                        pady=(1.25, 5),
+                        columnspan=2,
+                        sticky="nsew",
+                    )
 
-            """100ms後に同じことをする"""
-            self.master.after(100, self.updateMessages)
+                    space = customtkinter.CTkFrame(
+                        master=self.messageContainer,
+                        corner_radius=0,
+                        fg_color="transparent",
+                        height=100,
+                    )
+                    space.grid(
+                        row=messageIndex * 2 + 1,
+                        column=2,
+                        padx=0,
+                        pady=0,
+                        sticky="nsew",
+                    )
+
+        def updateOldestId(self, message):
+            """表示中で最も古いメッセージのIDを更新"""
+            if message.get("id") is not None and (
+                self.oldestId is None or message["id"] < self.oldestId
+            ):
+                self.oldestId = message["id"]
+
+        def loadOlderMessages(self):
+            """表示中より古い過去ログを要求"""
+            if self.oldestId is None or not self.hasMoreHistory:
+                return
+            if self.isLoadingHistory:
+                return
+
+            self.isLoadingHistory = True
+            self.master.wsManager.loadHistory(self.oldestId, self.onHistory)
+
+        def onHistory(self, page):
+            """過去ログを受け取ったとき"""
+            self.hasMoreHistory = page["has_more"]
+            for message in page["messages"]:
+                self.downloadImage(message)
+            if page["messages"]:
+                self.olderMessages = page["messages"][::-1]
+            else:
+                self.isLoadingHistory = False
+
+        def prependMessages(self):
+            """過去ログを先頭に追加して描画し直す"""
+            olderMessages = self.olderMessages
+            self.olderMessages = []
+            for message in olderMessages:
+                self.updateOldestId(message)
+            self.messages = olderMessages + self.messages
+
+            for widget in self.messageContainer.winfo_children():
+                widget.destroy()
+            for messageIndex, message in enumerate(self.messages):
+                self.addMessageWidget(message, messageIndex)
+
+            """読み込み前に先頭だったメッセージの位置までスクロール"""
+            self.messageContainer.update_idletasks()
+            self.messageContainer._parent_canvas.yview_moveto(
+                len(olderMessages) / len(self.messages)
+            )
+            self.isLoadingHistory = False
+
+        def onClickSearch(self):
+            dialog = customtkinter.CTkInputDialog(
+                text="検索語", title="search", font=self.master.font
+            )
+            query = (dialog.get_input() or "").strip()
+
+            """キャンセル・空白のみ"""
+            if not query:
+                return
+
+            self.searchQuery = query
+            self.searchOffset = 0
+            self.master.wsManager.search(query, 0, self.onSearch)
+
+        def onSearchMore(self):
+            self.master.wsManager.search(
+                self.searchQuery, self.searchOffset, self.onSearch
+            )
+
+        def onSearch(self, page):
+            """検索結果を受け取ったとき(表示は updateMessages で行う)"""
+            self.searchPage = page
+
+        def showSearchResults(self):
+            """検索結果を別ウィンドウに表示(続きは末尾に追加)"""
+            page = self.searchPage
+            self.searchPage = None
+            self.openSearchWindow()
+
+            """検索語のエラーなどは検索結果の欄に表示(接続は続ける)"""
+            if "error" in page:
+                self.searchText.configure(state="normal")
+                self.searchText.delete("1.0", "end")
+                self.searchText.insert(
+                    "end", f"検索できませんでした\n{page['error']['message']}\n"
+                )
+                self.searchText.configure(state="disabled")
+                self.searchMore.configure(state="disabled")
+                self.searchWindow.lift()
+                return
+
+            self.searchText.configure(state="normal")
+            if self.searchOffset == 0:
+                self.searchText.delete("1.0", "end")
+                if not page["messages"]:
+                    self.searchText.insert("end", "見つかりませんでした\n")
+            for message in page["messages"]:
+                self.searchText.insert(
+                    "end",
+                    f"[{message['timestamp']}] {message['user']}: {message['message']}\n",
+                )
+            self.searchText.configure(state="disabled")
+            self.searchOffset += len(page["messages"])
+            self.searchMore.configure(state="normal" if page["has_more"] else "disabled")
+            self.searchWindow.lift()
+
+        def openSearchWindow(self):
+            """検索結果のウィンドウ(閉じられていたら作り直す)"""
+            if self.searchWindow is None or not self.searchWindow.winfo_exists():
+                self.searchWindow = customtkinter.CTkToplevel(self)
+                self.searchWindow.title("search")
+                self.searchWindow.geometry("500x400")
+                self.searchWindow.grid_rowconfigure(0, weight=1)
+                self.searchWindow.grid_columnconfigure(0, weight=1)
+                self.searchText = customtkinter.CTkTextbox(
+                    master=self.searchWindow, font=self.master.font
+                )
+                self.searchText.grid(row=0, column=0, padx=5, pady=5, sticky="nsew")
+                self.searchMore = customtkinter.CTkButton(
+                    master=self.searchWindow,
+                    text="さらに表示",
+                    command=self.onSearchMore,
+                    font=self.master.font,
+                )
+                self.searchMore.grid(row=1, column=0, padx=5, pady=5, sticky="ew")
+
+        def showNotice(self):
+            """接続を続けたまま通知を表示(閉じるのを待たない)"""
+            notice = self.master.notice
+            self.master.notice = None
+            text = notice["message"]
+            if notice.get("code") == "RATE_LIMITED":
+                text = f"送信が多すぎます\n{notice['retry_after']}秒後に送信してください"
+            elif notice.get("code") == "UPLOAD_FAILED":
+                text = f"ファイルを送信できませんでした\n{notice['message']}"
+            Alert(text=text, title="Notice", font=self.master.font)
 
         def onQuit(self):
 
+            if self.searchWindow is not None and self.searchWindow.winfo_exists():
+                self.searchWindow.destroy()
             self.master.wsManager.leave()
             self.master.wsManager.offMessage()
+            self.master.wsManager.offHistory()
+            self.master.wsManager.onRooms(self.master.onRooms)
 
             self.destroy()
             self.master.activeWidgets.remove(self)
@@ -917,7 +1152,7 @@ class App(customtkinter.CTk):
             if message.get("message"):
                 pass
 
-            elif message.get("image"):
+            elif message.get("image_url"):
 
                 file = filedialog.asksaveasfile(
                     mode="wb",
@@ -928,7 +1163,10 @@ class App(customtkinter.CTk):
                 if not file:
                     return
                 
-                fileByteData = base64.b64decode(message["image"])
+                """保存は元画像をダウンロードする"""
+                link = re.sub("^[/\\\\]", "", message["image_url"])
+                link = os.path.join(URL, link)
+                fileByteData = requests.get(link).content
                 image = Image.open(io.BytesIO(fileByteData))
                 image.save(file, format="PNG")
                 file.close()
@@ -1016,9 +1254,8 @@ class App(customtkinter.CTk):
                 return
 
             for file in files:
-                fileByteData = base64.b64encode(file.read())
+                fileData = file.read()
                 file.close()
-                fileData = fileByteData.decode("utf-8")
                 self.master.wsManager.sendImage(fileData)
 
         def onAttachFile(self):
@@ -1034,11 +1271,8 @@ class App(customtkinter.CTk):
                 return
 
             for file in files:
-                fileByteData = base64.b64encode(file.read())
-                filename = file.name
                 file.close()
-                fileData = fileByteData.decode("utf-8")
-                self.master.wsManager.sendFile(fileData, os.path.basename(filename))
+                self.master.wsManager.sendFile(file.name)
 
 
 if __name__ == "__main__":
@@ -1,24 +1,77 @@
-import base64
+import threading
+import uuid
 from pathlib import Path
 
+import requests
 import socketio
 import socketio.exceptions
 
 IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
+# これより大きいファイルはHTTPで送信
+HTTP_UPLOAD_THRESHOLD = 1024**2 * 8
+# 通知のみで接続を続けるエラー(送信の上限超過・ファイルの保存失敗)
+NOTICE_CODES = {"RATE_LIMITED", "UPLOAD_FAILED"}
 
 def dummyFunc(*args, **kwargs):
     pass
 
+def isFatalError(error: dict):
+    """接続を続けられないエラーか"""
+    return error.get("code") not in NOTICE_CODES
+
+class MultipartFile:
+    """ファイルを少しずつ読みながら送る multipart/form-data の本文"""
+
+    def __init__(self, file: Path, field: str = "file", chunkSize: int = 1024 * 64):
+        boundary = uuid.uuid4().hex
+        self.file = file
+        self.chunkSize = chunkSize
+        self.contentType = f"multipart/form-data; boundary={boundary}"
+        self.head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{file.name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        self.tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    def __len__(self):
+        return len(self.head) + self.file.stat().st_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with self.file.open("rb") as f:
+            while chunk := f.read(self.chunkSize):
+                yield chunk
+        yield self.tail
+
+def applyRoomsDelta(rooms, changes):
+    """部屋一覧に差分を適用(人数0の部屋は削除)"""
+    counts = {room["name"]: room["count"] for room in rooms}
+    for room in changes:
+        counts[room["name"]] = room["count"]
+    return sorted(
+        [{"name": name, "count": count} for name, count in counts.items() if count > 0],
+        key=lambda room: room["count"],
+        reverse=True,
+    )
+
 class SimpleChatWSManager:
 
     def __init__(self):
+        # websocket-client は permessage-deflate に対応していないため、WebSocketは圧縮されない
         self.sio = socketio.Client()
+        self.rooms = []
+        self.roomsVersion = None
+        self.sio.on("rooms_delta", self.onRoomsDelta)
         self.offDisconnect()
+        self.offError()
         self.offRooms()
         self.offMessage()
         
     def connect(self, url: str = "http://127.0.0.1:5000", username: str = None):
         """接続処理"""
+        self.url = url
+        self.roomsVersion = None
         self.sio.connect(f"{url}?name={username}")
 
     def disconnect(self):
@@ -36,45 +89,167 @@ class SimpleChatWSManager:
         self.sio.on("disconnect", dummyFunc)
 
     def onError(self, handler):
-        """部屋一覧受け取り"""
+        """エラー受け取り(アップロードの失敗も通知のみのエラーとして渡す)"""
+        self.errorHandler = handler
         self.sio.on("error", handler)
 
     def offError(self):
-        """部屋一覧受け取り解除"""
+        """エラー受け取り解除"""
+        self.errorHandler = dummyFunc
         self.sio.on("error", dummyFunc)
 
+    def onUploadFailed(self, message: str):
+        """アップロードの失敗を通知"""
+        self.errorHandler({"code": "UPLOAD_FAILED", "message": message})
+
     def onRooms(self, handler):
         """部屋一覧受け取り"""
-        self.sio.on("rooms", handler)
+        self.roomsHandler = handler
 
     def offRooms(self):
         """部屋一覧受け取り解除"""
-        self.sio.on("rooms", dummyFunc)
+        self.roomsHandler = dummyFunc
+
+    def onRoomsDelta(self, data):
+        """部屋一覧の差分を適用(版番号が飛んだら全件を再要求)"""
+        if data["full"]:
+            if self.roomsVersion is not None and data["version"] < self.roomsVersion:
+                return
+            self.rooms = data["rooms"]
+        else:
+            if self.roomsVersion is None or data["version"] <= self.roomsVersion:
+                return
+            if data["version"] != self.roomsVersion + 1:
+                self.sio.emit("sync_rooms")
+                return
+            self.rooms = applyRoomsDelta(self.rooms, data["rooms"])
+        self.roomsVersion = data["version"]
+        self.roomsHandler(self.rooms)
 
     def onMessage(self, handler):
-        """メッセージ受け取り"""
+        """メッセージ受け取り(サーバがまとめて送った場合も1件ずつ渡す)"""
         self.sio.on("message", handler)
+        self.sio.on(
+            "messages", lambda data: [handler(message) for message in data["messages"]]
+        )
 
     def offMessage(self):
         """メッセージ解除"""
         self.sio.on("message", dummyFunc)
+        self.sio.on("messages", dummyFunc)
+
+    def onHistory(self, handler):
+        """部屋に参加したときの過去ログ受け取り"""
+        self.sio.on("history", handler)
+
+    def offHistory(self):
+        """過去ログ解除"""
+        self.sio.on("history", dummyFunc)
 
     def join(self, room: str):
         """ルームに参加"""
+        # ロビーを離れる間の差分は届かないので、退出時に全件を受け取り直す
+        self.roomsVersion = None
         self.sio.emit("join", {"room": room})
 
     def leave(self):
         """ルームから退出"""
         self.sio.emit("leave")
 
+    def loadHistory(self, before: int, handler):
+        """before より古い過去ログを要求(結果はhandlerで受け取り)"""
+        self.sio.emit("load_history", {"before": before}, callback=handler)
+
+    def search(self, query: str, offset: int, handler):
+        """参加中の部屋のメッセージを検索(結果はhandlerで受け取り)"""
+        self.sio.emit("search", {"query": query, "offset": offset}, callback=handler)
+
     def sendText(self, message: str):
         """テキストメッセージの送信"""
         self.sio.emit("message", {"message": message})
 
-    def sendImage(self, imageData: str):
-        """画像の送信"""
+    def sendImage(self, imageData: bytes):
+        """画像の送信(バイナリ添付)"""
         self.sio.emit("message", {"image": imageData})
 
-    def sendFile(self, fileData: str, fileName):
-        """ファイルの送信"""
-        self.sio.emit("message", {"file_data": fileData, "filename": fileName})
\ No newline at end of file
+    def sendFile(self, path: str):
+        """ファイルの送信(バックグラウンドで行い、大きいファイルはHTTPで送る)"""
+        if Path(path).stat().st_size > HTTP_UPLOAD_THRESHOLD:
+            self.sio.start_background_task(self.postFile, path)
+        else:
+            self.sio.start_background_task(self.uploadFile, path)
+
+    def postFile(self, path: str):
+        """ファイルをHTTPで送信"""
+        body = MultipartFile(Path(path))
+        try:
+            response = requests.post(
+                f"{self.url.rstrip('/')}/files",
+                data=body,
+                headers={
+                    "Content-Type": body.contentType,
+                    "X-Socket-Id": self.sio.get_sid(),
+                },
+            )
+        except requests.RequestException as e:
+            self.onUploadFailed(str(e))
+            return
+        if response.status_code != 201:
+            try:
+                message = response.json()["message"]
+            except (ValueError, KeyError):
+                message = f"HTTP {response.status_code}"
+            self.onUploadFailed(message)
+
+    def uploadFile(self, path: str):
+        """ファイルを分割して送信(失敗したら onUploadFailed で通知)"""
+        try:
+            self.uploadChunks(Path(path))
+        except (OSError, socketio.exceptions.SocketIOError) as e:
+            self.onUploadFailed(str(e))
+
+    def uploadChunks(self, file: Path):
+        """ファイルを分割して送信(応答待ちのチャンクは window 個まで)"""
+        upload = self.sio.call(
+            "upload_start", {"filename": file.name, "size": file.stat().st_size}
+        )
+        if "error" in upload:
+            self.onUploadFailed(upload["error"]["message"])
+            return
+        uploadId = upload["upload_id"]
+        window = threading.Semaphore(upload["window"])
+        errors = []
+
+        def onAck(response):
+            if "error" in response:
+                errors.append(response["error"]["message"])
+            window.release()
+
+        with file.open("rb") as f:
+            offset = 0
+            while not errors:
+                chunk = f.read(upload["chunk_size"])
+                if not chunk:
+                    break
+                window.acquire()
+                self.sio.emit(
+                    "upload_chunk",
+                    {
+                        "upload_id": uploadId,
+                        "offset": offset,
+                        "data": chunk,
+                    },
+                    callback=onAck,
+                )
+                offset += len(chunk)
+
+        """送信済みのチャンクの応答をすべて待つ"""
+        for _ in range(upload["window"]):
+            window.acquire()
+        if errors:
+            self.sio.emit("upload_abort", {"upload_id": uploadId})
+            self.onUploadFailed(errors[0])
+            return
+        result = self.sio.call("upload_end", {"upload_id": uploadId})
+        if "error" in result:
+            self.onUploadFailed(result["error"]["message"])
\ No newline at end of file
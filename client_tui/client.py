@@ -1,11 +1,12 @@
 import argparse
-import base64
+import asyncio
 import io
 import webbrowser
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
+import aiohttp
 import socketio
 from PIL import Image
 from rich.style import Style
@@ -19,29 +20,37 @@ from textual.screen import Screen
 from textual.widgets import Button, Input, Label, Static
 
 IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
+# これより大きいファイルはHTTPで送信
+HTTP_UPLOAD_THRESHOLD = 1024**2 * 8
+# 表示に使う縮小画像の最小サイズ(カラーブロック表示の最大幅)
+THUMBNAIL_MIN_SIZE = 40
 
 
 class ImageClickMessage(TextualMessage):
     """画像クリック時のメッセージ"""
 
-    def __init__(self, image_data: str) -> None:
-        self.image_data = image_data
+    def __init__(self, image_url: str) -> None:
+        self.image_url = image_url
         super().__init__()
 
 
+class LoadOlderMessages(TextualMessage):
+    """過去ログの読み込み要求"""
+
+
 class ImageDisplay(Static):
     """クリック可能な画像表示ウィジェット"""
 
-    def __init__(self, image_text: Text, image_data: str):
+    def __init__(self, image_text: Text, image_url: str):
         super().__init__()
         self.image_text = image_text
-        self.image_data = image_data
+        self.image_url = image_url
 
     def compose(self) -> ComposeResult:
         yield Label(self.image_text)
 
     def on_click(self) -> None:
-        self.post_message(ImageClickMessage(self.image_data))
+        self.post_message(ImageClickMessage(self.image_url))
 
 
 class Hyperlink(Static):
@@ -95,14 +104,16 @@ class Message(Static):
         user: str,
         timestamp: str,
         content: Optional[str] = None,
-        image_data: Optional[str] = None,
+        image_url: Optional[str] = None,
+        thumbnail_url: Optional[str] = None,
         file_info: Optional[tuple[str, str]] = None,
     ):
         super().__init__()
         self.user = user
         self.timestamp = timestamp
         self.content = content
-        self.image_data = image_data
+        self.image_url = image_url
+        self.thumbnail_url = thumbnail_url
         self.file_info = file_info
 
     def compose(self) -> ComposeResult:
@@ -110,25 +121,44 @@ class Message(Static):
         yield Label(f"[{time}] {self.user}:")
         if self.content:
             yield Label(f"  {self.content}")
-        elif self.image_data:
-            for text in self.convert_image_to_color_blocks(self.image_data):
-                yield ImageDisplay(text, self.image_data)
+        elif self.image_url:
+            yield Label("  [画像を読み込み中...]", classes="image-loading")
         elif self.file_info:
             filename, link = self.file_info
             yield Hyperlink(filename, link)
 
+    def on_mount(self) -> None:
+        if self.image_url:
+            self.run_worker(self.load_image())
+
+    async def load_image(self) -> None:
+        """画像(縮小画像があればそちら)をダウンロードして表示"""
+        loading = self.query_one(".image-loading", Label)
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(
+                    self.thumbnail_url or self.image_url
+                ) as response:
+                    response.raise_for_status()
+                    image_data = await response.read()
+        except Exception as e:
+            loading.update(f"  [画像を読み込めませんでした: {str(e)}]")
+            return
+        await loading.remove()
+        await self.mount_all(
+            ImageDisplay(text, self.image_url)
+            for text in self.convert_image_to_color_blocks(image_data)
+        )
+
     def convert_image_to_color_blocks(
-        self, image_data: str, max_width: int = 40, max_height: int = 20
+        self, image_data: bytes, max_width: int = 40, max_height: int = 20
     ) -> list[Text]:
         """
         画像データをカラーブロック文字に変換する関数
         Returns: 表示用の文字列のリスト
         """
         try:
-            # Base64デコード
-            image_data = image_data.split(",")[-1]
-            image_bytes = base64.b64decode(image_data + "=" * (-len(image_data) % 4))
-            image = Image.open(io.BytesIO(image_bytes))
+            image = Image.open(io.BytesIO(image_data))
 
             # 画像のリサイズ
             width, height = image.size
@@ -166,6 +196,18 @@ class Message(Static):
             return [f"[画像の変換に失敗しました: {str(e)}]"]
 
 
+def apply_rooms_delta(rooms, changes):
+    """部屋一覧に差分を適用(人数0の部屋は削除)"""
+    counts = {room["name"]: room["count"] for room in rooms}
+    for room in changes:
+        counts[room["name"]] = room["count"]
+    return sorted(
+        [{"name": name, "count": count} for name, count in counts.items() if count > 0],
+        key=lambda room: room["count"],
+        reverse=True,
+    )
+
+
 class RoomSelector(Screen):
     """ルーム選択画面"""
 
@@ -175,10 +217,7 @@ class RoomSelector(Screen):
         yield Container(
             Label("チャットルームを選択するか、新しいルーム名を入力してください:"),
             Container(
-                *[
-                    Button(room["name"], id=f"room-{room['name']}")
-                    for room in self.rooms
-                ],
+                *[Button(room["name"]) for room in self.rooms],
                 id="room-buttons",
             ),
             Input(placeholder="新しいルーム名", id="new-room"),
@@ -190,8 +229,8 @@ class RoomSelector(Screen):
         if self.is_mounted:
             button_container = self.query_one("#room-buttons")
             button_container.remove_children()
-            for room in rooms:
-                button_container.mount(Button(room["name"], id=f"room-{room['name']}"))
+            # 差分が続けて届くと削除が終わる前に再描画されるためIDは付けない
+            button_container.mount_all([Button(room["name"]) for room in rooms])
 
     async def on_button_pressed(self, event: Button.Pressed) -> None:
         """ルームボタンが押されたときの処理"""
@@ -203,14 +242,27 @@ class RoomSelector(Screen):
             await self.app.join_room(event.value)
 
 
+class MessageLog(ScrollableContainer):
+    """先頭までスクロールすると過去ログを要求するメッセージログ"""
+
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        if new_value <= 0 < old_value:
+            self.post_message(LoadOlderMessages())
+
+    def on_mouse_scroll_up(self, event: events.MouseScrollUp) -> None:
+        if self.scroll_y <= 0:
+            self.post_message(LoadOlderMessages())
+
+
 class ChatRoom(Screen):
     """チャットルーム画面"""
 
     def compose(self) -> ComposeResult:
         yield Container(
             Label("", id="room-name"),
-            ScrollableContainer(id="message-log"),
-            Input(placeholder="メッセージを入力...", id="message-input"),
+            MessageLog(id="message-log"),
+            Input(placeholder="メッセージを入力...(Ctrl+Fで検索)", id="message-input"),
         )
 
     def clear_messages(self) -> None:
@@ -218,13 +270,10 @@ class ChatRoom(Screen):
         message_log = self.query_one("#message-log")
         message_log.remove_children()
 
-    def save_image(self, image_data: str) -> None:
+    def save_image(self, image_data: bytes) -> None:
         """画像データを保存する"""
         try:
-            # Base64デコード
-            image_data = image_data.split(",")[-1]
-            image_bytes = base64.b64decode(image_data + "=" * (-len(image_data) % 4))
-            image = Image.open(io.BytesIO(image_bytes))
+            image = Image.open(io.BytesIO(image_data))
 
             # 保存先のディレクトリを作成
             save_dir = Path("downloaded_images")
@@ -241,8 +290,23 @@ class ChatRoom(Screen):
             self.notify(f"画像の保存に失敗しました: {str(e)}", severity="error")
 
     async def on_image_click_message(self, message: ImageClickMessage) -> None:
-        """画像クリック時の処理"""
-        self.save_image(message.image_data)
+        """画像クリック時に元画像をダウンロードして保存"""
+        self.run_worker(self.download_image(message.image_url))
+
+    async def download_image(self, image_url: str) -> None:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(image_url) as response:
+                    response.raise_for_status()
+                    image_data = await response.read()
+        except Exception as e:
+            self.notify(f"画像のダウンロードに失敗しました: {str(e)}", severity="error")
+            return
+        self.save_image(image_data)
+
+    def on_load_older_messages(self, message: LoadOlderMessages) -> None:
+        """過去ログの読み込み"""
+        self.run_worker(self.app.load_older_messages(), exclusive=True)
 
     async def on_input_submitted(self, event: Input.Submitted) -> None:
         if event.value.strip():
@@ -252,6 +316,52 @@ class ChatRoom(Screen):
     async def on_key(self, event: events.Key) -> None:
         if event.key == "escape":
             await self.app.leave_room()
+        elif event.key == "ctrl+f":
+            await self.app.push_screen("search")
+
+
+class SearchScreen(Screen):
+    """参加中の部屋のメッセージ検索画面(Escで戻る)"""
+
+    search_query = ""
+    offset = 0
+
+    def compose(self) -> ComposeResult:
+        yield Container(
+            Input(placeholder="検索語を入力...", id="search-input"),
+            ScrollableContainer(id="search-results"),
+            Button("さらに表示", id="search-more", disabled=True),
+        )
+
+    async def on_input_submitted(self, event: Input.Submitted) -> None:
+        if event.value.strip():
+            self.search_query = event.value
+            self.offset = 0
+            await self.query_one("#search-results").remove_children()
+            await self.load_results()
+
+    async def on_button_pressed(self, event: Button.Pressed) -> None:
+        await self.load_results()
+
+    async def load_results(self) -> None:
+        """検索結果の次のページを追加"""
+        page = await self.app.search_messages(self.search_query, self.offset)
+        if page is None:
+            return
+        if not page["messages"] and self.offset == 0:
+            self.notify("見つかりませんでした")
+        self.offset += len(page["messages"])
+        await self.query_one("#search-results").mount_all(
+            [
+                Label(Text(f"[{m['timestamp']}] {m['user']}: {m['message']}"))
+                for m in page["messages"]
+            ]
+        )
+        self.query_one("#search-more").disabled = not page["has_more"]
+
+    async def on_key(self, event: events.Key) -> None:
+        if event.key == "escape":
+            self.app.pop_screen()
 
 
 class ChatApp(App):
@@ -278,6 +388,10 @@ class ChatApp(App):
         overflow-y: auto;
         border-bottom: none;
     }
+    #search-results {
+        height: 1fr;
+        border: solid green;
+    }
     #room-name {
         dock: top;
         width: 100%;
@@ -314,45 +428,59 @@ class ChatApp(App):
         "login": LoginScreen,
         "room_selector": RoomSelector,
         "chat": ChatRoom,
+        "search": SearchScreen,
     }
 
     def __init__(self, url: str = "http://localhost:5000", username: str = None):
         super().__init__()
-        self.sio = socketio.AsyncClient()
+        # WebSocketの圧縮(permessage-deflate)を要求する
+        self.sio = socketio.AsyncClient(websocket_extra_options={"compress": 15})
         self.url = url
         self.username = username
         self.current_room = None
+        self.oldest_message_id = None
+        self.has_more_history = True
+        self.loading_history = False
+        self.rooms_version = None
         self.setup_socket_handlers()
 
     def setup_socket_handlers(self):
-        @self.sio.on("rooms")
-        async def on_rooms(data):
-            if hasattr(self, "current_room") and self.current_room is None:
-                room_selector = self.get_screen("room_selector")
-                room_selector.rooms = data
-                self.refresh()
+        @self.sio.on("rooms_delta")
+        async def on_rooms_delta(data):
+            room_selector = self.get_screen("room_selector")
+            if data["full"]:
+                if (
+                    self.rooms_version is not None
+                    and data["version"] < self.rooms_version
+                ):
+                    return
+                rooms = data["rooms"]
+            else:
+                if self.rooms_version is None or data["version"] <= self.rooms_version:
+                    return
+                if data["version"] != self.rooms_version + 1:
+                    # 差分が欠けたので全件を再要求
+                    await self.sio.emit("sync_rooms")
+                    return
+                rooms = apply_rooms_delta(room_selector.rooms, data["rooms"])
+            self.rooms_version = data["version"]
+            room_selector.rooms = rooms
+            self.refresh()
 
         @self.sio.on("message")
         async def on_message(data):
-            if self.current_room is not None:
-                chat_screen = self.get_screen("chat")
-                message_log = chat_screen.query_one("#message-log")
-                if data.get("message"):
-                    message = Message(
-                        data["user"], data["timestamp"], content=data["message"]
-                    )
-                elif data.get("image"):
-                    message = Message(
-                        data["user"], data["timestamp"], image_data=data["image"]
-                    )
-                elif data.get("filename") and data.get("link"):
-                    message = Message(
-                        data["user"],
-                        data["timestamp"],
-                        file_info=(data["filename"], f'{self.url}{data["link"]}'),
-                    )
-                message_log.mount(message)
-                message_log.scroll_end(animate=False)
+            self.show_messages([data])
+
+        @self.sio.on("messages")
+        async def on_messages(data):
+            # サーバがまとめて送ったメッセージは1回で追加して描画する
+            self.show_messages(data["messages"])
+
+        @self.sio.on("history")
+        async def on_history(data):
+            # 参加時の過去ログ(新しい順)を古い順にまとめて描画する
+            self.has_more_history = data["has_more"]
+            self.show_messages(data["messages"][::-1])
 
         @self.sio.on("error")
         async def on_error(data):
@@ -373,6 +501,80 @@ class ChatApp(App):
             await self.sio.disconnect()
             self.push_screen("login")
 
+    def show_messages(self, messages: list[dict]):
+        """受信したメッセージをログの末尾に追加"""
+        if self.current_room is None or not messages:
+            return
+        chat_screen = self.get_screen("chat")
+        message_log = chat_screen.query_one("#message-log")
+        message_log.mount(*[self.create_message(data) for data in messages])
+        message_log.scroll_end(animate=False)
+
+    def create_message(self, data: dict) -> Message:
+        """受信データからメッセージウィジェットを作成"""
+        if data.get("id") is not None and (
+            self.oldest_message_id is None or data["id"] < self.oldest_message_id
+        ):
+            self.oldest_message_id = data["id"]
+        if data.get("message"):
+            return Message(data["user"], data["timestamp"], content=data["message"])
+        elif data.get("image_url"):
+            return Message(
+                data["user"],
+                data["timestamp"],
+                image_url=f'{self.url}{data["image_url"]}',
+                thumbnail_url=self.thumbnail_url(data.get("thumbnails")),
+            )
+        elif data.get("filename") and data.get("link"):
+            return Message(
+                data["user"],
+                data["timestamp"],
+                file_info=(data["filename"], f'{self.url}{data["link"]}'),
+            )
+
+    def thumbnail_url(self, thumbnails: Optional[list[dict]]) -> Optional[str]:
+        """表示に足りる最小の縮小画像のURL(なければNone)"""
+        for thumbnail in thumbnails or []:
+            if thumbnail["size"] >= THUMBNAIL_MIN_SIZE:
+                return f'{self.url}{thumbnail["url"]}'
+        return None
+
+    async def load_older_messages(self):
+        """表示中より古い過去ログを読み込んで先頭に追加"""
+        if (
+            self.current_room is None
+            or self.oldest_message_id is None
+            or not self.has_more_history
+            or self.loading_history
+        ):
+            return
+        self.loading_history = True
+        try:
+            page = await self.sio.call(
+                "load_history", {"before": self.oldest_message_id}
+            )
+            self.has_more_history = page["has_more"]
+            messages = [self.create_message(m) for m in page["messages"][::-1]]
+            if messages:
+                message_log = self.get_screen("chat").query_one("#message-log")
+                await message_log.mount(*messages, before=0)
+        except Exception as e:
+            self.notify(f"過去ログ読み込みエラー: {str(e)}", severity="error")
+        finally:
+            self.loading_history = False
+
+    async def search_messages(self, query: str, offset: int = 0):
+        """参加中の部屋のメッセージを検索(失敗したらNone)"""
+        try:
+            page = await self.sio.call("search", {"query": query, "offset": offset})
+        except Exception as e:
+            self.notify(f"検索エラー: {str(e)}", severity="error")
+            return None
+        if "error" in page:
+            self.notify(page["error"]["message"], severity="error")
+            return None
+        return page
+
     async def connect_to_server(self):
         """サーバーへの接続"""
         try:
@@ -388,6 +590,10 @@ class ChatApp(App):
         """ルームへの参加"""
         try:
             self.current_room = room_name
+            self.oldest_message_id = None
+            self.has_more_history = True
+            # ロビーを離れる間の差分は届かないので、退出時に全件を受け取り直す
+            self.rooms_version = None
             await self.sio.emit("join", {"room": room_name})
             await self.push_screen("chat")
             self.get_screen("chat").query_one("#room-name").update(f"Room: {room_name}")
@@ -399,18 +605,78 @@ class ChatApp(App):
         try:
             if Path(message).exists():
                 file = Path(message)
+                if file.suffix not in IMAGE_SUFFIXES:
+                    if file.stat().st_size > HTTP_UPLOAD_THRESHOLD:
+                        await self.post_file(file)
+                    else:
+                        await self.send_file(file)
+                    return
+                # バイナリ添付としてそのまま送る
                 with file.open("rb") as f:
-                    data = base64.b64encode(f.read()).decode("utf-8")
-                if file.suffix in IMAGE_SUFFIXES:
-                    message_data = {"image": data}
-                else:
-                    message_data = {"filename": file.name, "file_data": data}
+                    message_data = {"image": f.read()}
             else:
                 message_data = {"message": message}
             await self.sio.emit("message", message_data)
         except Exception as e:
             self.notify(f"メッセージ送信エラー: {str(e)}", severity="error")
 
+    async def post_file(self, file: Path):
+        """ファイルをHTTPで送信(大きいファイル用)"""
+        async with aiohttp.ClientSession() as session:
+            with file.open("rb") as f:
+                form = aiohttp.FormData(quote_fields=False)
+                form.add_field("file", f, filename=file.name)
+                async with session.post(
+                    f"{self.url}/files",
+                    data=form,
+                    headers={"X-Socket-Id": self.sio.get_sid()},
+                ) as response:
+                    result = await response.json()
+                    if response.status != 201:
+                        raise RuntimeError(result["message"])
+
+    async def send_file(self, file: Path):
+        """ファイルを分割して送信(応答待ちのチャンクは window 個まで)"""
+        upload = await self.sio.call(
+            "upload_start", {"filename": file.name, "size": file.stat().st_size}
+        )
+        if "error" in upload:
+            raise RuntimeError(upload["error"]["message"])
+        upload_id = upload["upload_id"]
+        window = asyncio.Semaphore(upload["window"])
+        errors = []
+
+        def on_ack(response):
+            if "error" in response:
+                errors.append(response["error"]["message"])
+            window.release()
+
+        with file.open("rb") as f:
+            offset = 0
+            while not errors:
+                chunk = f.read(upload["chunk_size"])
+                if not chunk:
+                    break
+                await window.acquire()
+                await self.sio.emit(
+                    "upload_chunk",
+                    {
+                        "upload_id": upload_id,
+                        "offset": offset,
+                        "data": chunk,
+                    },
+                    callback=on_ack,
+                )
+                offset += len(chunk)
+
+        # 送信済みのチャンクの応答をすべて待つ
+        for _ in range(upload["window"]):
+            await window.acquire()
+        if errors:
+            await self.sio.emit("upload_abort", {"upload_id": upload_id})
+            raise RuntimeError(errors[0])
+        await self.sio.call("upload_end", {"upload_id": upload_id})
+
     async def leave_room(self):
         """ルームからの退出"""
         if self.current_room:
@@ -421,8 +687,6 @@ class ChatApp(App):
                 chat_screen = self.get_screen("chat")
                 chat_screen.clear_messages()
                 await self.pop_screen()
-                room_selector = self.get_screen("room_selector")
-                room_selector.rooms = []
             except Exception as e:
                 self.notify(f"ルーム退出エラー: {str(e)}", severity="error")
 
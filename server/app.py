@@ -1,8 +1,16 @@
+if __name__ == "__main__":
+    # eventlet・gevent のモンキーパッチは他のモジュールを読み込む前に行う
+    from libs import concurrency
+    from libs.args import args
+
+    concurrency.patch(args.async_mode)
+
 from flask import Flask
 from flask_cors import CORS
 from flask_socketio import SocketIO
-from libs import config, storage
-from libs.args import args
+from libs import cluster, compression, concurrency, config, storage
+from libs.metrics import metrics
+from libs.profiler import profiler
 from libs.routes.http import http_module
 from libs.routes.ws import register_socket_routes
 
@@ -10,6 +18,7 @@ from libs.routes.ws import register_socket_routes
 def create_app():
     """flask初期化"""
     app = Flask(__name__)
+    compression.install()
 
     CORS(app, resources={"/*": {"origins": "*"}})
     app.config.from_object(config.AppConfig)
@@ -17,11 +26,25 @@ def create_app():
     app.json.ensure_ascii = False
 
     socketio = SocketIO(
-        app, cors_allowed_origins="*", max_http_buffer_size=config.MAX_BUFFER_SIZE
+        app,
+        cors_allowed_origins="*",
+        max_http_buffer_size=config.MAX_BUFFER_SIZE,
+        # ポーリングの応答の圧縮(WebSocketは compression.install で設定)
+        http_compression=config.COMPRESSION,
+        compression_threshold=config.COMPRESSION_THRESHOLD,
+        async_mode=concurrency.async_mode,
+        # 複数ワーカーでは送信をメッセージキュー経由で全ワーカーに配る
+        client_manager=(
+            cluster.create_manager(config.MESSAGE_QUEUE)
+            if config.MESSAGE_QUEUE
+            else None
+        ),
     )
 
     app.register_blueprint(http_module)
     register_socket_routes(socketio)
+    profiler.init_app(socketio)
+    metrics.init_app(app, socketio)
 
     return app, socketio
 
@@ -30,10 +53,17 @@ app, socketio = create_app()
 
 if __name__ == "__main__":
     storage.init()
+    # 同時接続数の上限(eventlet は既定で1024に制限される)
+    options = {}
+    if args.async_mode == "eventlet":
+        options["max_size"] = config.MAX_CONNECTIONS
+    elif args.async_mode == "gevent":
+        options["spawn"] = config.MAX_CONNECTIONS
     socketio.run(
         app,
-        host="0.0.0.0" if args.host else None,
+        host="0.0.0.0" if args.host else "127.0.0.1",
         port=args.port,
         debug=args.debug,
         allow_unsafe_werkzeug=True,
+        **options,
     )
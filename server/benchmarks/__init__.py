@@ -0,0 +1,34 @@
+"""サーバのベンチマーク
+
+serverフォルダで `python -m benchmarks.<名前>` として実行する。
+"""
+
+import os
+import statistics
+import tempfile
+import time
+
+
+def use_temp_storage(prefix: str = "simple_chat_bench_"):
+    """DB・保存先フォルダを一時ディレクトリに向ける
+
+    libs.configは読み込み時に環境変数を参照するため、libsをimportする前に呼ぶ。
+    処理能力を測るため送信の上限も外す(RATE_LIMIT=True を指定すれば有効)。
+    """
+    directory = tempfile.mkdtemp(prefix=prefix)
+    os.environ["DATABASE"] = os.path.join(directory, "storage.db")
+    os.environ["FILE_FOLDER"] = os.path.join(directory, "files")
+    os.environ["IMAGE_FOLDER"] = os.path.join(directory, "images")
+    os.environ.setdefault("RATE_LIMIT", "False")
+    return directory
+
+
+def measure(func, repeat: int):
+    """func を repeat 回実行した時間(ミリ秒)の中央値と95パーセンタイル"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.95)]
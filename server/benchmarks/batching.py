@@ -0,0 +1,154 @@
+"""部屋へのメッセージ送信のまとめ(MESSAGE_BATCH_INTERVAL)の比較
+
+まとめる待ち時間ごとにサーバを起動し、1つの部屋の参加者のうち数人が一定の頻度で
+送信したときに、受信側に届くパケット数・バイト数と、送信から受信までの遅延を測る。
+サーバ側で溜めたことによる遅延は /stats の値も表示する。
+
+$ python -m benchmarks.batching --intervals 0 5 20 --members 200 --rate 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+from benchmarks import use_temp_storage
+from benchmarks.idle import wait_ready
+
+
+def start_server(interval: float, args):
+    """一時ストレージ・指定の待ち時間でサーバを起動"""
+    use_temp_storage()
+    env = dict(os.environ, MESSAGE_BATCH_INTERVAL=str(interval), WAL_MODE="True")
+    return subprocess.Popen(
+        [sys.executable, "app.py", "-p", str(args.port)]
+        + ["--async-mode", args.async_mode],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def connect(session, url: str, name: str):
+    """Engine.IO/Socket.IOで接続して部屋に参加"""
+    ws = await session.ws_connect(
+        f"{url}/socket.io/?EIO=4&transport=websocket&name={name}"
+    )
+    await ws.receive_str()  # open
+    await ws.send_str("40")
+    while not (await ws.receive_str()).startswith("40"):
+        pass
+    await ws.send_str('42["join",{"room":"bench"}]')
+    return ws
+
+
+def parse_messages(frame: str):
+    """Socket.IOのフレームからベンチマークのメッセージを取り出す"""
+    if not frame.startswith("42"):
+        return []
+    event, data = json.loads(frame[2:])[:2]
+    if event == "message":
+        messages = [data]
+    elif event == "messages":
+        messages = data["messages"]
+    else:
+        return []
+    return [m["message"] for m in messages if m.get("message", "").startswith("b ")]
+
+
+async def receive(ws, result: dict, stop: asyncio.Event):
+    """受信したパケット数・バイト数・各メッセージの遅延を記録"""
+    while not stop.is_set():
+        try:
+            message = await ws.receive(timeout=0.5)
+        except asyncio.TimeoutError:
+            continue
+        if message.type != aiohttp.WSMsgType.TEXT:
+            break
+        now = time.time()
+        if message.data == "2":
+            await ws.send_str("3")
+            continue
+        result["frames"] += 1
+        result["bytes"] += len(message.data)
+        for text in parse_messages(message.data):
+            result["latencies"].append(now - float(text[2:]))
+
+
+async def measure(args):
+    url = f"http://127.0.0.1:{args.port}"
+    result = {"frames": 0, "bytes": 0, "latencies": []}
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_ready(session, url)
+        sockets = [
+            await connect(session, url, f"bench{i}") for i in range(args.members)
+        ]
+        await asyncio.sleep(1)
+        stop = asyncio.Event()
+        receivers = [asyncio.ensure_future(receive(ws, result, stop)) for ws in sockets]
+        await asyncio.sleep(0.5)
+        result.update(frames=0, bytes=0, latencies=[])
+
+        start = time.time()
+        senders = sockets[: args.senders]
+        sent = 0
+        while time.time() - start < args.duration:
+            ws = senders[sent % len(senders)]
+            await ws.send_str(f'42["message",{{"message":"b {time.time()}"}}]')
+            sent += 1
+            await asyncio.sleep(max(0, start + sent / args.rate - time.time()))
+        await asyncio.sleep(1)
+        elapsed = time.time() - start
+        stop.set()
+        await asyncio.gather(*receivers)
+
+        async with session.get(f"{url}/stats") as response:
+            stats = (await response.json())["messages"]
+        for ws in sockets:
+            await ws.close()
+    return result, elapsed, sent, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--intervals", nargs="+", default=[0, 5, 20], type=float, help="ms"
+    )
+    parser.add_argument("--members", default=100, type=int)
+    parser.add_argument("--senders", default=10, type=int)
+    parser.add_argument("--rate", default=50, type=float, help="messages/sec")
+    parser.add_argument("--duration", default=10, type=float)
+    parser.add_argument("--async-mode", default="gevent")
+    parser.add_argument("-p", "--port", default=5300, type=int)
+    args = parser.parse_args()
+
+    for interval in args.intervals:
+        server = start_server(interval, args)
+        try:
+            result, elapsed, sent, stats = asyncio.run(measure(args))
+        finally:
+            server.terminate()
+            server.wait()
+        latencies = sorted(result["latencies"]) or [0]
+        expected = sent * args.members
+        print(
+            f"interval={interval:g}ms"
+            f"  messages/s={len(result['latencies']) / elapsed:8.1f}"
+            f"  packets/s={result['frames'] / elapsed:8.1f}"
+            f"  KiB/s={result['bytes'] / elapsed / 1024:8.1f}"
+            f"  delivered={len(result['latencies']) / expected:6.1%}"
+            f"  latency p50={statistics.median(latencies) * 1000:6.1f}ms"
+            f" p99={latencies[int(len(latencies) * 0.99)] * 1000:6.1f}ms"
+            f"  batch delay avg={stats['average_delay']:5.1f}ms"
+            f" max={stats['max_delay']:5.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
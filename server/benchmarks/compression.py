@@ -0,0 +1,185 @@
+"""WebSocketの圧縮(COMPRESSION・COMPRESSION_THRESHOLD)の比較
+
+設定ごとにサーバを起動し、permessage-deflate を要求するクライアントを1つの部屋に集めて、
+チャットのメッセージの配信と過去ログの取得を行ったときに、サーバからクライアントへ
+実際に流れたバイト数(間に挟んだプロキシで数える)と、サーバのCPU時間を測る。
+
+$ python -m benchmarks.compression --members 50 -n 200
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+import aiohttp
+from benchmarks import use_temp_storage
+from benchmarks.idle import wait_ready
+
+SETTINGS = {
+    "off": {"COMPRESSION": "False"},
+    "threshold": {"COMPRESSION": "True"},
+    "all": {"COMPRESSION": "True", "COMPRESSION_THRESHOLD": "0"},
+}
+WORDS = (
+    "今日 明日 会議 資料 確認 お願いします ありがとうございます 了解です 例の件 "
+    "the build is green again deploy finished ok see you at lunch "
+    "リリース 障害 対応中 レビュー コメント 修正しました"
+).split()
+
+
+def cpu_time(pid: int):
+    """プロセスのCPU時間(秒)"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class CountingProxy:
+    """サーバからクライアントへのバイト数を数えるTCPプロキシ"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.received = 0
+
+    async def handle(self, reader, writer):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                "127.0.0.1", self.port
+            )
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(
+            self.pipe(reader, upstream_writer),
+            self.pipe(upstream_reader, writer, count=True),
+        )
+
+    async def pipe(self, reader, writer, count=False):
+        try:
+            while data := await reader.read(65536):
+                if count:
+                    self.received += len(data)
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def connect(session, url: str, name: str):
+    """permessage-deflate を要求して接続し、部屋に参加"""
+    ws = await session.ws_connect(
+        f"{url}/socket.io/?EIO=4&transport=websocket&name={name}", compress=15
+    )
+    await ws.receive_str()  # open
+    await ws.send_str("40")
+    while not (await ws.receive_str()).startswith("40"):
+        pass
+    await ws.send_str('42["join",{"room":"bench"}]')
+    return ws
+
+
+async def receive_until(ws, prefix: str, count: int):
+    """prefix で始まるフレームを count 個受信するまで待つ"""
+    while count > 0:
+        data = await ws.receive_str(timeout=30)
+        if data == "2":
+            await ws.send_str("3")
+        elif data.startswith(prefix):
+            count -= 1
+
+
+async def measure(pid: int, args):
+    proxy = CountingProxy(args.port)
+    server = await asyncio.start_server(proxy.handle, "127.0.0.1", args.port + 1)
+    url = f"http://127.0.0.1:{args.port + 1}"
+    random.seed(0)
+    texts = [
+        " ".join(random.choices(WORDS, k=random.randint(2, 60)))
+        for _ in range(args.messages)
+    ]
+    async with aiohttp.ClientSession() as session:
+        await wait_ready(session, url)
+        sockets = [
+            await connect(session, url, f"bench{i}") for i in range(args.members)
+        ]
+        await asyncio.sleep(1)
+        for ws in sockets:
+            while True:
+                try:
+                    await ws.receive_str(timeout=0.1)
+                except asyncio.TimeoutError:
+                    break
+
+        results = {}
+        received, cpu = proxy.received, cpu_time(pid)
+        receivers = [
+            asyncio.ensure_future(receive_until(ws, '42["message"', len(texts)))
+            for ws in sockets
+        ]
+        for text in texts:
+            await sockets[0].send_str(f'42["message",{{"message":"{text}"}}]')
+        await asyncio.gather(*receivers)
+        deliveries = len(texts) * len(sockets)
+        results["message"] = (
+            (proxy.received - received) / deliveries,
+            (cpu_time(pid) - cpu) / deliveries,
+        )
+
+        received, cpu = proxy.received, cpu_time(pid)
+        for ws in sockets:
+            await ws.send_str('421["load_history",{"limit":100}]')
+        await asyncio.gather(*(receive_until(ws, "431", 1) for ws in sockets))
+        results["history"] = (
+            (proxy.received - received) / len(sockets),
+            (cpu_time(pid) - cpu) / len(sockets),
+        )
+        for ws in sockets:
+            await ws.close()
+    # 中継中の接続が閉じ終わるのを待つ
+    await asyncio.sleep(0.5)
+    server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--settings", nargs="+", default=list(SETTINGS), choices=list(SETTINGS)
+    )
+    parser.add_argument("--members", default=50, type=int)
+    parser.add_argument("-n", "--messages", default=200, type=int)
+    parser.add_argument("--async-mode", default="threading")
+    parser.add_argument("-p", "--port", default=5400, type=int)
+    args = parser.parse_args()
+
+    for name in args.settings:
+        use_temp_storage()
+        server = subprocess.Popen(
+            [sys.executable, "app.py", "-p", str(args.port)]
+            + ["--async-mode", args.async_mode],
+            env=dict(os.environ, **SETTINGS[name]),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            results = asyncio.run(measure(server.pid, args))
+        finally:
+            server.terminate()
+            server.wait()
+        for kind, (size, cpu) in results.items():
+            unit = "message" if kind == "message" else "history page"
+            print(
+                f"{name:<10} {size:9.1f} bytes/{unit:<13}"
+                f" {cpu * 1e6:8.1f} us CPU/{unit}"
+            )
+        time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    main()
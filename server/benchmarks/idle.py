@@ -0,0 +1,185 @@
+"""待機中の接続数の負荷試験
+
+非同期モードごとにサーバを別プロセスで起動し、ロビーで待機するだけの
+WebSocket接続を大量に張ったまま保持して、接続時間・サーバのメモリ使用量・
+スレッド数と、その間のHTTP応答時間を比較する。
+
+$ python -m benchmarks.idle -n 3000 --modes threading gevent
+"""
+
+import argparse
+import asyncio
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+from benchmarks import use_temp_storage
+
+
+def read_status(pid: int):
+    """サーバプロセスのメモリ使用量(MiB)とスレッド数"""
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "Threads"):
+                status[key] = int(value.split()[0])
+    return status["VmRSS"] / 1024, status["Threads"]
+
+
+def start_server(mode: str, port: int):
+    """一時ストレージでサーバを起動"""
+    use_temp_storage()
+    return subprocess.Popen(
+        [sys.executable, "app.py", "-p", str(port), "--async-mode", mode],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, timeout: float = 15):
+    """サーバが応答するまで待つ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{url}/stats") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+async def hold(
+    session,
+    url: str,
+    name: str,
+    ready: asyncio.Queue,
+    stop: asyncio.Event,
+    timeout: float = 30,
+):
+    """Engine.IO/Socket.IOの接続だけを行い、pingに応答しながら待機する"""
+    start = time.perf_counter()
+    try:
+        async with session.ws_connect(
+            f"{url}/socket.io/?EIO=4&transport=websocket&name={name}"
+        ) as ws:
+            await ws.receive_str(timeout=timeout)  # open
+            await ws.send_str("40")
+            while not (await ws.receive_str(timeout=timeout)).startswith("40"):
+                pass
+            await ready.put(time.perf_counter() - start)
+            receiver = asyncio.ensure_future(ws.receive())
+            stopper = asyncio.ensure_future(stop.wait())
+            while True:
+                done, _ = await asyncio.wait(
+                    (receiver, stopper), return_when=asyncio.FIRST_COMPLETED
+                )
+                if stopper in done:
+                    receiver.cancel()
+                    return
+                message = receiver.result()
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    return
+                if message.data == "2":
+                    await ws.send_str("3")
+                receiver = asyncio.ensure_future(ws.receive())
+    except Exception as e:
+        await ready.put(e)
+
+
+async def measure(session, url: str):
+    """待機中の接続がある状態でのHTTP応答時間(ミリ秒)"""
+    start = time.perf_counter()
+    async with session.get(f"{url}/stats") as response:
+        await response.read()
+    return (time.perf_counter() - start) * 1000
+
+
+async def run(mode: str, connections: int, seconds: float, port: int, burst: int):
+    url = f"http://127.0.0.1:{port}"
+    server = start_server(mode, port)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        try:
+            await wait_ready(session, url)
+            ready = asyncio.Queue()
+            stop = asyncio.Event()
+            tasks = []
+            connect_times = []
+            errors = 0
+            start = time.perf_counter()
+            for i in range(0, connections, burst):
+                for j in range(i, min(i + burst, connections)):
+                    tasks.append(
+                        asyncio.ensure_future(
+                            hold(session, url, f"idle{j}", ready, stop)
+                        )
+                    )
+                # 一度に張る接続数を burst までに抑える
+                for _ in range(len(tasks) - len(connect_times) - errors):
+                    result = await ready.get()
+                    if isinstance(result, Exception):
+                        errors += 1
+                    else:
+                        connect_times.append(result)
+            elapsed = time.perf_counter() - start
+
+            await asyncio.sleep(seconds)
+            latencies = [await measure(session, url) for _ in range(20)]
+            rss, threads = read_status(server.pid)
+            stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            server.terminate()
+            server.wait()
+
+    connect_times.sort()
+    return {
+        "connected": len(connect_times),
+        "errors": errors,
+        "connect/sec": len(connect_times) / elapsed,
+        "connect p50 ms": statistics.median(connect_times) * 1000,
+        "connect p99 ms": connect_times[int(len(connect_times) * 0.99)] * 1000,
+        "http p50 ms": statistics.median(latencies),
+        "rss MiB": rss,
+        "threads": threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--connections", default=3000, type=int)
+    parser.add_argument(
+        "--modes", nargs="+", default=["threading", "eventlet", "gevent"]
+    )
+    parser.add_argument("-s", "--seconds", default=5, type=float, help="hold time")
+    parser.add_argument(
+        "-b", "--burst", default=100, type=int, help="parallel connects"
+    )
+    parser.add_argument("-p", "--port", default=5099, type=int)
+    args = parser.parse_args()
+
+    # 接続数分のファイルディスクリプタを使う(サーバプロセスにも引き継がれる)
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = {}
+    for mode in args.modes:
+        results[mode] = asyncio.run(
+            run(mode, args.connections, args.seconds, args.port, args.burst)
+        )
+
+    keys = list(next(iter(results.values())))
+    print(f"{'':<16}" + "".join(f"{mode:>12}" for mode in results))
+    for key in keys:
+        row = "".join(f"{result[key]:12.1f}" for result in results.values())
+        print(f"{key:<16}{row}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""多数のチャットクライアントを模擬する負荷試験
+
+クライアントアプリと同じ python-socketio のクライアントで N 人のユーザを接続し、
+部屋に振り分けて(uniform: 均等、zipf: 一部の部屋に集中)テキスト・画像・ファイルを
+指定の頻度で送信させ、次の値を測る。
+
+- 接続(connect)と参加(join から過去ログの受信まで)にかかる時間
+- 送信数・配信数/秒と、送信から同じ部屋の他の参加者が受信するまでの遅延
+- 接続の失敗・サーバからのエラー・途中の切断の数
+
+送信時刻はメッセージの timestamp に入れて送り、サーバがそのまま返す値から遅延を計算する
+(時計を共有するため、サーバと同じマシンで動かす)。--url を省略すると一時ストレージで
+サーバを起動する。負荷をかける側が詰まらないよう --processes で複数プロセスに分けられる。
+結果は --output のJSONに書き出し、実行ごとに比較できる。
+
+$ python -m benchmarks.load -n 1000 --rooms 50 --duration 30 --output load.json
+$ python -m benchmarks.load --url http://127.0.0.1:5000 -n 200 --image-rate 0.05
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import aiohttp
+import socketio
+from benchmarks import use_temp_storage
+from benchmarks.idle import wait_ready
+from benchmarks.synthetic import random_message
+from PIL import Image
+
+KINDS = ("text", "image", "file")
+
+
+def percentiles(values: list):
+    """p50・p95・p99・最大(ミリ秒)"""
+    if not values:
+        return None
+    values = sorted(values)
+    result = {}
+    for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        result[name] = values[min(int(len(values) * q), len(values) - 1)] * 1000
+    result["max"] = values[-1] * 1000
+    return result
+
+
+def assign_rooms(users: int, rooms: int, distribution: str, seed: int = 0):
+    """ユーザごとの部屋番号"""
+    if distribution == "uniform":
+        return [i % rooms for i in range(users)]
+    rng = random.Random(seed)
+    weights = [1 / (room + 1) for room in range(rooms)]
+    return rng.choices(range(rooms), weights, k=users)
+
+
+def make_image(size: int, rng: random.Random):
+    """size バイト程度のPNG(送信ごとに末尾を変えて別の画像として保存させる)"""
+    image = Image.frombytes("RGB", (32, 32), rng.randbytes(32 * 32 * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue() + rng.randbytes(max(0, size - buffer.tell()))
+
+
+def message_kind(message: dict):
+    if "image_url" in message:
+        return "image"
+    if "filename" in message:
+        return "file"
+    return "text"
+
+
+class Report:
+    """1プロセス分の計測結果"""
+
+    def __init__(self):
+        self.connect_times = []
+        self.join_times = []
+        self.joined = {}
+        self.sent = {kind: {} for kind in KINDS}
+        self.latencies = {kind: [] for kind in KINDS}
+        self.errors = {}
+        self.received = 0
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def receive(self, name: str, messages: list):
+        now = time.time()
+        for message in messages:
+            if message.get("user") == name:
+                continue
+            try:
+                sent = float(message.get("timestamp"))
+            except (TypeError, ValueError):
+                # システムメッセージなど
+                continue
+            self.latencies[message_kind(message)].append(now - sent)
+            self.received += 1
+
+
+class SimulatedUser:
+    """部屋に参加してメッセージを送り続けるユーザ"""
+
+    def __init__(self, name: str, room: int, report: Report, session, seed: int):
+        self.name = name
+        self.room = room
+        self.report = report
+        self.rng = random.Random(seed)
+        self.joined = asyncio.Event()
+        self.running = False
+        self.sio = socketio.AsyncClient(
+            reconnection=False, http_session=session, handle_sigint=False
+        )
+        self.sio.on("history", self.on_history)
+        self.sio.on("message", lambda data: report.receive(name, [data]))
+        self.sio.on("messages", lambda data: report.receive(name, data["messages"]))
+        self.sio.on("error", self.on_error)
+        self.sio.on("disconnect", self.on_disconnect)
+
+    async def on_history(self, data):
+        self.joined.set()
+
+    async def on_error(self, data):
+        self.report.error(f"server:{data.get('code', 'UNKNOWN')}")
+
+    async def on_disconnect(self, *args):
+        if self.running:
+            self.report.error("disconnected")
+
+    async def connect(self, url: str, timeout: float):
+        """接続して部屋に参加(失敗したらFalse)"""
+        try:
+            start = time.perf_counter()
+            await self.sio.connect(
+                f"{url}?name={self.name}",
+                transports=["websocket"],
+                wait_timeout=timeout,
+            )
+            connected = time.perf_counter()
+            await self.sio.emit("join", {"room": f"room{self.room}"})
+            await asyncio.wait_for(self.joined.wait(), timeout)
+        except Exception:
+            self.report.error("connect")
+            return False
+        self.report.connect_times.append(connected - start)
+        self.report.join_times.append(time.perf_counter() - connected)
+        self.report.joined[self.room] = self.report.joined.get(self.room, 0) + 1
+        self.running = True
+        return True
+
+    async def send_loop(self, end: float, args):
+        """終了時刻まで、種類ごとの頻度で(ポアソン過程で)送信"""
+        rates = {"text": args.text_rate, "image": args.image_rate}
+        rates["file"] = args.file_rate
+        total = sum(rates.values())
+        if total <= 0:
+            return
+        kinds = list(rates)
+        weights = list(rates.values())
+        while True:
+            delay = self.rng.expovariate(total)
+            if time.time() + delay >= end:
+                return
+            await asyncio.sleep(delay)
+            kind = self.rng.choices(kinds, weights)[0]
+            if kind == "text":
+                data = {"message": random_message(self.rng)}
+            elif kind == "image":
+                data = {"image": make_image(args.image_size, self.rng)}
+            else:
+                data = {
+                    "filename": f"load{self.rng.getrandbits(32)}.bin",
+                    "file_data": self.rng.randbytes(args.file_size),
+                }
+            data["timestamp"] = repr(time.time())
+            try:
+                await self.sio.emit("message", data)
+            except Exception:
+                self.report.error("send")
+                continue
+            sent = self.report.sent[kind]
+            sent[self.room] = sent.get(self.room, 0) + 1
+
+    async def close(self):
+        self.running = False
+        try:
+            await self.sio.disconnect()
+        except Exception:
+            pass
+
+
+async def run_clients(users: list, args, barrier, results):
+    report = Report()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        clients = [
+            SimulatedUser(f"load{i}", room, report, session, args.seed + i)
+            for i, room in users
+        ]
+        # 同時に接続を始める数を制限して順に接続
+        semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+        async def connect(client):
+            async with semaphore:
+                return await client.connect(args.url, args.timeout)
+
+        connected = await asyncio.gather(*(connect(client) for client in clients))
+        clients = [client for client, ok in zip(clients, connected) if ok]
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+        start = time.time()
+        end = start + args.duration
+        await asyncio.gather(*(client.send_loop(end, args) for client in clients))
+        # 送信済みのメッセージが届き終わる(1秒間受信がない)まで待つ
+        deadline = time.time() + args.drain
+        received = -1
+        while received != report.received and time.time() < deadline:
+            received = report.received
+            await asyncio.sleep(1)
+        for client in clients:
+            client.running = False
+        await asyncio.gather(*(client.close() for client in clients))
+    results.put(vars(report))
+
+
+def client_process(users, args, barrier, results):
+    # 切断時の送信キューの終了のログを抑える
+    logging.getLogger("engineio.client").setLevel(logging.CRITICAL)
+    asyncio.run(run_clients(users, args, barrier, results))
+
+
+def start_server(args):
+    """一時ストレージでサーバを起動"""
+    use_temp_storage()
+    env = dict(os.environ, WAL_MODE="True")
+    return subprocess.Popen(
+        [sys.executable, "app.py", "-p", str(args.port)]
+        + ["--async-mode", args.async_mode],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def check_ready(url: str):
+    async with aiohttp.ClientSession() as session:
+        await wait_ready(session, url)
+
+
+def summarize(reports: list, args, elapsed: float):
+    """各プロセスの結果をまとめる"""
+    joined = {}
+    for report in reports:
+        for room, count in report["joined"].items():
+            joined[room] = joined.get(room, 0) + count
+    sent = {kind: 0 for kind in KINDS}
+    expected = 0
+    for report in reports:
+        for kind in KINDS:
+            for room, count in report["sent"][kind].items():
+                sent[kind] += count
+                # 送信者以外の参加者に届く
+                expected += count * (joined[room] - 1)
+    latencies = {
+        kind: [value for report in reports for value in report["latencies"][kind]]
+        for kind in KINDS
+    }
+    everything = [value for values in latencies.values() for value in values]
+    errors = {}
+    for report in reports:
+        for kind, count in report["errors"].items():
+            errors[kind] = errors.get(kind, 0) + count
+    return {
+        "config": vars(args),
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "users": args.users,
+        "connected": sum(joined.values()),
+        "rooms": len(joined),
+        "largest_room": max(joined.values(), default=0),
+        "connect_ms": percentiles(
+            [value for report in reports for value in report["connect_times"]]
+        ),
+        "join_ms": percentiles(
+            [value for report in reports for value in report["join_times"]]
+        ),
+        "duration": elapsed,
+        "sent": sent,
+        "sent_per_sec": sum(sent.values()) / args.duration,
+        "delivered": len(everything),
+        "delivered_per_sec": len(everything) / args.duration,
+        "expected": expected,
+        "delivery_ratio": len(everything) / expected if expected else None,
+        "latency_ms": {
+            "all": percentiles(everything),
+            **{kind: percentiles(values) for kind, values in latencies.items()},
+        },
+        "errors": errors,
+    }
+
+
+def print_summary(result: dict):
+    def line(name, stats):
+        if stats is None:
+            return f"{name:<10} -"
+        return f"{name:<10} " + "  ".join(
+            f"{key}={value:8.1f}ms" for key, value in stats.items()
+        )
+
+    print(
+        f"users={result['users']}  connected={result['connected']}"
+        f"  rooms={result['rooms']}  largest room={result['largest_room']}"
+    )
+    print(line("connect", result["connect_ms"]))
+    print(line("join", result["join_ms"]))
+    print(
+        f"sent={result['sent']}  {result['sent_per_sec']:.1f}/s"
+        f"  delivered={result['delivered']}  {result['delivered_per_sec']:.1f}/s"
+        f"  ratio={result['delivery_ratio'] or 0:.1%}"
+    )
+    for kind, stats in result["latency_ms"].items():
+        print(line(kind, stats))
+    print(f"errors={result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="running server (default: start one)")
+    parser.add_argument("-n", "--users", default=1000, type=int)
+    parser.add_argument("--rooms", default=50, type=int)
+    parser.add_argument("--distribution", default="zipf", choices=["uniform", "zipf"])
+    parser.add_argument("--duration", default=30, type=float)
+    parser.add_argument(
+        "--text-rate", default=0.2, type=float, help="messages/sec per user"
+    )
+    parser.add_argument(
+        "--image-rate", default=0.0, type=float, help="images/sec per user"
+    )
+    parser.add_argument(
+        "--file-rate", default=0.0, type=float, help="files/sec per user"
+    )
+    parser.add_argument("--image-size", default=32 * 1024, type=int)
+    parser.add_argument("--file-size", default=64 * 1024, type=int)
+    parser.add_argument("--processes", default=1, type=int)
+    parser.add_argument("--connect-concurrency", default=50, type=int)
+    parser.add_argument("--timeout", default=30, type=float)
+    parser.add_argument(
+        "--drain", default=30, type=float, help="max wait for deliveries after sending"
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--async-mode", default="gevent")
+    parser.add_argument("-p", "--port", default=5500, type=int)
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    server = None
+    if args.url is None:
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = start_server(args)
+    try:
+        asyncio.run(check_ready(args.url))
+        rooms = assign_rooms(args.users, args.rooms, args.distribution, args.seed)
+        users = list(enumerate(rooms))
+        processes = args.processes
+        barrier = multiprocessing.Barrier(processes + 1)
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=client_process,
+                args=(users[p::processes], args, barrier, results),
+            )
+            for p in range(processes)
+        ]
+        for proc in procs:
+            proc.start()
+        barrier.wait()
+        start = time.time()
+        reports = [results.get() for _ in procs]
+        elapsed = time.time() - start
+        for proc in procs:
+            proc.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result = summarize(reports, args, elapsed)
+    print_summary(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
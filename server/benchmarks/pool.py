@@ -0,0 +1,59 @@
+"""接続プールのベンチマーク
+
+プールなし(毎回接続)とプールありで、ソケットイベントの処理数/秒を比較する。
+
+$ python -m benchmarks.pool -n 5000
+"""
+
+import argparse
+import time
+
+from benchmarks import use_temp_storage
+
+
+def run(socketio, app, events: int):
+    """ログイン・入室後にメッセージイベントを送り続けて処理数/秒を返す"""
+    client = socketio.test_client(app, query_string="name=bench")
+    client.emit("join", {"room": "bench"})
+    client.get_received()
+
+    start = time.perf_counter()
+    for i in range(events):
+        client.emit("message", {"message": f"message {i}"})
+    elapsed = time.perf_counter() - start
+
+    client.emit("leave")
+    client.disconnect()
+    return events / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--events", default=5000, type=int, help="event count")
+    parser.add_argument("-s", "--size", default=16, type=int, help="pool size")
+    args = parser.parse_args()
+
+    use_temp_storage()
+
+    from app import create_app
+    from libs import storage
+    from libs.config import DATABASE, DB_POOL_TIMEOUT
+
+    app, socketio = create_app()
+    storage.init()
+
+    results = {}
+    for label, size in (
+        ("before (no pool)", 0),
+        (f"after (pool={args.size})", args.size),
+    ):
+        storage.pool.close()
+        storage.pool = storage.ConnectionPool(DATABASE, size, DB_POOL_TIMEOUT)
+        results[label] = run(socketio, app, args.events)
+
+    for label, rate in results.items():
+        print(f"{label:<24} {rate:10.1f} events/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""ワーカー数によるメッセージ配信数のスケーリング
+
+launcher.py でワーカー数を変えて起動し、部屋ごとに分かれたクライアントが
+一斉にメッセージを送ったときの配信数/秒(受信したクライアント数の合計)を比較する。
+クライアントはワーカーのポートに直接、順番に振り分けて接続する(IPアドレスでの固定と同じく
+1クライアントは1ワーカーにだけ接続する)。負荷をかける側が詰まらないよう複数プロセスで動かす。
+
+$ python -m benchmarks.scaling -w 1 2 4 --rooms 20 --members 10 -n 200
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+from benchmarks import use_temp_storage
+
+MARKER = '"message":"bench '
+
+
+async def connect(session, port: int, name: str, room: str):
+    """Engine.IO/Socket.IOで接続して部屋に参加"""
+    ws = await session.ws_connect(
+        f"http://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket&name={name}"
+    )
+    await ws.receive_str()  # open
+    await ws.send_str("40")
+    while not (await ws.receive_str()).startswith("40"):
+        pass
+    await ws.send_str(f'42["join",{{"room":"{room}"}}]')
+    return ws
+
+
+async def receive(ws, expected: int, deadline: float):
+    """ベンチマークのメッセージを expected 件受信するまで待ち、受信数を返す"""
+    received = 0
+    while received < expected:
+        try:
+            message = await ws.receive(timeout=max(0.1, deadline - time.time()))
+        except asyncio.TimeoutError:
+            break
+        if message.type != aiohttp.WSMsgType.TEXT:
+            break
+        if message.data == "2":
+            await ws.send_str("3")
+        elif MARKER in message.data:
+            received += 1
+    return received
+
+
+async def run_clients(clients, ports, members, messages, barrier, results, timeout):
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        sockets = [
+            await connect(session, ports[i % len(ports)], f"bench{i}", f"room{room}")
+            for i, room in clients
+        ]
+        await asyncio.sleep(1)
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+        start = time.time()
+        receivers = [
+            asyncio.ensure_future(receive(ws, members * messages, start + timeout))
+            for ws in sockets
+        ]
+        for n in range(messages):
+            for ws in sockets:
+                await ws.send_str(f'42["message",{{"message":"bench {n}"}}]')
+        received = sum(await asyncio.gather(*receivers))
+        results.put((start, time.time(), received))
+        for ws in sockets:
+            await ws.close()
+
+
+def client_process(clients, ports, members, messages, barrier, results, timeout):
+    asyncio.run(
+        run_clients(clients, ports, members, messages, barrier, results, timeout)
+    )
+
+
+def wait_workers(launcher: subprocess.Popen):
+    """launcher.py がワーカーの起動を知らせるまで待ち、以降の出力は読み捨てる"""
+    for line in launcher.stdout:
+        if "workers on ports" in line:
+            threading.Thread(target=launcher.stdout.read, daemon=True).start()
+            return
+    raise RuntimeError("launcher exited")
+
+
+def run(workers: int, args):
+    use_temp_storage()
+    port = args.port
+    launcher = subprocess.Popen(
+        [sys.executable, "launcher.py", "-w", str(workers), "-p", str(port)]
+        + ["--no-proxy", "--async-mode", args.async_mode],
+        env=dict(os.environ, WAL_MODE="True"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        wait_workers(launcher)
+        ports = [port + 1 + i for i in range(workers)]
+        clients = [(i, i % args.rooms) for i in range(args.rooms * args.members)]
+        processes = args.processes
+        barrier = multiprocessing.Barrier(processes + 1)
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=client_process,
+                args=(
+                    clients[p::processes],
+                    ports,
+                    args.members,
+                    args.messages,
+                    barrier,
+                    results,
+                    args.timeout,
+                ),
+            )
+            for p in range(processes)
+        ]
+        for proc in procs:
+            proc.start()
+        barrier.wait()
+        reports = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        launcher.send_signal(signal.SIGTERM)
+        launcher.wait()
+
+    start = min(report[0] for report in reports)
+    end = max(report[1] for report in reports)
+    received = sum(report[2] for report in reports)
+    expected = len(clients) * args.members * args.messages
+    return received / (end - start), received / expected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", nargs="+", default=[1, 2, 4], type=int)
+    parser.add_argument("--rooms", default=20, type=int)
+    parser.add_argument("--members", default=10, type=int, help="clients per room")
+    parser.add_argument("-n", "--messages", default=100, type=int, help="per client")
+    parser.add_argument("--processes", default=4, type=int, help="client processes")
+    parser.add_argument("--timeout", default=60, type=float)
+    parser.add_argument("--async-mode", default="gevent")
+    parser.add_argument("-p", "--port", default=5200, type=int)
+    args = parser.parse_args()
+
+    print(f"cpu count: {os.cpu_count()}")
+    base = None
+    for workers in args.workers:
+        rate, delivered = run(workers, args)
+        base = base or rate
+        print(
+            f"workers={workers:<3} {rate:10.1f} deliveries/sec  x{rate / base:5.2f}"
+            f"  (delivered {delivered:.1%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
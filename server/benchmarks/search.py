@@ -0,0 +1,87 @@
+"""全文検索(FTS5)のベンチマーク
+
+大量の過去ログを生成したDBで、部屋を指定した検索の応答時間を語の種類ごとに測る。
+比較として、索引を使わずに LIKE で部屋のメッセージ全体を探した場合も測る。
+生成には時間がかかるので、--database で同じDBを使い回せる。
+
+$ python -m benchmarks.search -n 1000000 --database /tmp/search_bench.db
+"""
+
+import argparse
+import os
+import random
+import time
+
+from benchmarks import measure, use_temp_storage
+from benchmarks.synthetic import RARE_WORD, generate_history
+
+QUERIES = {
+    "rare word": RARE_WORD,
+    "common word": "お願いします",
+    "two words": "deploy rollback",
+    "short word": "会議",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rows", default=1000000, type=int)
+    parser.add_argument("--rooms", default=100, type=int)
+    parser.add_argument("--database", help="reuse this database if it exists")
+    parser.add_argument("--repeat", default=20, type=int)
+    args = parser.parse_args()
+
+    use_temp_storage()
+    if args.database:
+        os.environ["DATABASE"] = args.database
+    os.environ["WAL_MODE"] = "True"
+
+    from libs import storage
+
+    storage.init_db()
+    with storage.pool.connection() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if count < args.rows:
+            start = time.perf_counter()
+            generate_history(conn, args.rows - count, args.rooms)
+            elapsed = time.perf_counter() - start
+            print(f"generated {args.rows - count} rows: {elapsed:.1f}s")
+        size = os.path.getsize(os.environ["DATABASE"]) / 1024**2
+        print(f"messages: {max(count, args.rows)}  database: {size:.0f} MiB")
+        room_ids = [
+            row[0]
+            for row in conn.execute("SELECT id FROM rooms WHERE name LIKE 'room%'")
+        ]
+
+        rng = random.Random(0)
+        for name, query in QUERIES.items():
+            for offset in (0, 100):
+                p50, p95 = measure(
+                    lambda: storage.search_messages(
+                        conn, rng.choice(room_ids), query, 20, offset
+                    ),
+                    args.repeat,
+                )
+                print(
+                    f"{name:<12} offset={offset:<4} p50={p50:8.2f}ms  p95={p95:8.2f}ms"
+                )
+
+        # 索引を使わない場合
+        p50, p95 = measure(
+            lambda: conn.execute(
+                """
+                SELECT m.id FROM messages m
+                WHERE m.room_id = ? AND m.message LIKE ?
+                ORDER BY m.id DESC LIMIT 21
+                """,
+                (rng.choice(room_ids), f"%{RARE_WORD}%"),
+            ).fetchall(),
+            args.repeat,
+        )
+        print(
+            f"{'LIKE scan':<12} {'(rare word)':<11} p50={p50:8.2f}ms  p95={p95:8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
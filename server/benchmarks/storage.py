@@ -0,0 +1,217 @@
+"""ストレージ層のベンチマーク
+
+大量の投稿(メッセージ・画像・ファイル)を多数の部屋・ユーザに分けて生成したDBで、
+イベント処理が発行する主なSQLの応答時間と書き込みのスループットを測り、
+それぞれの EXPLAIN QUERY PLAN を表示する。
+
+- join: 参加時の過去ログ(get_history)と、古いページの読み込み(before 指定)
+- rooms: 部屋名での検索と、部屋一覧(presence.rooms、参加人数はメモリ上で管理)
+- users: 接続時のユーザ名での検索と、切断時の socket_id での更新
+- insert: メッセージの保存(書き込みスレッドでまとめてコミット / 1件ずつコミット)
+- sweep: 古いファイルの行の削除(sweep_files、測定後に巻き戻す)
+
+生成には時間がかかるので、--database で同じDBを使い回せる。
+
+$ python -m benchmarks.storage -n 2000000 --rooms 2000 --users 10000 --database /tmp/storage.db
+"""
+
+import argparse
+import os
+import random
+import time
+
+from benchmarks import measure, use_temp_storage
+from benchmarks.synthetic import generate_history, random_message
+
+
+def trace(conn, func):
+    """func が実行したSQL(パラメータ展開済み、トリガーを除く)"""
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        func()
+    finally:
+        conn.set_trace_callback(None)
+    return [sql for sql in statements if not sql.lstrip().startswith("--")]
+
+
+def explain(conn, sql: str):
+    """EXPLAIN QUERY PLAN を木の形で"""
+    depth = {0: -1}
+    lines = []
+    for id, parent, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+        depth[id] = depth.get(parent, -1) + 1
+        lines.append("      " + "  " * depth[id] + detail)
+    return lines
+
+
+def report(conn, name: str, func, repeat: int):
+    """応答時間と、実行したSQLごとの実行計画を表示"""
+    statements = trace(conn, func)
+    p50, p95 = measure(func, repeat)
+    print(f"{name:<28} p50={p50:8.3f}ms  p95={p95:8.3f}ms")
+    for sql in dict.fromkeys(statements):
+        if sql.split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE"):
+            continue
+        print("    " + " ".join(sql.split())[:100])
+        print("\n".join(explain(conn, sql)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rows", default=2000000, type=int)
+    parser.add_argument("--rooms", default=2000, type=int)
+    parser.add_argument("--users", default=10000, type=int)
+    parser.add_argument("--image-rate", default=0.05, type=float)
+    parser.add_argument("--file-rate", default=0.02, type=float)
+    parser.add_argument("--online", default=5000, type=int, help="sockets in rooms")
+    parser.add_argument("--database", help="reuse this database if it exists")
+    parser.add_argument("--repeat", default=200, type=int)
+    parser.add_argument("--inserts", default=5000, type=int)
+    parser.add_argument("--sweep", nargs="+", default=[5, 1000], type=int)
+    args = parser.parse_args()
+
+    use_temp_storage()
+    if args.database:
+        os.environ["DATABASE"] = args.database
+    os.environ["WAL_MODE"] = "True"
+    # 起動時の古いファイルの削除で生成した行を消さない
+    os.environ["MAX_FILES"] = str(10**12)
+
+    from libs import storage
+    from libs.config import JOIN_MESSAGES
+    from libs.presence import presence
+
+    storage.init_db()
+    rng = random.Random(0)
+    with storage.pool.connection() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM timeline").fetchone()[0]
+        if count < args.rows:
+            start = time.perf_counter()
+            generate_history(
+                conn,
+                args.rows - count,
+                args.rooms,
+                args.users,
+                seed=count,
+                image_rate=args.image_rate,
+                file_rate=args.file_rate,
+            )
+            elapsed = time.perf_counter() - start
+            print(f"generated {args.rows - count} rows: {elapsed:.1f}s")
+        # IDの払い出し・書き込みスレッドは生成した行の後から始める
+        storage.init()
+        counts = {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("messages", "images", "files", "rooms", "users")
+        }
+        size = os.path.getsize(os.environ["DATABASE"]) / 1024**2
+        print(f"{counts}  database: {size:.0f} MiB\n")
+
+        rooms = conn.execute("SELECT id, name FROM rooms").fetchall()
+        users = conn.execute(
+            "SELECT id, name, socket_id FROM users WHERE socket_id IS NOT NULL"
+        ).fetchall()
+        last_id = conn.execute("SELECT MAX(id) FROM timeline").fetchone()[0]
+
+        report(
+            conn,
+            "join history",
+            lambda: storage.get_history(conn, rng.choice(rooms)["id"], JOIN_MESSAGES),
+            args.repeat,
+        )
+        report(
+            conn,
+            "history page (before)",
+            lambda: storage.get_history(
+                conn, rng.choice(rooms)["id"], 100, rng.randrange(last_id)
+            ),
+            args.repeat,
+        )
+        report(
+            conn,
+            "room by name",
+            lambda: conn.execute(
+                "SELECT id FROM rooms WHERE name = ?", (rng.choice(rooms)["name"],)
+            ).fetchone(),
+            args.repeat,
+        )
+        # 接続中のユーザを部屋に振り分けて一覧を作る
+        for i in range(args.online):
+            room = rng.choice(rooms)
+            presence.connect(f"bench{i}", i, f"bench{i}")
+            presence.join(f"bench{i}", room["id"], room["name"])
+        report(conn, f"room list ({args.online} online)", presence.rooms, args.repeat)
+        report(
+            conn,
+            "user by name (connect)",
+            lambda: conn.execute(
+                "SELECT * FROM users WHERE name = ?", (rng.choice(users)["name"],)
+            ).fetchone(),
+            args.repeat,
+        )
+        conn.execute("BEGIN")
+        report(
+            conn,
+            "user by socket_id (disconnect)",
+            lambda: conn.execute(
+                "UPDATE users SET is_active = false WHERE socket_id = ?",
+                (rng.choice(users)["socket_id"],),
+            ),
+            args.repeat,
+        )
+        conn.rollback()
+
+        # 書き込みスレッドでまとめてコミット(WALモードのイベント処理と同じ)
+        start = time.perf_counter()
+        for _ in range(args.inserts):
+            future = storage.write(
+                storage.insert_message,
+                rng.choice(rooms)["id"],
+                rng.choice(users)["id"],
+                random_message(rng),
+                storage.next_timeline_id(),
+            )
+        future.result()
+        elapsed = time.perf_counter() - start
+        print(
+            f"{'insert (batch writer)':<28} {args.inserts / elapsed:10.0f} messages/s"
+        )
+        start = time.perf_counter()
+        for _ in range(args.inserts):
+            storage.insert_message(
+                conn,
+                rng.choice(rooms)["id"],
+                rng.choice(users)["id"],
+                random_message(rng),
+                storage.next_timeline_id(),
+            )
+            conn.commit()
+        elapsed = time.perf_counter() - start
+        print(f"{'insert (commit each)':<28} {args.inserts / elapsed:10.0f} messages/s")
+
+        # 同じ接続のトランザクション内で実行し、削除した行は巻き戻す
+        files = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        for deleted in args.sweep:
+            # 生成したファイルの行より多くは削除できない
+            deleted = max(0, min(deleted, files))
+            conn.execute("BEGIN")
+            storage._local.conn = conn
+            try:
+                statements = trace(conn, lambda: storage.sweep_files(files - deleted))
+                conn.rollback()
+                conn.execute("BEGIN")
+                start = time.perf_counter()
+                storage.sweep_files(files - deleted)
+                elapsed = (time.perf_counter() - start) * 1000
+            finally:
+                storage._local.conn = None
+                conn.rollback()
+            print(f"{f'sweep files ({deleted} rows)':<28} {elapsed:10.3f}ms")
+            for sql in dict.fromkeys(statements):
+                print("    " + " ".join(sql.split())[:100])
+                print("\n".join(explain(conn, sql)))
+
+
+if __name__ == "__main__":
+    main()
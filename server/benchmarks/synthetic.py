@@ -0,0 +1,128 @@
+"""ベンチマーク用の大量の過去ログの生成
+
+ユーザ・部屋を作り、単語の出現頻度に偏りのある(よく使う語ほど多い)メッセージと、
+指定の割合の画像・ファイルをタイムラインごと一括で登録する。
+全文検索の索引もトリガーで同時に作られる。画像・ファイルの本体は保存しない。
+"""
+
+import random
+import sqlite3
+
+# 出現頻度の高い順(i 番目の語は 1 / (i + 1) の重みで選ばれる)
+WORDS = (
+    "お願いします ありがとうございます 了解です 確認 今日 明日 会議 資料 "
+    "the is ok deploy build review please thanks fixed "
+    "リリース レビュー 修正しました 対応中 障害 例の件 ランチ 打ち合わせ "
+    "staging production rollback hotfix migration database "
+    "見積もり 請求書 契約書 議事録 インシデント"
+).split()
+# 1000件に1件だけ含まれる語
+RARE_WORD = "ポストモーテム"
+
+
+def random_message(rng: random.Random):
+    """2〜30語のメッセージ"""
+    weights = [1 / (i + 1) for i in range(len(WORDS))]
+    words = rng.choices(WORDS, weights, k=rng.randint(2, 30))
+    if rng.random() < 0.001:
+        words.append(RARE_WORD)
+    return " ".join(words)
+
+
+def generate_history(
+    conn: sqlite3.Connection,
+    rows: int,
+    rooms: int = 100,
+    users: int = 1000,
+    seed: int = 0,
+    chunk: int = 10000,
+    image_rate: float = 0.0,
+    file_rate: float = 0.0,
+):
+    """rows 件の投稿を rooms 個の部屋に登録し、部屋IDのリストを返す
+
+    投稿のうち image_rate の割合を画像、file_rate の割合をファイルにする。
+    ユーザには接続中と同じ形式の socket_id を付ける。
+    """
+    # libs は use_temp_storage() の後に読み込む
+    from libs.storage import get_file_link, get_file_path
+
+    rng = random.Random(seed)
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (name, socket_id) VALUES (?, ?)",
+        [(f"user{i}", f"{rng.getrandbits(80):020x}") for i in range(users)],
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO rooms (name) VALUES (?)",
+        [(f"room{i}",) for i in range(rooms)],
+    )
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users")]
+    room_ids = [
+        row[0] for row in conn.execute("SELECT id FROM rooms WHERE name LIKE 'room%'")
+    ]
+    last_ids = {}
+    for table in ("messages", "images", "files", "timeline"):
+        last_ids[table] = conn.execute(
+            f"SELECT COALESCE(MAX(id), 0) FROM {table}"
+        ).fetchone()[0]
+
+    for start in range(0, rows, chunk):
+        inserts = {"messages": [], "images": [], "files": []}
+        timeline = []
+        for _ in range(min(chunk, rows - start)):
+            room_id, user_id = rng.choice(room_ids), rng.choice(user_ids)
+            kind = rng.random()
+            if kind < image_rate:
+                table, kind = "images", "image"
+            elif kind < image_rate + file_rate:
+                table, kind = "files", "file"
+            else:
+                table, kind = "messages", "message"
+            last_ids[table] += 1
+            last_ids["timeline"] += 1
+            ref_id = last_ids[table]
+            if kind == "message":
+                inserts[table].append((ref_id, room_id, user_id, random_message(rng)))
+            elif kind == "image":
+                digest = f"{rng.getrandbits(256):064x}"
+                inserts[table].append((ref_id, room_id, user_id, digest))
+            else:
+                filename = f"file{ref_id}.txt"
+                inserts[table].append(
+                    (
+                        ref_id,
+                        room_id,
+                        user_id,
+                        filename,
+                        get_file_path(ref_id, filename),
+                        get_file_link(ref_id, filename),
+                    )
+                )
+            timeline.append((last_ids["timeline"], room_id, user_id, kind, ref_id))
+        conn.executemany(
+            "INSERT INTO messages (id, room_id, user_id, message) VALUES (?, ?, ?, ?)",
+            inserts["messages"],
+        )
+        conn.executemany(
+            """
+            INSERT INTO images (id, room_id, user_id, image, digest)
+            VALUES (?, ?, ?, '', ?)
+            """,
+            inserts["images"],
+        )
+        conn.executemany(
+            """
+            INSERT INTO files (id, room_id, user_id, filename, save_name, link)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            inserts["files"],
+        )
+        conn.executemany(
+            """
+            INSERT INTO timeline (id, room_id, user_id, kind, ref_id)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            timeline,
+        )
+        conn.commit()
+    return room_ids
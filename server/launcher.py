@@ -0,0 +1,178 @@
+"""複数ワーカーでのサーバ起動
+
+app.py のワーカーを別々のポートで起動し、ワーカー間の送信を中継する内蔵ブローカーと、
+同じクライアントを常に同じワーカーへ振り分けるプロキシ(クライアントのIPアドレスで固定)を動かす。
+Engine.IO のポーリングとWebSocketへの切り替えは同じワーカーに届く必要がある。
+内蔵ブローカーのソケットは起動ごとに作る本人のみアクセスできる一時ディレクトリに置く。
+
+$ python launcher.py -w 4 -p 5000
+
+MESSAGE_QUEUE に redis:// などを設定すると内蔵ブローカーの代わりにそちらを使う。
+--no-proxy ではプロキシを動かさないので、nginx の ip_hash などで各ワーカーに振り分ける。
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import zlib
+
+from dotenv import load_dotenv
+from libs.cluster import Broker
+from libs.concurrency import ASYNC_MODES
+from libs.config import MAX_WORKERS
+
+load_dotenv()
+
+
+class StickyProxy:
+    """クライアントのIPアドレスのハッシュでワーカーを選ぶTCPプロキシ
+
+    ポーリングの各リクエストは別のTCP接続で届くことがあるので、ポート番号は使えない。
+    TCPのまま中継するため Engine.IO の sid も読まない。そのため同じNATや
+    リバースプロキシの後ろのクライアントはすべて同じワーカーに集まる。
+    偏る場合は --no-proxy にして、sid やクッキーで振り分けるプロキシを前に置く。
+    """
+
+    def __init__(self, ports: list[int]):
+        self.ports = ports
+
+    def pick(self, address: str):
+        """クライアントの振り分け先のポート"""
+        return self.ports[zlib.crc32(address.encode()) % len(self.ports)]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        port = self.pick(writer.get_extra_info("peername")[0])
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                "127.0.0.1", port
+            )
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(
+            self.pipe(reader, upstream_writer), self.pipe(upstream_reader, writer)
+        )
+
+    async def pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def wait_port(port: int, process: asyncio.subprocess.Process, timeout=30):
+    """ワーカーが接続を受け付けるまで待つ"""
+    for _ in range(int(timeout * 10)):
+        if process.returncode is not None:
+            raise RuntimeError(f"worker on port {port} exited")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"worker on port {port} did not start")
+
+
+async def start_worker(index: int, args, env: dict):
+    port = args.port + 1 + index
+    command = [sys.executable, "app.py", "-p", str(port)]
+    command += ["--async-mode", args.async_mode]
+    if args.host and args.no_proxy:
+        command.append("--host")
+    worker_env = dict(env, WORKERS=str(args.workers), WORKER_INDEX=str(index))
+    process = await asyncio.create_subprocess_exec(*command, env=worker_env)
+    await wait_port(port, process)
+    return process
+
+
+async def run(args):
+    env = dict(os.environ)
+    broker = None
+    runtime_dir = None
+    if not env.get("MESSAGE_QUEUE"):
+        # mkdtemp は 0700 で作るので、他のユーザはソケットに接続できない
+        runtime_dir = tempfile.mkdtemp(prefix=f"simple_chat_{args.port}_")
+        env["MESSAGE_QUEUE"] = f"unix://{os.path.join(runtime_dir, 'broker.sock')}"
+
+    workers = []
+    proxy = None
+    try:
+        if env["MESSAGE_QUEUE"].startswith("unix://"):
+            broker = Broker(env["MESSAGE_QUEUE"].removeprefix("unix://"))
+            await broker.start()
+        # DBの初期化は最初のワーカーが行うので、起動を待ってから残りを起動する
+        workers.append(await start_worker(0, args, env))
+        workers += await asyncio.gather(
+            *(start_worker(i, args, env) for i in range(1, args.workers))
+        )
+        ports = [args.port + 1 + i for i in range(args.workers)]
+        if not args.no_proxy:
+            proxy = await asyncio.start_server(
+                StickyProxy(ports).handle,
+                "0.0.0.0" if args.host else "127.0.0.1",
+                args.port,
+            )
+        print(
+            f"{args.workers} workers on ports {ports} ({env['MESSAGE_QUEUE']})",
+            flush=True,
+        )
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        waiters = [asyncio.ensure_future(worker.wait()) for worker in workers]
+        await asyncio.wait(
+            [asyncio.ensure_future(stop.wait()), *waiters],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        if proxy is not None:
+            proxy.close()
+        for worker in workers:
+            if worker.returncode is None:
+                worker.terminate()
+        for worker in workers:
+            await worker.wait()
+        if broker is not None:
+            await broker.stop()
+        if runtime_dir is not None:
+            shutil.rmtree(runtime_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", action="store_true", help="host server")
+    parser.add_argument("-p", "--port", default=int(os.getenv("PORT", 5000)), type=int)
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=min(os.cpu_count(), MAX_WORKERS),
+        type=int,
+        help=f"worker count (up to {MAX_WORKERS})",
+    )
+    parser.add_argument(
+        "--async-mode",
+        default=os.getenv("ASYNC_MODE", "threading"),
+        choices=ASYNC_MODES,
+    )
+    parser.add_argument(
+        "--no-proxy", action="store_true", help="workers only (use nginx ip_hash)"
+    )
+    args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_WORKERS:
+        parser.error(f"--workers must be between 1 and {MAX_WORKERS}")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import argparse
 import os
 
 from dotenv import load_dotenv
+from libs.concurrency import ASYNC_MODES
 
 load_dotenv()
 parser = argparse.ArgumentParser()
@@ -10,6 +11,12 @@ parser.add_argument("--host", action="store_true", help="host server")
 parser.add_argument(
     "-p", "--port", default=os.getenv("PORT"), type=int, help="server port"
 )
+parser.add_argument(
+    "--async-mode",
+    default=os.getenv("ASYNC_MODE", "threading"),
+    choices=ASYNC_MODES,
+    help="server concurrency (eventlet/gevent for many connections)",
+)
 parser.add_argument("-d", "--debug", action="store_true", help="flask debug mode")
 
 args = parser.parse_args()
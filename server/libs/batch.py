@@ -0,0 +1,126 @@
+import threading
+import time
+
+from flask_socketio import SocketIO
+from libs.config import MESSAGE_BATCH_INTERVAL, MESSAGE_BATCH_SIZE
+
+
+class MessageBatcher:
+    """部屋へのメッセージ送信をまとめる
+
+    部屋ごとに interval 秒の間に届いたメッセージを溜め、1回の messages イベント
+    ({"messages": [...]})で送る。溜まった数が size に達した部屋はその場で送るので、
+    追加の遅延は最大 interval 秒(0以下なら溜めずに message イベントで即時送信)。
+    部屋ごとに溜めた順に送るため、送信中の部屋のまとめは送信中のスレッドがあとで続けて送る。
+    """
+
+    def __init__(self, interval: float, size: int):
+        self.interval = interval
+        self.size = size
+        self.socketio = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._task = None
+        # 部屋 -> [(溜めた時刻, メッセージ)]
+        self._pending = {}
+        # 部屋 -> 送信待ちのまとめのリスト(部屋があれば送信中のスレッドがいる)
+        self._ready = {}
+        self.messages = 0
+        self.batches = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def init_app(self, socketio: SocketIO):
+        self.socketio = socketio
+
+    def send(self, message: dict, room: str):
+        """部屋にメッセージを送信(まとめる場合は溜める)"""
+        if self.interval <= 0:
+            self.socketio.emit("message", message, to=room)
+            return
+        with self._lock:
+            pending = self._pending.setdefault(room, [])
+            pending.append((time.monotonic(), message))
+            drain = False
+            if len(pending) >= self.size:
+                del self._pending[room]
+                drain = self._enqueue(room, pending)
+            if self._task is None:
+                self._task = self.socketio.start_background_task(self._run)
+        if drain:
+            self._drain(room)
+        else:
+            self._wakeup.set()
+
+    def flush(self):
+        """溜まったメッセージを全ての部屋に送信"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            rooms = [
+                room for room, batch in pending.items() if self._enqueue(room, batch)
+            ]
+        for room in rooms:
+            self._drain(room)
+
+    def stats(self):
+        """送信したメッセージ数・まとめた送信数・溜めたことによる遅延(ミリ秒)"""
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "messages": self.messages,
+                "batches": self.batches,
+                "average_delay": (
+                    self.total_delay / self.messages * 1000 if self.messages else 0
+                ),
+                "max_delay": self.max_delay * 1000,
+            }
+
+    def _enqueue(self, room: str, batch: list):
+        """送信待ちに加え、この部屋を送信中のスレッドがいなければ True(呼び出し元が送る)
+
+        self._lock を取得した状態で呼ぶ。
+        """
+        ready = self._ready.get(room)
+        if ready is not None:
+            ready.append(batch)
+            return False
+        self._ready[room] = [batch]
+        return True
+
+    def _drain(self, room: str):
+        """部屋の送信待ちを溜めた順に送る(送信中に加わった分も送る)"""
+        while True:
+            with self._lock:
+                ready = self._ready[room]
+                if not ready:
+                    del self._ready[room]
+                    return
+                batch = ready.pop(0)
+            try:
+                self._emit(room, batch)
+            except Exception as e:
+                print(f"message batch failed: {e!r}")
+
+    def _emit(self, room: str, batch: list):
+        now = time.monotonic()
+        self.socketio.emit("messages", {"messages": [m for _, m in batch]}, to=room)
+        with self._lock:
+            self.messages += len(batch)
+            self.batches += 1
+            for queued, _ in batch:
+                self.total_delay += now - queued
+                self.max_delay = max(self.max_delay, now - queued)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # 最初のメッセージから interval 秒待つ間に届いた分もまとめて送る
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"message batch failed: {e!r}")
+
+
+batcher = MessageBatcher(MESSAGE_BATCH_INTERVAL / 1000, MESSAGE_BATCH_SIZE)
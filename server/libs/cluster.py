@@ -0,0 +1,263 @@
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+import socketio
+from libs.config import CLUSTER_HEARTBEAT
+from libs.lobby import lobby
+from libs.presence import presence
+from socketio import kombu_manager, redis_manager
+
+# ブローカーとの間のメッセージの区切り(ペイロードの長さ)
+FRAME = struct.Struct("!I")
+
+
+class ClusterMixin:
+    """複数ワーカー用の pub/sub マネージャの共通処理
+
+    接続中のユーザ一覧の変更をメッセージキューで共有し、各ワーカーが全体の一覧を持つ。
+    取りこぼしや後から起動したワーカーのため、CLUSTER_HEARTBEAT 秒ごとに
+    自分の接続の一覧全体も送り、3回分届かないワーカーの接続は停止したものとして消す。
+
+    キューに流すメッセージは pickle ではなく JSON にする(受け取った内容を実行しない)。
+    """
+
+    def initialize(self):
+        self._seen = {}
+        super().initialize()
+        presence.share = self.share_presence
+        if not self.write_only:
+            self.server.start_background_task(self._heartbeat)
+
+    def share_presence(self, op: str, *args):
+        """接続中のユーザ一覧の変更を他のワーカーに送る"""
+        self._publish(
+            {"method": "presence", "op": op, "args": args, "host_id": self.host_id}
+        )
+
+    def emit(self, event, data, namespace=None, room=None, to=None, **kwargs):
+        room = to or room
+        if isinstance(room, str) and self.is_connected(room, namespace or "/"):
+            # このワーカーに接続中のクライアント宛ならキューを通さない
+            kwargs["ignore_queue"] = True
+        return super().emit(event, data, namespace=namespace, room=room, **kwargs)
+
+    def _listen(self):
+        for message in super()._listen():
+            try:
+                data = decode(message)
+            except ValueError:
+                print("dropped a malformed message from the message queue")
+                continue
+            if data.get("method") == "presence":
+                if data.get("host_id") != self.host_id:
+                    self._receive_presence(data)
+                continue
+            yield data
+
+    def _receive_presence(self, data: dict):
+        host = data["host_id"]
+        self._seen[host] = time.monotonic()
+        op, args = data["op"], data["args"]
+        if op == "sync":
+            self.share_presence("snapshot", presence.snapshot())
+            return
+        if op == "snapshot":
+            presence.replace_host(host, args[0])
+        else:
+            presence.replicate(host, op, *args)
+        lobby.notify()
+
+    def _heartbeat(self):
+        # 先に起動しているワーカーの一覧を要求
+        self.share_presence("sync")
+        while True:
+            try:
+                self.share_presence("snapshot", presence.snapshot())
+            except Exception as e:
+                print(f"presence heartbeat failed: {e!r}")
+            self.server.sleep(CLUSTER_HEARTBEAT)
+            now = time.monotonic()
+            for host, seen in list(self._seen.items()):
+                if now - seen > CLUSTER_HEARTBEAT * 3:
+                    print(f"worker {host} is gone")
+                    del self._seen[host]
+                    presence.replace_host(host, [])
+                    lobby.notify()
+
+
+def encode(data: dict):
+    """キューに流すメッセージ(JSON)"""
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def decode(message):
+    """キューから受け取ったメッセージ(JSONのオブジェクト以外は ValueError)"""
+    data = json.loads(message) if isinstance(message, (bytes, str)) else message
+    if not isinstance(data, dict):
+        raise ValueError("message is not an object")
+    return data
+
+
+def read_frame(stream):
+    """ブローカーから1メッセージ読み込む"""
+    header = stream.read(FRAME.size)
+    if len(header) < FRAME.size:
+        raise ConnectionError("message queue closed")
+    (size,) = FRAME.unpack(header)
+    payload = stream.read(size)
+    if len(payload) < size:
+        raise ConnectionError("message queue closed")
+    return payload
+
+
+class UnixSocketPubSub(socketio.PubSubManager):
+    """内蔵ブローカー(Unixドメインソケット)を使う pub/sub マネージャ"""
+
+    name = "unix"
+
+    def __init__(self, url: str, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url.removeprefix("unix://")
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            if self._sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                self._sock = sock
+            return self._sock
+
+    def _reset(self, sock: socket.socket):
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+        sock.close()
+
+    def _publish(self, data):
+        payload = encode(data)
+        sock = self._connect()
+        try:
+            with self._lock:
+                sock.sendall(FRAME.pack(len(payload)) + payload)
+        except OSError as e:
+            self._reset(sock)
+            raise e
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect()
+            except OSError as e:
+                print(f"message queue is unavailable: {e!r}")
+                self.server.sleep(1)
+                continue
+            stream = sock.makefile("rb")
+            try:
+                while True:
+                    try:
+                        yield decode(read_frame(stream))
+                    except ValueError:
+                        print("dropped a malformed message from the message queue")
+            except OSError as e:
+                print(f"message queue disconnected: {e!r}")
+                stream.close()
+                self._reset(sock)
+
+
+class UnixSocketManager(ClusterMixin, UnixSocketPubSub):
+    pass
+
+
+class RedisManager(ClusterMixin, socketio.RedisManager):
+    def _publish(self, data):
+        retry = True
+        while True:
+            try:
+                if not retry:
+                    self._redis_connect()
+                return self.redis.publish(self.channel, encode(data))
+            except redis_manager.redis.exceptions.RedisError as e:
+                if not retry:
+                    print(f"cannot publish to redis: {e!r}")
+                    return
+                retry = False
+
+
+class KombuManager(ClusterMixin, socketio.KombuManager):
+    def _publish(self, data):
+        retry = True
+        while True:
+            try:
+                self._producer_publish(self.publisher_connection)(
+                    data, serializer="json"
+                )
+                return
+            except (OSError, kombu_manager.kombu.exceptions.KombuError) as e:
+                if not retry:
+                    print(f"cannot publish to message queue: {e!r}")
+                    return
+                retry = False
+
+
+def create_manager(url: str):
+    """MESSAGE_QUEUE のURLに応じた pub/sub マネージャ"""
+    if url.startswith("unix://"):
+        return UnixSocketManager(url)
+    if url.startswith(("redis://", "rediss://")):
+        return RedisManager(url)
+    return KombuManager(url)
+
+
+class Broker:
+    """ワーカー間のメッセージを中継する単一ホスト用のブローカー
+
+    各ワーカーの1本の接続から受け取ったメッセージを、送信元以外の全ワーカーへそのまま送る。
+    """
+
+    # 送信が詰まった接続のバッファがこれを超えたら、空くまで送信元の読み込みを止める
+    HIGH_WATER = 1024**2 * 4
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writers = set()
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in self._writers:
+            writer.close()
+        await self._server.wait_closed()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(FRAME.size)
+                frame = header + await reader.readexactly(FRAME.unpack(header)[0])
+                targets = [target for target in self._writers if target is not writer]
+                for target in targets:
+                    target.write(frame)
+                for target in targets:
+                    if target.transport.get_write_buffer_size() > self.HIGH_WATER:
+                        await target.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
@@ -0,0 +1,60 @@
+from libs import concurrency
+from libs.config import COMPRESSION, COMPRESSION_THRESHOLD
+from wsproto.extensions import PerMessageDeflate
+from wsproto.frame_protocol import Opcode
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    """しきい値未満のメッセージを圧縮せずに送る permessage-deflate(wsproto用)"""
+
+    def accept(self, offer):
+        if not COMPRESSION:
+            return None
+        return super().accept(offer)
+
+    def frame_outbound(self, proto, opcode, rsv, data, fin):
+        if (
+            opcode in (Opcode.TEXT, Opcode.BINARY)
+            and fin
+            and len(data) < COMPRESSION_THRESHOLD
+        ):
+            return (rsv, data)
+        return super().frame_outbound(proto, opcode, rsv, data, fin)
+
+
+def install():
+    """WebSocketの圧縮(permessage-deflate)に COMPRESSION の設定を反映する
+
+    threading・gevent の simple-websocket(wsproto)、eventlet の eventlet.websocket は
+    クライアントが要求すると全メッセージを圧縮するため、小さなメッセージは非圧縮で送るように
+    (RFC 7692 ではメッセージごとに圧縮の有無を選べる)それぞれの実装を置き換える。
+    """
+    from simple_websocket import ws
+
+    ws.PerMessageDeflate = ThresholdDeflate
+    if concurrency.async_mode == "eventlet":
+        _install_eventlet()
+
+
+def _install_eventlet():
+    from eventlet import websocket
+
+    class ThresholdWebSocket(websocket.RFC6455WebSocket):
+        """しきい値未満のメッセージを圧縮せずに送るWebSocket(eventlet用)"""
+
+        _compress = True
+
+        def _pack_message(self, message, *args, **kwargs):
+            self._compress = len(message) >= COMPRESSION_THRESHOLD
+            return super()._pack_message(message, *args, **kwargs)
+
+        def _get_permessage_deflate_enc(self):
+            if not self._compress:
+                return None
+            return super()._get_permessage_deflate_enc()
+
+    websocket.RFC6455WebSocket = ThresholdWebSocket
+    if not COMPRESSION:
+        websocket.WebSocketWSGI._negotiate_permessage_deflate = (
+            lambda self, extensions: None
+        )
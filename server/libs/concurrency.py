@@ -0,0 +1,56 @@
+ASYNC_MODES = ["threading", "eventlet", "gevent"]
+# patch() で切り替えるまではスレッド(Werkzeug)で動かす
+async_mode = "threading"
+
+
+def patch(mode: str):
+    """非同期モードを切り替え、eventlet・gevent なら標準ライブラリをモンキーパッチする
+
+    パッチ前に作られたソケットやロックは置き換わらないため、他のモジュールより先に呼ぶ。
+    """
+    global async_mode
+    if mode == "eventlet":
+        import eventlet
+
+        eventlet.monkey_patch()
+    elif mode == "gevent":
+        from gevent import monkey
+
+        monkey.patch_all()
+    elif mode != "threading":
+        raise ValueError(f"unknown async mode: {mode}")
+    async_mode = mode
+
+    if is_green():
+        from libs.config import OFFLOAD_WORKERS
+
+        if mode == "eventlet":
+            from eventlet import tpool
+
+            tpool.set_num_threads(OFFLOAD_WORKERS)
+        else:
+            import gevent
+
+            gevent.get_hub().threadpool.maxsize = OFFLOAD_WORKERS
+
+
+def is_green():
+    """グリーンスレッド(eventlet・gevent)で動いているか"""
+    return async_mode != "threading"
+
+
+def offload(func, *args, **kwargs):
+    """func をネイティブスレッドで実行して結果を待つ
+
+    グリーンスレッドではブロックする処理がイベントループ全体を止めるため、
+    スレッドプールに逃がしてその間は他の接続を処理する。threading ではそのまま呼ぶ。
+    """
+    if async_mode == "eventlet":
+        from eventlet import tpool
+
+        return tpool.execute(func, *args, **kwargs)
+    if async_mode == "gevent":
+        import gevent
+
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
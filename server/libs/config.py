@@ -11,14 +11,71 @@ class AppConfig:
 
     SECRET_KEY = os.getenv("SECRET_KEY", os.urandom(24))
     JSON_AS_ASCII = False
+    # ファイル送信をリバースプロキシに任せる(X-Sendfile ヘッダのみ返す)
+    USE_X_SENDFILE = literal_eval(os.getenv("USE_X_SENDFILE", "False").capitalize())
 
 
 SYSTEM_USER = "system"
 SYSTEM_LOBBY = "sys_lobby"
+# ワーカー数の上限(メッセージIDの下位ビットにワーカー番号を入れる)
+MAX_WORKERS = 32
+
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", 16))
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 10000))
+# 複数プロセスで動かすときの設定(launcher.py が各ワーカーに設定する)
+MESSAGE_QUEUE = os.getenv("MESSAGE_QUEUE", "")
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+CLUSTER_HEARTBEAT = float(os.getenv("CLUSTER_HEARTBEAT", 5))
 
 DATABASE = os.getenv("DATABASE", "storage.db")
-MAX_BUFFER_SIZE = os.getenv("MAX_BUFFER_SIZE", 1024**2 * 10)
-JOIN_MESSAGES = os.getenv("JOIN_MESSAGES", 10)
-MAX_FILES = os.getenv("MAX_FILES", 20)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 16))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))
+WAL_MODE = literal_eval(os.getenv("WAL_MODE", "False").capitalize())
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", -16000))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 1024**2 * 64))
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", 5000))
+WRITE_BATCH_LATENCY = float(os.getenv("WRITE_BATCH_LATENCY", 5))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 128))
+MAX_BUFFER_SIZE = int(os.getenv("MAX_BUFFER_SIZE", 1024**2 * 10))
+COMPRESSION = literal_eval(os.getenv("COMPRESSION", "True").capitalize())
+COMPRESSION_THRESHOLD = int(os.getenv("COMPRESSION_THRESHOLD", 256))
+LOBBY_BROADCAST_INTERVAL = float(os.getenv("LOBBY_BROADCAST_INTERVAL", 250))
+MESSAGE_BATCH_INTERVAL = float(os.getenv("MESSAGE_BATCH_INTERVAL", 0))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", 100))
+JOIN_MESSAGES = int(os.getenv("JOIN_MESSAGES", 10))
+HISTORY_PAGE_LIMIT = int(os.getenv("HISTORY_PAGE_LIMIT", 100))
+SEARCH_RANK_LIMIT = int(os.getenv("SEARCH_RANK_LIMIT", 1000))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 256))
+UPLOAD_WINDOW = int(os.getenv("UPLOAD_WINDOW", 4))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 1024**3))
+UPLOAD_MAX_PENDING = int(os.getenv("UPLOAD_MAX_PENDING", 4))
+UPLOAD_IDLE_TIMEOUT = float(os.getenv("UPLOAD_IDLE_TIMEOUT", 300))
+FILE_CACHE_SIZE = int(os.getenv("FILE_CACHE_SIZE", 1024))
+MAX_FILES = int(os.getenv("MAX_FILES", 20))
+FILE_SWEEP_THRESHOLD = int(os.getenv("FILE_SWEEP_THRESHOLD", 5))
+RATE_LIMIT = literal_eval(os.getenv("RATE_LIMIT", "True").capitalize())
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 3))
+RATE_TEXT_MESSAGES = float(os.getenv("RATE_TEXT_MESSAGES", 5))
+RATE_TEXT_BYTES = float(os.getenv("RATE_TEXT_BYTES", 1024 * 64))
+RATE_MEDIA_MESSAGES = float(os.getenv("RATE_MEDIA_MESSAGES", 1))
+RATE_MEDIA_BYTES = float(os.getenv("RATE_MEDIA_BYTES", 1024**2 * 2))
+ROOM_RATE_TEXT_MESSAGES = float(os.getenv("ROOM_RATE_TEXT_MESSAGES", 100))
+ROOM_RATE_TEXT_BYTES = float(os.getenv("ROOM_RATE_TEXT_BYTES", 1024**2))
+ROOM_RATE_MEDIA_MESSAGES = float(os.getenv("ROOM_RATE_MEDIA_MESSAGES", 10))
+ROOM_RATE_MEDIA_BYTES = float(os.getenv("ROOM_RATE_MEDIA_BYTES", 1024**2 * 20))
+METRICS = literal_eval(os.getenv("METRICS", "True").capitalize())
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_FOLDER = os.getenv("PROFILE_FOLDER", "profiles")
 LOG_SYSTEM = literal_eval(os.getenv("LOG_SYSTEM", "False").capitalize())
 FILE_FOLDER = os.getenv("FILE_FOLDER", "files")
+IMAGE_FOLDER = os.getenv("IMAGE_FOLDER", "images")
+THUMBNAIL_SIZES = [
+    int(size) for size in os.getenv("THUMBNAIL_SIZES", "80,320").split(",")
+]
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "WEBP").upper()
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+THUMBNAIL_FAILED_CACHE = int(os.getenv("THUMBNAIL_FAILED_CACHE", 1024))
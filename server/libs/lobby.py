@@ -0,0 +1,69 @@
+import threading
+
+from flask_socketio import SocketIO
+from libs.config import LOBBY_BROADCAST_INTERVAL, SYSTEM_LOBBY
+from libs.presence import presence
+
+
+class LobbyBroadcaster:
+    """ロビーへの部屋一覧の差分送信をまとめる
+
+    参加・退出のたびに送信せず、変更を通知されたバックグラウンドタスクが
+    interval 秒に1回までまとめて送信する(0以下なら通知ごとに即時送信)。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.socketio = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._task = None
+        self.requested = 0
+        self.sent = 0
+
+    def init_app(self, socketio: SocketIO):
+        self.socketio = socketio
+
+    def notify(self):
+        """部屋一覧の変更を通知"""
+        with self._lock:
+            self.requested += 1
+            if self.interval > 0 and self._task is None:
+                self._task = self.socketio.start_background_task(self._run)
+        if self.interval > 0:
+            self._wakeup.set()
+        else:
+            self.flush()
+
+    def flush(self):
+        """溜まった差分を送信"""
+        delta = presence.pop_delta()
+        if delta is None:
+            return
+        # 各ワーカーが全体の一覧を持つので、自分に接続中のクライアントにだけ送る
+        self.socketio.emit("rooms_delta", delta, to=SYSTEM_LOBBY, ignore_queue=True)
+        with self._lock:
+            self.sent += 1
+
+    def stats(self):
+        """送信要求数・実際の送信数・まとめて省略した数"""
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "requested": self.requested,
+                "sent": self.sent,
+                "suppressed": self.requested - self.sent,
+            }
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"lobby broadcast failed: {e!r}")
+            self.socketio.sleep(self.interval)
+
+
+lobby = LobbyBroadcaster(LOBBY_BROADCAST_INTERVAL / 1000)
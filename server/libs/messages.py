@@ -0,0 +1,60 @@
+from datetime import datetime
+
+from libs.batch import batcher
+from libs.config import HISTORY_PAGE_LIMIT, JOIN_MESSAGES
+from libs.presence import Presence
+from libs.storage import (
+    delete_file,
+    get_file_link,
+    insert_file,
+    next_timeline_id,
+    save_file,
+    write,
+)
+
+
+def timestamp(data=None):
+    if data:
+        data = dict(data)
+        return data.get("timestamp", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def history_limit(limit=None):
+    """過去ログ1ページの件数"""
+    if limit is None:
+        return JOIN_MESSAGES
+    return max(1, min(int(limit), HISTORY_PAGE_LIMIT))
+
+
+def publish_file(client: Presence, path: str, filename: str, data=None):
+    """受信済みの一時ファイルを登録して部屋に送信し、送信したメッセージを返す
+
+    保存先はファイルIDで決まるので登録してから移動し、移動できなければ登録を取り消す。
+    残った一時ファイルは呼び出し元で消す。
+    """
+    message_id = next_timeline_id()
+    file_id = write(
+        insert_file, client.room_id, client.user_id, filename, message_id
+    ).result()
+    try:
+        save_file(path, filename, file_id)
+    except OSError as e:
+        write(delete_file, file_id).result()
+        raise e
+    message = {
+        "id": message_id,
+        "user": client.name,
+        "filename": filename,
+        "link": get_file_link(file_id, filename),
+        "timestamp": timestamp(data),
+    }
+    # HTTPのリクエストからも送信できるようにSocketIO本体から送る
+    batcher.send(message, str(client.room_id))
+    return message
+
+
+def upload_failed(e: Exception):
+    """ファイルを保存できなかったときのエラー"""
+    print(f"failed to save file: {e!r}")
+    return {"code": "UPLOAD_FAILED", "message": "failed to save the file."}
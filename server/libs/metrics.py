@@ -0,0 +1,347 @@
+import bisect
+import re
+import threading
+import time
+from functools import lru_cache
+
+from flask import Flask, Response, g, request
+from flask_socketio import SocketIO
+from libs.batch import batcher
+from libs.config import METRICS
+from libs.lobby import lobby
+from libs.presence import presence
+from libs.ratelimit import limiter
+
+# 処理時間のヒストグラムの区切り(秒)
+LATENCY_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+# 1回の送信の送信先数
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# アップロードのサイズ(バイト、1KiB〜1GiB)
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(11))
+
+
+def escape(value: str):
+    """ラベルの値のエスケープ"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@lru_cache(maxsize=1024)
+def statement_kind(sql: str):
+    """SQLの種類(先頭の語)"""
+    return re.match(r"\s*(\w*)", sql).group(1).upper()
+
+
+def format_labels(names: tuple, values: tuple, extra: str = ""):
+    labels = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """ラベルごとの累積値"""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """ラベルごとの区切り別の件数・合計"""
+
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        # ラベル -> [区切りごとの件数..., 区切りを超えた件数, 合計]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                le = format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {total}")
+            label = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label} {counts[-1]}")
+            lines.append(f"{self.name}_count{label} {total}")
+        return lines
+
+
+def gauge(name: str, help: str, values: list, labels: tuple = (), type="gauge"):
+    """取得時に値を読む計測値"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for label, value in values:
+        lines.append(f"{name}{format_labels(labels, label)} {value}")
+    return lines
+
+
+class Metrics:
+    """Prometheus形式で公開する計測値
+
+    ソケットのイベント・HTTPのリクエストの処理時間、SQLの実行時間、送信先の数とバイト数、
+    アップロードのサイズを記録する。記録は区切りの二分探索と加算だけで、
+    文字列への整形は /metrics の取得時にまとめて行う。
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.events = Histogram(
+            "simple_chat_socket_event_seconds",
+            "Socket.IO event handler latency.",
+            LATENCY_BUCKETS,
+            ("event",),
+        )
+        self.event_errors = Counter(
+            "simple_chat_socket_event_errors_total",
+            "Socket.IO event handlers that raised an exception.",
+            ("event",),
+        )
+        self.requests = Histogram(
+            "simple_chat_http_request_seconds",
+            "HTTP request latency until the response is created.",
+            LATENCY_BUCKETS,
+            ("route", "method", "status"),
+        )
+        self.sql = Histogram(
+            "simple_chat_sql_seconds",
+            "SQLite statement execution time.",
+            LATENCY_BUCKETS,
+            ("statement",),
+        )
+        self.fanout = Histogram(
+            "simple_chat_emit_recipients",
+            "Recipients per Socket.IO emit.",
+            FANOUT_BUCKETS,
+        )
+        self.sent_packets = Counter(
+            "simple_chat_sent_packets_total", "Engine.IO packets sent to clients."
+        )
+        self.sent_bytes = Counter(
+            "simple_chat_sent_bytes_total",
+            "Engine.IO packet payload bytes sent to clients (before compression).",
+        )
+        self.uploads = Histogram(
+            "simple_chat_upload_bytes",
+            "Size of uploaded images and files.",
+            SIZE_BUCKETS,
+            ("kind",),
+        )
+
+    def init_app(self, app: Flask, socketio: SocketIO):
+        """登録済みのイベント処理・HTTPのリクエスト・送信を計測するように差し替える"""
+        if not self.enabled:
+            return
+        handlers = socketio.server.handlers.get("/", {})
+        for event, handler in handlers.items():
+            handlers[event] = self._timed_handler(event, handler)
+
+        # 部屋への送信は送信先を列挙しながら1件ずつ送るので、列挙した数を送信先数とする
+        manager = socketio.server.manager
+        manager.get_participants = self._counted_participants(manager.get_participants)
+        eio = socketio.server.eio
+        eio.send_packet = self._counted_send(eio.send_packet)
+
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+
+    def observe_sql(self, sql: str, elapsed: float):
+        """SQLの実行時間(文の種類ごと)"""
+        if self.enabled:
+            self.sql.observe(elapsed, (statement_kind(sql),))
+
+    def observe_upload(self, kind: str, size: int):
+        """アップロードのサイズ"""
+        if self.enabled:
+            self.uploads.observe(size, (kind,))
+
+    def render(self):
+        """Prometheusのテキスト形式"""
+        lines = []
+        for metric in (
+            self.events,
+            self.event_errors,
+            self.requests,
+            self.sql,
+            self.fanout,
+            self.sent_packets,
+            self.sent_bytes,
+            self.uploads,
+        ):
+            lines += metric.render()
+
+        rooms = presence.rooms()["rooms"]
+        lines += gauge(
+            "simple_chat_room_sockets",
+            "Sockets joined to each room (all workers).",
+            [((room["name"],), room["count"]) for room in rooms],
+            ("room",),
+        )
+        lines += gauge(
+            "simple_chat_connected_sockets",
+            "Connected sockets (all workers).",
+            [((), presence.size())],
+        )
+
+        lobby_stats = lobby.stats()
+        lines += gauge(
+            "simple_chat_lobby_updates_total",
+            "Room list changes notified to the lobby broadcaster.",
+            [((), lobby_stats["requested"])],
+            type="counter",
+        )
+        lines += gauge(
+            "simple_chat_lobby_broadcasts_total",
+            "Room list deltas sent to the lobby.",
+            [((), lobby_stats["sent"])],
+            type="counter",
+        )
+        batch_stats = batcher.stats()
+        lines += gauge(
+            "simple_chat_batched_messages_total",
+            "Messages sent through the room message batcher.",
+            [((), batch_stats["messages"])],
+            type="counter",
+        )
+        lines += gauge(
+            "simple_chat_message_batches_total",
+            "Batched messages events sent to rooms.",
+            [((), batch_stats["batches"])],
+            type="counter",
+        )
+        lines += gauge(
+            "simple_chat_message_batch_delay_seconds_max",
+            "Longest time a message waited in the batcher.",
+            [((), batch_stats["max_delay"] / 1000)],
+        )
+        limit_stats = limiter.stats()
+        lines += gauge(
+            "simple_chat_rate_limit_allowed_total",
+            "Messages accepted by the rate limiter.",
+            [((kind,), count) for kind, count in limit_stats["allowed"].items()],
+            ("kind",),
+            type="counter",
+        )
+        lines += gauge(
+            "simple_chat_rate_limited_total",
+            "Messages rejected with RATE_LIMITED.",
+            [
+                ((scope, kind), count)
+                for scope, counts in limit_stats["limited"].items()
+                for kind, count in counts.items()
+            ],
+            ("scope", "kind"),
+            type="counter",
+        )
+        lines += gauge(
+            "simple_chat_rate_limit_buckets",
+            "Sockets and rooms holding rate limit buckets.",
+            [(("socket",), limit_stats["sockets"]), (("room",), limit_stats["rooms"])],
+            ("scope",),
+        )
+        return "\n".join(lines) + "\n"
+
+    def _timed_handler(self, event: str, handler):
+        def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return handler(*args)
+            except Exception as e:
+                self.event_errors.inc((event,))
+                raise e
+            finally:
+                self.events.observe(time.perf_counter() - start, (event,))
+
+        return wrapper
+
+    def _counted_participants(self, get_participants):
+        def wrapper(*args, **kwargs):
+            count = 0
+            try:
+                for participant in get_participants(*args, **kwargs):
+                    count += 1
+                    yield participant
+            finally:
+                self.fanout.observe(count)
+
+        return wrapper
+
+    def _counted_send(self, send_packet):
+        def wrapper(sid, pkt):
+            # 部屋への送信では同じパケットを全員に送るので、サイズは1回だけ数える
+            size = getattr(pkt, "_metrics_size", None)
+            if size is None:
+                data = pkt.data
+                if isinstance(data, str):
+                    size = len(data.encode())
+                elif isinstance(data, bytes):
+                    size = len(data)
+                else:
+                    size = 0
+                pkt._metrics_size = size
+            self.sent_packets.inc()
+            self.sent_bytes.inc(value=size)
+            return send_packet(sid, pkt)
+
+        return wrapper
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+
+    def _end_request(self, response: Response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            rule = request.url_rule.rule if request.url_rule else "(unmatched)"
+            self.requests.observe(
+                time.perf_counter() - start,
+                (rule, request.method, response.status_code),
+            )
+        return response
+
+
+metrics = Metrics(METRICS)
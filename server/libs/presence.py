@@ -0,0 +1,206 @@
+import threading
+
+
+class Presence:
+    """接続中のユーザ"""
+
+    def __init__(self, user_id: int, name: str, host: str | None = None):
+        self.user_id = user_id
+        self.name = name
+        self.room_id = None
+        # 他のワーカーに接続しているユーザならそのワーカーのID
+        self.host = host
+
+
+class PresenceRegistry:
+    """接続中のユーザと参加中の部屋の対応表(スレッドセーフ)
+
+    sid → ユーザ・部屋、部屋 → 参加者のsid をメモリ上に保持する。
+    イベント処理ではこちらを参照し、DBへは永続化のためにのみ書き込む。
+    部屋の人数の変化は版番号付きの差分として取り出せる。
+
+    複数ワーカーで動かす場合は、このワーカーでの変更を share に渡して共有し、
+    他のワーカーでの変更を replicate() で反映して全体の一覧を保つ。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users: dict[str, Presence] = {}
+        self._rooms: dict[int, set[str]] = {}
+        self._room_names: dict[int, str] = {}
+        self._changes: dict[str, int] = {}
+        self._version = 0
+        self.share = None
+
+    def connect(self, sid: str, user_id: int, name: str):
+        """接続を登録"""
+        with self._lock:
+            self._users[sid] = Presence(user_id, name)
+        self._share("connect", sid, user_id, name)
+
+    def disconnect(self, sid: str):
+        """接続を削除し (ユーザ, 参加していた部屋のID, 部屋の残り人数) を返す"""
+        with self._lock:
+            user = self._users.pop(sid, None)
+            if user is None:
+                return None, None, 0
+            remaining = self._discard(sid, user.room_id)
+        self._share("disconnect", sid)
+        return user, user.room_id, remaining
+
+    def join(self, sid: str, room_id: int, room_name: str):
+        """部屋に参加し、参加後の人数を返す"""
+        with self._lock:
+            count = self._join(sid, room_id, room_name)
+        self._share("join", sid, room_id, room_name)
+        return count
+
+    def leave(self, sid: str):
+        """部屋から退出し (退出した部屋のID, 部屋の残り人数) を返す"""
+        with self._lock:
+            user = self._users.get(sid)
+            if user is None or user.room_id is None:
+                return None, 0
+            room_id = user.room_id
+            user.room_id = None
+            remaining = self._discard(sid, room_id)
+        self._share("leave", sid)
+        return room_id, remaining
+
+    def replicate(self, host: str, op: str, *args):
+        """他のワーカーでの接続・参加・退出・切断を反映"""
+        with self._lock:
+            if op == "connect":
+                sid, user_id, name = args
+                self._remove(sid)
+                self._users[sid] = Presence(user_id, name, host)
+                return
+            sid = args[0]
+            if op == "join" and sid in self._users:
+                _, room_id, room_name = args
+                self._join(sid, room_id, room_name)
+            elif op == "leave" and sid in self._users:
+                user = self._users[sid]
+                self._discard(sid, user.room_id)
+                user.room_id = None
+            elif op == "disconnect":
+                self._remove(sid)
+
+    def snapshot(self):
+        """このワーカーに接続中のユーザの一覧 [(sid, ユーザID, 名前, 部屋のID, 部屋名)]"""
+        with self._lock:
+            return [
+                (
+                    sid,
+                    user.user_id,
+                    user.name,
+                    user.room_id,
+                    self._room_names.get(user.room_id),
+                )
+                for sid, user in self._users.items()
+                if user.host is None
+            ]
+
+    def replace_host(self, host: str, entries: list):
+        """他のワーカーの接続中のユーザを snapshot() の一覧に置き換える
+
+        差分の取りこぼしや起動前の接続もこれで揃う。空の一覧で停止したワーカーの分を消す。
+        """
+        with self._lock:
+            current = {sid for sid, user in self._users.items() if user.host == host}
+            for sid in current - {entry[0] for entry in entries}:
+                self._remove(sid)
+            for sid, user_id, name, room_id, room_name in entries:
+                user = self._users.get(sid)
+                if user is None or user.host != host:
+                    self._remove(sid)
+                    user = self._users[sid] = Presence(user_id, name, host)
+                if user.room_id == room_id:
+                    continue
+                if room_id is None:
+                    self._discard(sid, user.room_id)
+                    user.room_id = None
+                else:
+                    self._join(sid, room_id, room_name)
+
+    def get(self, sid: str) -> Presence | None:
+        """接続中のユーザを取得"""
+        return self._users.get(sid)
+
+    def members(self, room_id: int) -> set[str]:
+        """部屋の参加者のsid"""
+        with self._lock:
+            return set(self._rooms.get(room_id, ()))
+
+    def count(self, room_id: int) -> int:
+        """部屋の参加人数"""
+        return len(self._rooms.get(room_id, ()))
+
+    def size(self) -> int:
+        """接続中のユーザ数"""
+        return len(self._users)
+
+    def rooms(self):
+        """参加者のいる部屋の一覧(全件)"""
+        with self._lock:
+            rooms = [
+                {"name": self._room_names[room_id], "count": len(members)}
+                for room_id, members in self._rooms.items()
+            ]
+            return {
+                "version": self._version,
+                "full": True,
+                "rooms": sorted(rooms, key=lambda room: room["count"], reverse=True),
+            }
+
+    def pop_delta(self):
+        """前回からの部屋の人数の変化を取り出す(変化がなければNone)
+
+        count が 0 の部屋は一覧から削除されたことを表す。
+        """
+        with self._lock:
+            if not self._changes:
+                return None
+            self._version += 1
+            rooms = [
+                {"name": name, "count": count} for name, count in self._changes.items()
+            ]
+            self._changes.clear()
+            return {"version": self._version, "full": False, "rooms": rooms}
+
+    def _share(self, op: str, *args):
+        if self.share is not None:
+            self.share(op, *args)
+
+    def _join(self, sid: str, room_id: int, room_name: str):
+        """部屋に参加させ、参加後の人数を返す(ロック取得済みで呼ぶ)"""
+        user = self._users[sid]
+        self._discard(sid, user.room_id)
+        user.room_id = room_id
+        members = self._rooms.setdefault(room_id, set())
+        members.add(sid)
+        self._room_names[room_id] = room_name
+        self._changes[room_name] = len(members)
+        return len(members)
+
+    def _remove(self, sid: str):
+        """接続を削除(ロック取得済みで呼ぶ)"""
+        user = self._users.pop(sid, None)
+        if user is not None:
+            self._discard(sid, user.room_id)
+
+    def _discard(self, sid: str, room_id: int | None):
+        """部屋の参加者から外し、残り人数を返す(ロック取得済みで呼ぶ)"""
+        members = self._rooms.get(room_id)
+        if members is None:
+            return 0
+        members.discard(sid)
+        room_name = self._room_names[room_id]
+        self._changes[room_name] = len(members)
+        if not members:
+            del self._rooms[room_id]
+            del self._room_names[room_id]
+        return len(members)
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,151 @@
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from flask_socketio import SocketIO
+from libs.config import ADMIN_TOKEN, PROFILE_FOLDER, PROFILE_SAMPLE_RATE
+
+
+def is_admin(token) -> bool:
+    """管理用のトークンか(ADMIN_TOKEN が空なら管理機能は無効)"""
+    if not ADMIN_TOKEN or not isinstance(token, str):
+        return False
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+class HandlerProfiler:
+    """イベント処理の一部を cProfile で計測し、イベントごとに集計する
+
+    rate の割合の呼び出しだけを計測するので、負荷の高い本番でも有効にしておける
+    (0なら計測せず、差し替えた処理の追加コストは判定1回のみ)。
+    rate は実行中に set_rate で変更でき、再起動は要らない。
+
+    cProfile はスレッド単位で動くため、同時に計測するのは1件のみ。
+    eventlet・gevent では計測中に切り替わった他のグリーンスレッドの処理も含まれ、
+    ネイティブスレッドに逃がしたSQLや書き込みスレッドの処理は待ち時間として現れる。
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._active = False
+        # イベント -> 集計した pstats.Stats
+        self._stats = {}
+        self.samples = {}
+        self.started = time.time()
+
+    def init_app(self, socketio: SocketIO):
+        """登録済みのイベント処理を計測できるように差し替える"""
+        handlers = socketio.server.handlers.get("/", {})
+        for event, handler in handlers.items():
+            handlers[event] = self._sampled_handler(event, handler)
+
+    def set_rate(self, rate: float):
+        """計測する呼び出しの割合(0〜1)を変更"""
+        self.rate = max(0.0, min(float(rate), 1.0))
+
+    def reset(self):
+        """集計を破棄"""
+        with self._lock:
+            self._stats.clear()
+            self.samples.clear()
+            self.started = time.time()
+
+    def control(self, options: dict):
+        """管理用の操作を反映して状態を返す
+
+        options: {"rate": 計測する割合, "reset": 集計を破棄, "dump": ファイルに書き出す}
+        """
+        if options.get("reset"):
+            self.reset()
+        if options.get("rate") is not None:
+            try:
+                self.set_rate(options["rate"])
+            except (TypeError, ValueError):
+                raise ValueError("rate must be a number.")
+        status = self.status()
+        if options.get("dump"):
+            status["files"] = self.dump()
+        return status
+
+    def status(self):
+        """計測の割合・イベントごとの計測回数"""
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "started": self.started,
+                "samples": dict(self.samples),
+            }
+
+    def report(self, event=None, sort="cumulative", limit=30, view="stats"):
+        """集計結果をテキストで返す
+
+        view は stats(関数ごと)・callers(呼び出し元)・callees(呼び出し先)。
+        """
+        if view not in ("stats", "callers", "callees"):
+            raise ValueError(f"unknown view: {view}")
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise ValueError(f"unknown sort key: {sort}")
+        stream = io.StringIO()
+        with self._lock:
+            for name, stats in sorted(self._stats.items()):
+                if event is not None and name != event:
+                    continue
+                stream.write(f"=== {name} ({self.samples[name]} samples)\n")
+                stats.stream = stream
+                stats.sort_stats(sort)
+                getattr(stats, f"print_{view}")(limit)
+        return stream.getvalue()
+
+    def dump(self, folder: str = PROFILE_FOLDER):
+        """イベントごとに pstats 形式のファイルへ書き出し、パスのリストを返す
+
+        snakeviz などで開ける(python -m pstats <ファイル> でも読める)。
+        """
+        os.makedirs(folder, exist_ok=True)
+        suffix = time.strftime("%Y%m%d-%H%M%S")
+        paths = []
+        with self._lock:
+            for name, stats in self._stats.items():
+                path = os.path.join(
+                    folder, f"{re.sub(r'[^A-Za-z0-9_-]', '_', name)}-{suffix}.prof"
+                )
+                stats.dump_stats(path)
+                paths.append(path)
+        return paths
+
+    def _sampled_handler(self, event: str, handler):
+        def wrapper(*args):
+            if self.rate <= 0 or random.random() >= self.rate or self._active:
+                return handler(*args)
+            with self._lock:
+                busy = self._active
+                self._active = True
+            if busy:
+                return handler(*args)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(handler, *args)
+            finally:
+                self._active = False
+                self._add(event, profile)
+
+        return wrapper
+
+    def _add(self, event: str, profile: cProfile.Profile):
+        with self._lock:
+            stats = self._stats.get(event)
+            if stats is None:
+                self._stats[event] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.samples[event] = self.samples.get(event, 0) + 1
+
+
+profiler = HandlerProfiler(PROFILE_SAMPLE_RATE)
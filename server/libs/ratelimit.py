@@ -0,0 +1,154 @@
+import threading
+import time
+
+from libs.config import (
+    RATE_LIMIT,
+    RATE_LIMIT_BURST,
+    RATE_MEDIA_BYTES,
+    RATE_MEDIA_MESSAGES,
+    RATE_TEXT_BYTES,
+    RATE_TEXT_MESSAGES,
+    ROOM_RATE_MEDIA_BYTES,
+    ROOM_RATE_MEDIA_MESSAGES,
+    ROOM_RATE_TEXT_BYTES,
+    ROOM_RATE_TEXT_MESSAGES,
+)
+
+SCOPES = ("socket", "room")
+KINDS = ("text", "media")
+
+
+class RateLimited(Exception):
+    """送信の上限を超えた"""
+
+    def __init__(self, scope: str, kind: str, retry_after: float):
+        super().__init__(
+            f"too many {kind} messages from this {scope}. "
+            f"retry after {retry_after:.1f} seconds."
+        )
+        self.scope = scope
+        self.kind = kind
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        """error イベントの内容"""
+        return {
+            "code": "RATE_LIMITED",
+            "message": str(self),
+            "scope": self.scope,
+            "kind": self.kind,
+            "retry_after": round(self.retry_after, 3),
+        }
+
+
+class TokenBucket:
+    """毎秒 rate 個補充され、最大 burst 個まで溜まるトークン"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait(self, amount: float, now: float):
+        """amount 個取り出せるまでの秒数(0なら今すぐ取り出せる)
+
+        burst を超える量は満杯なら取り出せる(不足分は後の補充で返す)。
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (min(amount, self.burst) - self.tokens) / self.rate)
+
+    def take(self, amount: float):
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """接続ごと・部屋ごとの送信数/秒とバイト数/秒の上限(トークンバケット)
+
+    テキストと画像・ファイル(media)は別々に数える。limits は
+    {(scope, kind): (メッセージ数/秒, バイト数/秒)} で、0の項目は制限しない。
+    burst 秒分までは続けて送れる。
+
+    部屋の上限はワーカーごとに数えるので、複数ワーカーでは部屋全体で最大ワーカー数倍になる。
+    """
+
+    def __init__(self, enabled: bool, limits: dict, burst: float):
+        self.enabled = enabled
+        self.limits = limits
+        self.burst = burst
+        self._lock = threading.Lock()
+        # scope -> キー(sid・部屋ID) -> kind -> [(バケット, 単位)]
+        self._buckets = {scope: {} for scope in SCOPES}
+        self.allowed = {kind: 0 for kind in KINDS}
+        self.limited = {(scope, kind): 0 for scope in SCOPES for kind in KINDS}
+
+    def acquire(self, sid: str, room_id: int, costs: dict):
+        """送信分のトークンを取り出す(足りなければ何も取り出さず RateLimited)
+
+        costs: {kind: (メッセージ数, バイト数)}
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for scope, key in (("socket", sid), ("room", room_id)):
+                limits = self._buckets[scope].get(key)
+                if limits is None:
+                    limits = self._buckets[scope][key] = {}
+                for kind, (count, size) in costs.items():
+                    for bucket, unit in self._get(limits, scope, kind, now):
+                        amount = count if unit == "messages" else size
+                        wait = bucket.wait(amount, now)
+                        if wait > 0:
+                            self.limited[(scope, kind)] += 1
+                            raise RateLimited(scope, kind, wait)
+                        buckets.append((bucket, amount))
+            for bucket, amount in buckets:
+                bucket.take(amount)
+            for kind, (count, _) in costs.items():
+                self.allowed[kind] += count
+
+    def discard(self, scope: str, key):
+        """切断した接続・空になった部屋のバケットを破棄"""
+        with self._lock:
+            self._buckets[scope].pop(key, None)
+
+    def stats(self):
+        """送信を許可した数・上限で断った数・バケットを持つ接続と部屋の数"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "allowed": dict(self.allowed),
+                "limited": {
+                    scope: {kind: self.limited[(scope, kind)] for kind in KINDS}
+                    for scope in SCOPES
+                },
+                "sockets": len(self._buckets["socket"]),
+                "rooms": len(self._buckets["room"]),
+            }
+
+    def _get(self, limits: dict, scope: str, kind: str, now: float):
+        buckets = limits.get(kind)
+        if buckets is None:
+            buckets = limits[kind] = [
+                (TokenBucket(rate, rate * self.burst, now), unit)
+                for rate, unit in zip(self.limits[(scope, kind)], ("messages", "bytes"))
+                if rate > 0
+            ]
+        return buckets
+
+
+limiter = RateLimiter(
+    RATE_LIMIT,
+    {
+        ("socket", "text"): (RATE_TEXT_MESSAGES, RATE_TEXT_BYTES),
+        ("socket", "media"): (RATE_MEDIA_MESSAGES, RATE_MEDIA_BYTES),
+        ("room", "text"): (ROOM_RATE_TEXT_MESSAGES, ROOM_RATE_TEXT_BYTES),
+        ("room", "media"): (ROOM_RATE_MEDIA_MESSAGES, ROOM_RATE_MEDIA_BYTES),
+    },
+    RATE_LIMIT_BURST,
+)
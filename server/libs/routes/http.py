@@ -1,30 +1,309 @@
+import os
 import sqlite3
 
-from flask import Blueprint, abort, jsonify, render_template, send_file
-from libs.storage import transact
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    jsonify,
+    render_template,
+    request,
+    send_file,
+)
+from libs.batch import batcher
+from libs.config import MAX_UPLOAD_SIZE, THUMBNAIL_SIZES
+from libs.lobby import lobby
+from libs.messages import history_limit, publish_file, upload_failed
+from libs.metrics import metrics
+from libs.presence import presence
+from libs.profiler import is_admin, profiler
+from libs.ratelimit import RateLimited, limiter
+from libs.storage import (
+    find_file_path,
+    get_history,
+    get_image_mimetype,
+    get_image_path,
+    get_thumbnail_path,
+    is_image_digest,
+    open_upload_file,
+    parse_thumbnail_name,
+    search_messages,
+    transact,
+)
+from libs.thumbnail import thumbnails
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
 
 http_module = Blueprint("http_routes", __name__)
 
+# multipart のファイル以外の値はメモリに読むので、合計のバイト数と項目数を制限する
+MAX_FORM_MEMORY_SIZE = 1024 * 64
+MAX_FORM_PARTS = 16
+
+
+def cache_forever(response: Response):
+    """内容の変わらないURLの応答を長期キャッシュさせる"""
+    response.cache_control.no_cache = None
+    response.cache_control.max_age = 31536000
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def joined_client():
+    """X-Socket-Id ヘッダの接続(部屋に参加していなければ None)"""
+    client = presence.get(request.headers.get("X-Socket-Id", ""))
+    if client is None or client.room_id is None:
+        return None
+    return client
+
+
+def not_in_room(action: str):
+    return (
+        jsonify({"code": "NOT_IN_ROOM", "message": f"join a room before {action}."}),
+        403,
+    )
+
 
 @http_module.route("/")
 def main():
     return jsonify({"status": "http online"})
 
 
+@http_module.get("/stats")
+def get_stats():
+    """ロビー送信・メッセージ送信のまとめ状況と送信の上限で断った数"""
+    return jsonify(
+        {
+            "lobby": lobby.stats(),
+            "messages": batcher.stats(),
+            "rate_limit": limiter.stats(),
+        }
+    )
+
+
+@http_module.get("/metrics")
+def get_metrics():
+    """処理時間・送信量などの計測値(Prometheus形式)"""
+    if not metrics.enabled:
+        abort(404)
+    return Response(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@http_module.get("/admin/profile")
+def get_profile():
+    """イベントごとのプロファイル(管理用、X-Admin-Token ヘッダが必要)
+
+    event でイベントを絞り込み、sort・limit・view(stats, callers, callees)で表示を指定する。
+    """
+    if not is_admin(request.headers.get("X-Admin-Token")):
+        abort(403)
+    try:
+        report = profiler.report(
+            request.args.get("event"),
+            request.args.get("sort", "cumulative"),
+            request.args.get("limit", 30, type=int),
+            request.args.get("view", "stats"),
+        )
+    except ValueError as e:
+        return jsonify({"code": "INVALID_OPTION", "message": str(e)}), 400
+    return Response(report, content_type="text/plain; charset=utf-8")
+
+
+@http_module.post("/admin/profile")
+def control_profile():
+    """計測の割合の変更・集計の破棄・ファイルへの書き出し(管理用)
+
+    本文は {"rate": 0.01, "reset": true, "dump": true} の形式(いずれも省略可)。
+    """
+    if not is_admin(request.headers.get("X-Admin-Token")):
+        abort(403)
+    try:
+        return jsonify(profiler.control(request.get_json(silent=True) or {}))
+    except ValueError as e:
+        return jsonify({"code": "INVALID_OPTION", "message": str(e)}), 400
+
+
 @http_module.route("/test")
 def test_client():
     return render_template("index.html")
 
 
 @http_module.get("/files/<int:id>/<filename>")
-@transact
-def get_file(conn: sqlite3.Connection, id: int, filename: str):
-    """ファイルダウンロード"""
-    file = conn.execute(
-        "SELECT * FROM files WHERE id = ? AND filename = ?", (id, filename)
-    ).fetchone()
-    if file is None:
+def get_file(id: int, filename: str):
+    """ファイルダウンロード(Range・条件付きリクエストに対応)"""
+    try:
+        file_path = find_file_path(id, filename)
+        stat = os.stat(file_path)
+    except FileNotFoundError:
         abort(404)
-    file_path = file["save_name"]
 
-    return send_file(file_path, download_name=file["filename"])
+    # IDごとに内容は変わらないので、保存時の状態から強いETagを作り長期キャッシュさせる
+    response = cache_forever(
+        send_file(
+            file_path,
+            download_name=filename,
+            etag=f"{id}-{stat.st_size}-{stat.st_mtime_ns}",
+            last_modified=stat.st_mtime,
+        )
+    )
+    # 途中から再開できることを通常の応答でも知らせる
+    response.accept_ranges = "bytes"
+    return response
+
+
+@http_module.post("/files")
+def upload_file():
+    """ファイルアップロード(multipart の本文を一時ファイルに少しずつ書き込む)
+
+    送信者は X-Socket-Id ヘッダの接続で参加中の部屋に送信される。
+    """
+    client = joined_client()
+    if client is None:
+        return not_in_room("uploading")
+    sid = request.headers["X-Socket-Id"]
+    # 本文を読む前に本文の長さで数える(長さのない chunked は受け付ける上限で数える)
+    length = request.content_length
+    if length is None:
+        length = MAX_UPLOAD_SIZE + MAX_FORM_MEMORY_SIZE
+    try:
+        limiter.acquire(sid, client.room_id, {"media": (1, length)})
+    except RateLimited as e:
+        return (
+            jsonify(e.to_dict()),
+            429,
+            {"Retry-After": str(max(1, round(e.retry_after)))},
+        )
+
+    streams = {}
+
+    def stream_factory(*args, **kwargs):
+        file, path = open_upload_file()
+        streams[file] = path
+        return file
+
+    try:
+        # 本文はファイルに区切りやファイル以外の値を加えた分まで受け付ける
+        _, _, files = parse_form_data(
+            request.environ,
+            stream_factory=stream_factory,
+            max_form_memory_size=MAX_FORM_MEMORY_SIZE,
+            max_content_length=MAX_UPLOAD_SIZE + MAX_FORM_MEMORY_SIZE,
+            max_form_parts=MAX_FORM_PARTS,
+        )
+        file = files.get("file")
+        filename = os.path.basename(file.filename or "") if file else ""
+        if not filename:
+            return (
+                jsonify({"code": "INVALID_UPLOAD", "message": "file is required."}),
+                400,
+            )
+        file.close()
+        size = os.path.getsize(streams[file.stream])
+        if size > MAX_UPLOAD_SIZE:
+            raise RequestEntityTooLarge()
+        metrics.observe_upload("http", size)
+        message = publish_file(client, streams[file.stream], filename)
+    except RequestEntityTooLarge:
+        return (
+            jsonify(
+                {
+                    "code": "TOO_LARGE",
+                    "message": f"file size exceeds {MAX_UPLOAD_SIZE} bytes.",
+                }
+            ),
+            413,
+        )
+    except (OSError, sqlite3.Error) as e:
+        return jsonify(upload_failed(e)), 500
+    finally:
+        # 保存先に移動しなかった一時ファイル
+        for stream, path in streams.items():
+            stream.close()
+            if os.path.exists(path):
+                os.remove(path)
+    return jsonify({"id": message["id"], "link": message["link"]}), 201
+
+
+@http_module.get("/images/<digest>")
+def get_image(digest: str):
+    """画像ダウンロード"""
+    if not is_image_digest(digest):
+        abort(404)
+    image_path = get_image_path(digest)
+    if not os.path.exists(image_path):
+        abort(404)
+
+    # ハッシュ値のURLなので内容が変わることはない
+    return cache_forever(send_file(image_path, mimetype=get_image_mimetype(image_path)))
+
+
+@http_module.get("/thumbnails/<name>")
+def get_thumbnail(name: str):
+    """縮小画像ダウンロード(未作成なら作成を待つ。作成できない画像は404)"""
+    parsed = parse_thumbnail_name(name)
+    if parsed is None or parsed[1] not in THUMBNAIL_SIZES:
+        abort(404)
+    digest, _ = parsed
+    if not os.path.exists(get_image_path(digest)):
+        abort(404)
+    thumbnail_path = get_thumbnail_path(name)
+    if not os.path.exists(thumbnail_path):
+        # 作成中または機能追加前の画像
+        try:
+            thumbnails.submit(digest).result()
+        except Exception:
+            # 失敗は作成時に記録済み
+            abort(404)
+
+    return cache_forever(
+        send_file(thumbnail_path, mimetype=get_image_mimetype(thumbnail_path))
+    )
+
+
+@http_module.get("/rooms/<name>/history")
+@transact
+def get_room_history(conn: sqlite3.Connection, name: str):
+    """過去ログを before より古い順に取得
+
+    X-Socket-Id ヘッダの接続がその部屋に参加している場合のみ返す。
+    """
+    client = joined_client()
+    room = conn.execute("SELECT id FROM rooms WHERE name = ?", (name,)).fetchone()
+    if client is None or room is None or room["id"] != client.room_id:
+        return not_in_room("reading its history")
+    messages, has_more = get_history(
+        conn,
+        room["id"],
+        history_limit(request.args.get("limit", type=int)),
+        request.args.get("before", type=int),
+    )
+    return jsonify({"messages": messages, "has_more": has_more})
+
+
+@http_module.get("/search")
+@transact
+def search(conn: sqlite3.Connection):
+    """部屋のメッセージを検索(関連度の高い順、offset から limit 件)
+
+    X-Socket-Id ヘッダの接続が room の部屋に参加している場合のみ検索する。
+    """
+    client = joined_client()
+    room = conn.execute(
+        "SELECT id FROM rooms WHERE name = ?", (request.args.get("room", ""),)
+    ).fetchone()
+    if client is None or room is None or room["id"] != client.room_id:
+        return not_in_room("searching")
+    try:
+        messages, has_more = search_messages(
+            conn,
+            room["id"],
+            request.args.get("q", ""),
+            history_limit(request.args.get("limit", type=int)),
+            max(0, request.args.get("offset", 0, type=int)),
+        )
+    except ValueError as e:
+        return jsonify({"code": "INVALID_QUERY", "message": str(e)}), 400
+    return jsonify({"messages": messages, "has_more": has_more})
@@ -1,37 +1,67 @@
+import os
 import sqlite3
-from datetime import datetime
 
 from flask import request
 from flask_socketio import SocketIO, disconnect, emit, join_room, leave_room
-from libs.config import JOIN_MESSAGES, LOG_SYSTEM, SYSTEM_LOBBY, SYSTEM_USER
-from libs.storage import cursor_transact, decode_file, transact
+from libs.batch import batcher
+from libs.config import (
+    JOIN_MESSAGES,
+    LOG_SYSTEM,
+    MAX_UPLOAD_SIZE,
+    SYSTEM_LOBBY,
+    SYSTEM_USER,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_WINDOW,
+)
+from libs.lobby import lobby
+from libs.messages import history_limit, publish_file, timestamp, upload_failed
+from libs.metrics import metrics
+from libs.presence import presence
+from libs.profiler import is_admin, profiler
+from libs.ratelimit import RateLimited, limiter
+from libs.storage import (
+    decode_file,
+    get_history,
+    get_image_link,
+    get_thumbnail_links,
+    insert_image,
+    insert_message,
+    next_timeline_id,
+    search_messages,
+    store_image,
+    to_bytes,
+    transact,
+    write,
+)
+from libs.thumbnail import thumbnails
+from libs.upload import TooManyUploads, uploads
 
 
-def timestamp(data=None):
-    if data:
-        data = dict(data)
-        return data.get("timestamp", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def message_costs(data: dict):
+    """送信の上限と照らし合わせる種類ごとの(メッセージ数, バイト数)"""
+    costs = {}
+    if data.get("message"):
+        costs["text"] = (1, len(str(data["message"]).encode()))
+    media = []
+    if data.get("image"):
+        media.append(len(data["image"]))
+    if data.get("filename") and data.get("file_data"):
+        media.append(len(data["file_data"]))
+    if media:
+        costs["media"] = (len(media), sum(media))
+    return costs
 
 
-@transact
-def get_available_rooms(conn: sqlite3.Connection):
-    """部屋一覧を取得"""
-    available_rooms = conn.execute(
-        """
-        SELECT r.name, COUNT(j.id) as count
-        FROM rooms r
-        INNER JOIN joins j ON r.id = j.room_id
-        WHERE r.is_active = true
-        GROUP BY r.name
-        ORDER BY count DESC
-        """
-    ).fetchall()
-    available_rooms = [dict(room) for room in available_rooms]
-    return available_rooms
+def ack_error(code: str, message: str):
+    """イベントの応答(ack)でのエラー"""
+    return {"error": {"code": code, "message": message}}
 
 
 def register_socket_routes(socketio: SocketIO):
+    lobby.init_app(socketio)
+    batcher.init_app(socketio)
+    uploads.init_app(socketio)
+
     @socketio.on("connect")
     @transact
     def handle_connect(conn: sqlite3.Connection):
@@ -40,6 +70,7 @@ def register_socket_routes(socketio: SocketIO):
         if name is None:
             emit("error", {"code": "MISSING_NAME", "message": "name is required."})
             disconnect()
+            return
         client = conn.execute("SELECT * FROM users WHERE name = ?", (name,)).fetchone()
         if client:
             # DBに同一ユーザ名の登録がある
@@ -58,66 +89,56 @@ def register_socket_routes(socketio: SocketIO):
                 "UPDATE users SET socket_id = ?, is_active = true WHERE name = ?",
                 (request.sid, name),
             )
+            user_id = client["id"]
         else:
             # ユーザ新規登録
-            conn.execute(
+            user_id = conn.execute(
                 "INSERT INTO users (name, socket_id) VALUES (?, ?)",
                 (name, request.sid),
-            )
+            ).lastrowid
+        presence.connect(request.sid, user_id, name)
 
-        available_rooms = get_available_rooms()
         join_room(SYSTEM_LOBBY)  # ロビー
-        emit("rooms", available_rooms)
+        emit("rooms_delta", presence.rooms())
 
     @socketio.on("disconnect")
     @transact
     def handle_disconnect(conn: sqlite3.Connection):
         """切断処理"""
-        client = conn.execute(
-            "SELECT * FROM users WHERE socket_id = ?", (request.sid,)
-        ).fetchone()
-        room = conn.execute(
-            """
-            SELECT r.id, r.name, COUNT(j.id) as join_count
-            FROM rooms r
-            INNER JOIN joins j ON r.id = j.room_id
-            INNER JOIN users u ON u.id = j.user_id
-            WHERE r.id IN (
-                SELECT r.id
-                FROM joins
-                JOIN users ON joins.user_id = users.id
-                WHERE users.socket_id = ?
-            )
-            GROUP BY r.id
-            """,
-            (request.sid,),
-        ).fetchone()
+        uploads.discard_all(request.sid)
+        limiter.discard("socket", request.sid)
+        client, room_id, remaining = presence.disconnect(request.sid)
 
-        if room and room["id"]:
+        if room_id is not None:
             # leave が未処理
-            print(f"disconnect {client and dict(client)}")
-            if room["join_count"] <= 1:
+            print(f"disconnect {vars(client)}")
+            if remaining == 0:
                 conn.execute(
-                    "UPDATE rooms SET is_active = false WHERE id = ?", (room["id"],)
+                    "UPDATE rooms SET is_active = false WHERE id = ?", (room_id,)
                 )
-            conn.execute("DELETE FROM joins WHERE user_id = ?", (client["id"],))
-            message = f"{client['name']} has leaved the room."
+                limiter.discard("room", room_id)
+            conn.execute("DELETE FROM joins WHERE user_id = ?", (client.user_id,))
+            message = f"{client.name} has leaved the room."
+            message_id = None
             if LOG_SYSTEM:
                 sys_user = conn.execute(
                     "SELECT id FROM users WHERE name = ?", (SYSTEM_USER,)
                 ).fetchone()
-                conn.execute(
-                    "INSERT INTO messages (room_id, user_id, message) VALUES (?, ?, ?)",
-                    (room["id"], sys_user["id"], message),
-                )
-            emit(
-                "message",
-                {"user": SYSTEM_USER, "message": message, "timestamp": timestamp()},
-                to=str(room["id"]),
-            )
+                message_id = next_timeline_id()
             conn.commit()
-            available_rooms = get_available_rooms()
-            emit("rooms", available_rooms, to=SYSTEM_LOBBY)
+            if LOG_SYSTEM:
+                # 書き込みスレッドがこの接続のロックを待たないようコミット後に渡す
+                write(insert_message, room_id, sys_user["id"], message, message_id)
+            batcher.send(
+                {
+                    "id": message_id,
+                    "user": SYSTEM_USER,
+                    "message": message,
+                    "timestamp": timestamp(),
+                },
+                str(room_id),
+            )
+            lobby.notify()
 
         leave_room(SYSTEM_LOBBY)
         conn.execute(
@@ -132,210 +153,288 @@ def register_socket_routes(socketio: SocketIO):
             emit("error", {"message": f"{SYSTEM_LOBBY} is used by system."})
             disconnect()
             return
-        client = conn.execute(
-            "SELECT * FROM users WHERE socket_id = ?", (request.sid,)
-        ).fetchone()
+        client = presence.get(request.sid)
         room = conn.execute(
             "SELECT id FROM rooms WHERE name = ?", (data["room"],)
         ).fetchone()
         if not room:
-            # ルームを作成
-            conn.execute("INSERT INTO rooms (name) VALUES (?)", (data["room"],))
+            # ルームを作成(同時に作成された場合はそちらを使う)
+            conn.execute(
+                "INSERT OR IGNORE INTO rooms (name) VALUES (?)", (data["room"],)
+            )
             room = conn.execute(
                 "SELECT id FROM rooms WHERE name = ?", (data["room"],)
             ).fetchone()
 
         conn.execute(
             "INSERT INTO joins (room_id, user_id) VALUES (?, ?)",
-            (room["id"], client["id"]),
+            (room["id"], client.user_id),
         )
         conn.execute("UPDATE rooms SET is_active = true WHERE id = ?", (room["id"],))
-        message = f"{client['name']} has entered the room."
+        presence.join(request.sid, room["id"], data["room"])
+        message = f"{client.name} has entered the room."
+        message_id = None
         if LOG_SYSTEM:
             sys_user = conn.execute(
                 "SELECT id FROM users WHERE name = ?", (SYSTEM_USER,)
             ).fetchone()
-            conn.execute(
-                "INSERT INTO messages (room_id, user_id, message) VALUES (?, ?, ?)",
-                (room["id"], sys_user["id"], message),
-            )
-        messages = conn.execute(
-            """
-            WITH combined_data AS (
-                SELECT
-                    u.name AS user,
-                    m.message,
-                    NULL AS image,
-                    NULL AS filename,
-                    NULL AS link,
-                    m.updated_at
-                FROM messages m
-                JOIN users u ON m.user_id = u.id
-                WHERE m.room_id = ?
-
-                UNION ALL
-
-                SELECT
-                    u.name AS user,
-                    NULL AS message,
-                    i.image,
-                    NULL AS filename,
-                    NULL AS link,
-                    i.updated_at
-                FROM images i
-                JOIN users u ON i.user_id = u.id
-                WHERE i.room_id = ?
-
-                UNION ALL
-
-                SELECT
-                    u.name AS user,
-                    NULL AS message,
-                    NULL AS image,
-                    f.filename,
-                    f.link,
-                    f.updated_at
-                FROM files f
-                JOIN users u ON f.user_id = u.id
-                WHERE f.room_id = ?
-            )
-            SELECT user, message, image, filename, link, updated_at AS timestamp
-            FROM combined_data
-            ORDER BY updated_at DESC
-            LIMIT ?
-            """,
-            (room["id"], room["id"], room["id"], JOIN_MESSAGES),
-        ).fetchall()
+            message_id = next_timeline_id()
+        messages, has_more = get_history(conn, room["id"], JOIN_MESSAGES)
         conn.commit()
+        if LOG_SYSTEM:
+            # 書き込みスレッドがこの接続のロックを待たないようコミット後に渡す
+            write(insert_message, room["id"], sys_user["id"], message, message_id)
 
         leave_room(SYSTEM_LOBBY)
         join_room(str(room["id"]))
-        [emit("message", dict(m)) for m in messages[::-1]]
-        emit(
-            "message",
-            {"user": SYSTEM_USER, "message": message, "timestamp": timestamp()},
-            to=str(room["id"]),
+        # 過去ログは1ページ分をまとめて送る(load_history の応答と同じ形式)
+        emit("history", {"messages": messages, "has_more": has_more})
+        batcher.send(
+            {
+                "id": message_id,
+                "user": SYSTEM_USER,
+                "message": message,
+                "timestamp": timestamp(),
+            },
+            str(room["id"]),
         )
         conn.commit()
-        available_rooms = get_available_rooms()
-        emit("rooms", available_rooms, to=SYSTEM_LOBBY)
+        lobby.notify()
 
     @socketio.on("leave")
     @transact
     def handle_leave(conn: sqlite3.Connection):
         """部屋から退出"""
-        client = conn.execute(
-            "SELECT * FROM users WHERE socket_id = ?", (request.sid,)
-        ).fetchone()
-        room = conn.execute(
-            """
-            SELECT r.id, r.name, COUNT(j.id) as join_count
-            FROM rooms r
-            INNER JOIN joins j ON r.id = j.room_id
-            INNER JOIN users u ON u.id = j.user_id
-            WHERE r.id IN (
-                SELECT r.id
-                FROM joins
-                JOIN users ON joins.user_id = users.id
-                WHERE users.socket_id = ?
-            )
-            GROUP BY r.id
-            """,
-            (request.sid,),
-        ).fetchone()
-        if room["join_count"] <= 1:
+        client = presence.get(request.sid)
+        room_id, remaining = presence.leave(request.sid)
+        if room_id is None:
+            return
+        if remaining == 0:
             # 部屋が空になる
-            conn.execute(
-                "UPDATE rooms SET is_active = false WHERE id = ?", (room["id"],)
-            )
-        conn.execute("DELETE FROM joins WHERE user_id = ?", (client["id"],))
-        message = f"{client['name']} has leaved the room."
+            conn.execute("UPDATE rooms SET is_active = false WHERE id = ?", (room_id,))
+            limiter.discard("room", room_id)
+        conn.execute("DELETE FROM joins WHERE user_id = ?", (client.user_id,))
+        message = f"{client.name} has leaved the room."
+        message_id = None
         if LOG_SYSTEM:
             sys_user = conn.execute(
                 "SELECT id FROM users WHERE name = ?", (SYSTEM_USER,)
             ).fetchone()
-            conn.execute(
-                "INSERT INTO messages (room_id, user_id, message) VALUES (?, ?, ?)",
-                (room["id"], sys_user["id"], message),
-            )
+            message_id = next_timeline_id()
+        conn.commit()
+        if LOG_SYSTEM:
+            # 書き込みスレッドがこの接続のロックを待たないようコミット後に渡す
+            write(insert_message, room_id, sys_user["id"], message, message_id)
 
-        leave_room(str(room["id"]))
+        leave_room(str(room_id))
         join_room(SYSTEM_LOBBY)
-        emit(
-            "message",
-            {"user": SYSTEM_USER, "message": message, "timestamp": timestamp()},
-            to=str(room["id"]),
+        batcher.send(
+            {
+                "id": message_id,
+                "user": SYSTEM_USER,
+                "message": message,
+                "timestamp": timestamp(),
+            },
+            str(room_id),
         )
-        conn.commit()
-        available_rooms = get_available_rooms()
-        emit("rooms", available_rooms, to=SYSTEM_LOBBY)
+        lobby.notify()
+        emit("rooms_delta", presence.rooms())
+
+    @socketio.on("sync_rooms")
+    def handle_sync_rooms():
+        """部屋一覧を全件再送(クライアントが版番号の欠落を検知したとき)"""
+        emit("rooms_delta", presence.rooms())
 
     @socketio.on("message")
-    @transact
-    def handle_message(conn: sqlite3.Connection, data):
+    def handle_message(data):
         """テキストメッセージ受信"""
-        with cursor_transact(conn) as cur:
-            client = cur.execute(
-                "SELECT * FROM users WHERE socket_id = ?", (request.sid,)
-            ).fetchone()
-            room = cur.execute(
-                """
-                SELECT r.id
-                FROM rooms r
-                INNER JOIN joins j ON r.id = j.room_id
-                INNER JOIN users u ON j.user_id = u.id
-                WHERE u.socket_id = ? AND r.is_active = true
-                """,
-                (request.sid,),
-            ).fetchone()
-            data = dict(data)
-            if data.get("message"):
-                cur.execute(
-                    "INSERT INTO messages (room_id, user_id, message) VALUES (?, ?, ?)",
-                    (room["id"], client["id"], data["message"]),
-                )
-                emit(
-                    "message",
-                    {
-                        "user": client["name"],
-                        "message": data["message"],
-                        "timestamp": timestamp(data),
-                    },
-                    to=str(room["id"]),
-                )
-            if data.get("image"):
-                cur.execute(
-                    "INSERT INTO images (room_id, user_id, image) VALUES (?, ?, ?)",
-                    (room["id"], client["id"], data["image"]),
-                )
-                emit(
-                    "message",
-                    {
-                        "user": client["name"],
-                        "image": data["image"],
-                        "timestamp": timestamp(data),
-                    },
-                    to=str(room["id"]),
-                )
-            if data.get("filename") and data.get("file_data"):
-                cur.execute(
-                    "INSERT INTO files (room_id, user_id, filename) VALUES (?, ?, ?)",
-                    (room["id"], client["id"], data["filename"]),
-                )
-                file_id = cur.lastrowid
-                file_path = decode_file(data["file_data"], data["filename"], file_id)
-                link = f"/files/{file_id}/{data['filename']}"
-                cur.execute(
-                    "UPDATE files SET save_name = ?, link = ? WHERE id = ?",
-                    (file_path, link, file_id),
-                )
-                emit(
-                    "message",
-                    {
-                        "user": client["name"],
-                        "filename": data["filename"],
-                        "link": link,
-                        "timestamp": timestamp(data),
-                    },
-                    to=str(room["id"]),
-                )
+        client = presence.get(request.sid)
+        if client is None or client.room_id is None:
+            return
+        room_id = client.room_id
+        data = dict(data)
+        try:
+            limiter.acquire(request.sid, room_id, message_costs(data))
+        except RateLimited as e:
+            # 保存・送信の前に断り、送信者にだけ知らせる
+            emit("error", e.to_dict())
+            return
+        if data.get("message"):
+            message_id = next_timeline_id()
+            write(
+                insert_message,
+                room_id,
+                client.user_id,
+                data["message"],
+                message_id,
+            )
+            batcher.send(
+                {
+                    "id": message_id,
+                    "user": client.name,
+                    "message": data["message"],
+                    "timestamp": timestamp(data),
+                },
+                str(room_id),
+            )
+        if data.get("image"):
+            metrics.observe_upload("image", len(data["image"]))
+            message_id = next_timeline_id()
+            digest = store_image(data["image"])
+            thumbnails.submit(digest)
+            write(insert_image, room_id, client.user_id, digest, message_id)
+            batcher.send(
+                {
+                    "id": message_id,
+                    "user": client.name,
+                    "image_url": get_image_link(digest),
+                    "thumbnails": get_thumbnail_links(digest),
+                    "timestamp": timestamp(data),
+                },
+                str(room_id),
+            )
+        if data.get("filename") and data.get("file_data"):
+            metrics.observe_upload("file", len(data["file_data"]))
+            # リンクにIDが必要なのでファイルのみ保存を待つ
+            path = None
+            try:
+                path = decode_file(data["file_data"])
+                publish_file(client, path, data["filename"], data)
+            except (OSError, sqlite3.Error) as e:
+                emit("error", upload_failed(e))
+            finally:
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+
+    @socketio.on("load_history")
+    @transact
+    def handle_load_history(conn: sqlite3.Connection, data=None):
+        """参加中の部屋の過去ログを before より古い順に取得(ackで返す)"""
+        data = dict(data or {})
+        client = presence.get(request.sid)
+        if client is None or client.room_id is None:
+            return {"messages": [], "has_more": False}
+        before = data.get("before")
+        messages, has_more = get_history(
+            conn,
+            client.room_id,
+            history_limit(data.get("limit")),
+            None if before is None else int(before),
+        )
+        return {"messages": messages, "has_more": has_more}
+
+    @socketio.on("search")
+    @transact
+    def handle_search(conn: sqlite3.Connection, data):
+        """参加中の部屋のメッセージを検索(ackで関連度の高い順に返す)"""
+        data = dict(data)
+        client = presence.get(request.sid)
+        if client is None or client.room_id is None:
+            return ack_error("NOT_IN_ROOM", "join a room before searching.")
+        try:
+            messages, has_more = search_messages(
+                conn,
+                client.room_id,
+                str(data.get("query") or ""),
+                history_limit(data.get("limit")),
+                max(0, int(data.get("offset") or 0)),
+            )
+        except ValueError as e:
+            return ack_error("INVALID_QUERY", str(e))
+        return {"messages": messages, "has_more": has_more}
+
+    @socketio.on("upload_start")
+    def handle_upload_start(data):
+        """分割アップロードの開始(ackで upload_id・チャンクサイズ・ウィンドウを返す)"""
+        client = presence.get(request.sid)
+        if client is None or client.room_id is None:
+            return ack_error("NOT_IN_ROOM", "join a room before uploading.")
+        data = dict(data)
+        filename = os.path.basename(data.get("filename") or "")
+        size = data.get("size")
+        if not filename or not isinstance(size, int) or size < 0:
+            return ack_error("INVALID_UPLOAD", "filename and size are required.")
+        if size > MAX_UPLOAD_SIZE:
+            return ack_error("TOO_LARGE", f"file size exceeds {MAX_UPLOAD_SIZE} bytes.")
+        try:
+            # チャンクを受け取る前にファイル全体のバイト数を数える
+            limiter.acquire(request.sid, client.room_id, {"media": (1, size)})
+        except RateLimited as e:
+            return {"error": e.to_dict()}
+        try:
+            upload_id = uploads.start(request.sid, filename, size)
+        except TooManyUploads as e:
+            return ack_error("TOO_MANY_UPLOADS", str(e))
+        return {
+            "upload_id": upload_id,
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "window": UPLOAD_WINDOW,
+        }
+
+    @socketio.on("upload_chunk")
+    def handle_upload_chunk(data):
+        """チャンクを一時ファイルに書き込む(ackで受信済みのバイト数を返す)
+
+        クライアントは応答待ちのチャンクが window 個になったら応答を待つ。
+        """
+        data = dict(data)
+        upload = uploads.get(request.sid, data.get("upload_id"))
+        if upload is None:
+            return ack_error("UNKNOWN_UPLOAD", "upload is not started.")
+        chunk = to_bytes(data.get("data") or b"")
+        if len(chunk) > UPLOAD_CHUNK_SIZE:
+            return ack_error(
+                "CHUNK_TOO_LARGE", f"chunk size exceeds {UPLOAD_CHUNK_SIZE} bytes."
+            )
+        offset = data.get("offset")
+        if not isinstance(offset, int) or isinstance(offset, bool):
+            return ack_error("INVALID_CHUNK", "offset must be an integer.")
+        try:
+            received = upload.write(offset, chunk)
+        except ValueError as e:
+            return ack_error("INVALID_CHUNK", str(e))
+        return {"received": received}
+
+    @socketio.on("upload_end")
+    def handle_upload_end(data):
+        """受信したファイルを保存して部屋に送信(ackでメッセージIDとリンクを返す)"""
+        data = dict(data)
+        upload = uploads.pop(request.sid, data.get("upload_id"))
+        if upload is None:
+            return ack_error("UNKNOWN_UPLOAD", "upload is not started.")
+        client = presence.get(request.sid)
+        if client is None or client.room_id is None:
+            upload.discard()
+            return ack_error("NOT_IN_ROOM", "join a room before uploading.")
+        if not upload.complete:
+            upload.discard()
+            return ack_error(
+                "INCOMPLETE_UPLOAD",
+                f"received {upload.received} of {upload.size} bytes.",
+            )
+        upload.close()
+        metrics.observe_upload("chunked", upload.size)
+        try:
+            message = publish_file(client, upload.path, upload.filename, data)
+        except (OSError, sqlite3.Error) as e:
+            upload.discard()
+            return {"error": upload_failed(e)}
+        return {"id": message["id"], "link": message["link"]}
+
+    @socketio.on("upload_abort")
+    def handle_upload_abort(data):
+        """分割アップロードの中止"""
+        upload = uploads.pop(request.sid, dict(data).get("upload_id"))
+        if upload is not None:
+            upload.discard()
+
+    @socketio.on("admin_profile")
+    def handle_admin_profile(data):
+        """プロファイルの計測の切り替え・書き出し(管理用、ackで状態を返す)"""
+        data = dict(data or {})
+        if not is_admin(data.get("token")):
+            return ack_error("FORBIDDEN", "admin token is required.")
+        try:
+            return profiler.control(data)
+        except ValueError as e:
+            return ack_error("INVALID_OPTION", str(e))
@@ -1,35 +1,414 @@
+import atexit
 import base64
+import hashlib
 import os
+import re
+import queue
 import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
 from contextlib import contextmanager
-from functools import wraps
+from functools import lru_cache, wraps
 
-from libs.config import DATABASE, FILE_FOLDER, MAX_FILES, SYSTEM_USER
+from libs import concurrency
+from libs.config import (
+    DATABASE,
+    DB_BUSY_TIMEOUT,
+    DB_CACHE_SIZE,
+    DB_MMAP_SIZE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_SYNCHRONOUS,
+    FILE_CACHE_SIZE,
+    FILE_FOLDER,
+    FILE_SWEEP_THRESHOLD,
+    IMAGE_FOLDER,
+    MAX_FILES,
+    MAX_WORKERS,
+    METRICS,
+    SEARCH_RANK_LIMIT,
+    SYSTEM_USER,
+    THUMBNAIL_FORMAT,
+    THUMBNAIL_SIZES,
+    WAL_MODE,
+    WORKER_INDEX,
+    WRITE_BATCH_LATENCY,
+    WRITE_BATCH_SIZE,
+)
+from libs.metrics import metrics
+
+
+def may_block(sql: str):
+    """SQLがロック待ちで止まりうるか(WALモードの読み込みは書き込みを待たない)"""
+    return not (WAL_MODE and sql.lstrip()[:6].upper() == "SELECT")
+
+
+class TimedCursor(sqlite3.Cursor):
+    """文の実行時間を記録するカーソル"""
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            metrics.observe_sql(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            metrics.observe_sql(sql, time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """文の実行・コミットの時間を記録する接続(METRICS が有効な場合に使う)
+
+    Connection.execute はカーソルの execute を経由しないため、こちらでも計測する。
+    時間は最初の行を返すまでで、残りの行の fetch は含まない。
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            metrics.observe_sql(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            metrics.observe_sql(sql, time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            metrics.observe_sql("COMMIT", time.perf_counter() - start)
+
+
+class GreenCursor(TimedCursor):
+    """ロックを取る最初の実行をネイティブスレッドで行うカーソル"""
+
+    def execute(self, sql, *args):
+        if not may_block(sql):
+            return super().execute(sql, *args)
+        return concurrency.offload(super().execute, sql, *args)
+
+    def executemany(self, *args):
+        return concurrency.offload(super().executemany, *args)
+
+    def executescript(self, *args):
+        return concurrency.offload(super().executescript, *args)
+
+
+class GreenConnection(TimedConnection):
+    """eventlet・gevent 用の接続
+
+    SQLiteのロック待ち(最大 DB_BUSY_TIMEOUT)やコミット時のfsyncはイベントループ全体を
+    止めるため、文の実行・コミットをネイティブスレッドへ逃がす。
+    スレッドの切り替えは1回ごとに時間がかかるので、止まらない読み込みはそのまま実行する。
+    """
+
+    def cursor(self, factory=GreenCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        if not may_block(sql):
+            return super().execute(sql, *args)
+        return concurrency.offload(super().execute, sql, *args)
+
+    def executemany(self, *args):
+        return concurrency.offload(super().executemany, *args)
+
+    def executescript(self, *args):
+        return concurrency.offload(super().executescript, *args)
+
+    def commit(self):
+        return concurrency.offload(super().commit)
+
+    def rollback(self):
+        return concurrency.offload(super().rollback)
+
+
+class ConnectionPool:
+    """SQLite接続プール
+
+    接続を使い回して、イベントごとの接続・切断とスキーマ読み込みを省く。
+    貸し出し中と待機中を合わせた接続数は max_size 以下に制限される。
+    """
+
+    def __init__(self, database: str, max_size: int, timeout: float):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size) if max_size > 0 else None
+
+    def connect(self):
+        """新しい接続を作成"""
+        conn = sqlite3.connect(
+            self.database,
+            timeout=DB_BUSY_TIMEOUT / 1000,
+            check_same_thread=False,
+            factory=(
+                GreenConnection
+                if concurrency.is_green()
+                else TimedConnection if METRICS else sqlite3.Connection
+            ),
+        )
+        conn.row_factory = sqlite3.Row
+        if WAL_MODE:
+            conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+            conn.execute(f"PRAGMA cache_size = {DB_CACHE_SIZE}")
+            conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        return conn
+
+    def is_healthy(self, conn: sqlite3.Connection):
+        """接続が使える状態か確認"""
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return not conn.in_transaction
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """接続を借りる"""
+        if self._slots is None:
+            # プール無効時は毎回接続する
+            return self.connect()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("connection pool exhausted")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if self.is_healthy(conn):
+                    return conn
+                conn.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        """接続を返す"""
+        if self._slots is None:
+            conn.close()
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """待機中の接続をすべて閉じる"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+pool = ConnectionPool(DATABASE, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+_local = threading.local()
 
 
 def get_db():
     """DB接続"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return pool.connect()
 
 
 def transact(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
+        conn = getattr(_local, "conn", None)
+        if conn is not None:
+            # 同じスレッドで処理中のトランザクションがあれば同じ接続を使う
+            return func(conn, *args, **kwargs)
+        with pool.connection() as conn:
+            _local.conn = conn
+            try:
+                result = func(conn, *args, **kwargs)
+                conn.commit()
+                return result
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                _local.conn = None
+
+    return wrapper
+
+
+class BatchWriter:
+    """書き込み専用スレッド
+
+    投入された書き込み処理をまとめて1トランザクションでコミットする。
+    最初の書き込みから max_latency 秒以内、または max_size 件たまった時点でコミットする。
+    """
+
+    def __init__(self, connect, max_latency: float, max_size: int):
+        self.connect = connect
+        self.max_latency = max_latency
+        self.max_size = max_size
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="storage-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """未処理の書き込みをコミットしてから終了"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, func, *args):
+        """書き込み処理 func(conn, *args) を投入し、コミット後に結果が入るFutureを返す"""
+        future = Future()
+        self._queue.put((func, args, future))
+        return future
+
+    def _run(self):
+        conn = self.connect()
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [job for job in batch if job is not None]
+            if batch:
+                self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: list):
+        results = []
         try:
-            conn = sqlite3.connect(DATABASE)
-            conn.row_factory = sqlite3.Row
-            result = func(conn, *args, **kwargs)
+            conn.execute("BEGIN")
+            for func, args, future in batch:
+                # 1件の失敗で他の書き込みが巻き戻らないようにセーブポイントで区切る
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, func(conn, *args), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
             conn.commit()
-            return result
         except Exception as e:
             conn.rollback()
-            raise e
-        finally:
-            conn.close()
+            print(f"write batch failed: {e!r}")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                print(f"write failed: {error!r}")
+                future.set_exception(error)
 
-    return wrapper
+
+# タイムラインIDは (ID_EPOCH からのミリ秒 << 12) | (同じミリ秒内の連番 << 5) | ワーカー番号
+ID_EPOCH = 1704067200000  # 2024-01-01 UTC
+ID_SEQUENCE_BITS = 7
+ID_WORKER_BITS = (MAX_WORKERS - 1).bit_length()
+
+
+class IdAllocator:
+    """IDの払い出し
+
+    コミット前(書き込みスレッドに投入する前)にIDを確定させるため、
+    挿入時の採番ではなくプロセス内で払い出す。
+    複数ワーカーでも払い出した順に大きくなるように上位を時刻、下位をワーカー番号にする。
+    時刻が戻ったり、同じミリ秒内の連番を使い切ったりしたときは、最後のIDの次を使う。
+    """
+
+    def __init__(self, conn: sqlite3.Connection, table: str, worker: int = 0):
+        if not 0 <= worker < MAX_WORKERS:
+            raise ValueError(f"worker index must be less than {MAX_WORKERS}.")
+        last = conn.execute(
+            f"""
+            SELECT MAX(
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0),
+                COALESCE((SELECT MAX(id) FROM {table}), 0)
+            )
+            """,
+            (table,),
+        ).fetchone()[0]
+        self.worker = worker
+        # (時刻 << ID_SEQUENCE_BITS) | 連番 の最後に払い出した値
+        self._last = last >> ID_WORKER_BITS
+        self._lock = threading.Lock()
+
+    def next(self):
+        now = (int(time.time() * 1000) - ID_EPOCH) << ID_SEQUENCE_BITS
+        with self._lock:
+            self._last = max(now, self._last + 1)
+            return self._last << ID_WORKER_BITS | self.worker
+
+
+writer = None
+timeline_ids = None
+sweeper = None
+
+
+def next_timeline_id():
+    """タイムラインIDを払い出す"""
+    return timeline_ids.next()
+
+
+def write(func, *args):
+    """書き込み処理 func(conn, *args) を実行してFutureを返す
+
+    WALモードでは書き込みスレッドに投入し、コミットを待たずに返る。
+    それ以外では呼び出し元のトランザクション内でそのまま実行する。
+    """
+    if writer is not None:
+        return writer.submit(func, *args)
+    future = Future()
+    try:
+        future.set_result(transact(func)(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 
 @contextmanager
@@ -185,49 +564,641 @@ def init_db(conn: sqlite3.Connection):
         """
     )
 
+    migrate(conn)
+
     conn.execute("DELETE FROM joins")
     conn.execute("UPDATE rooms SET is_active = false")
     conn.execute("UPDATE users SET is_active = false")
     conn.execute("INSERT OR IGNORE INTO users (name) VALUES (?)", (SYSTEM_USER,))
 
 
-def decode_file(encoded: str, filename: str, id: int):
-    decoded = base64.b64decode(encoded.split(",")[-1])
-    file_path = os.path.join(FILE_FOLDER, f"{id}_{filename}")
-    with open(file_path, "wb") as f:
-        f.write(decoded)
-    delete_limited_files()
-    return file_path
+def migrate_timeline(conn: sqlite3.Connection):
+    """タイムラインテーブルを作成し、既存のメッセージ・画像・ファイルを登録"""
+    # ルームごとの履歴をID順に引くためのテーブル(本体は各テーブルを参照)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS timeline (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            ref_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+            FOREIGN KEY (room_id) REFERENCES rooms (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_timeline_room
+        ON timeline (room_id, id, kind, ref_id, user_id, created_at)
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_timeline_ref ON timeline (kind, ref_id)"
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trigger_files_deleted AFTER DELETE ON files
+        BEGIN
+            DELETE FROM timeline WHERE kind = 'file' AND ref_id = OLD.id;
+        END
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO timeline (room_id, user_id, kind, ref_id, created_at)
+        SELECT room_id, user_id, kind, ref_id, updated_at
+        FROM (
+            SELECT room_id, user_id, 'message' AS kind, id AS ref_id, updated_at
+            FROM messages
+            UNION ALL
+            SELECT room_id, user_id, 'image' AS kind, id AS ref_id, updated_at
+            FROM images
+            UNION ALL
+            SELECT room_id, user_id, 'file' AS kind, id AS ref_id, updated_at
+            FROM files
+        )
+        ORDER BY updated_at, kind, ref_id
+        """
+    )
 
 
-@transact
-def delete_limited_files(conn: sqlite3.Connection):
-    delete_files = conn.execute(
+def migrate_image_blobs(conn: sqlite3.Connection):
+    """画像をDBからファイルに移し、DBにはハッシュ値のみ残す"""
+    conn.execute("ALTER TABLE images ADD COLUMN digest TEXT")
+    image_ids = conn.execute("SELECT id FROM images WHERE image != ''").fetchall()
+    for image_id in image_ids:
+        image = conn.execute(
+            "SELECT image FROM images WHERE id = ?", (image_id["id"],)
+        ).fetchone()
+        conn.execute(
+            "UPDATE images SET image = '', digest = ? WHERE id = ?",
+            (store_image(image["image"]), image_id["id"]),
+        )
+
+
+# スキーマ変更(PRAGMA user_version に適用済みの数を記録)
+def migrate_socket_index(conn: sqlite3.Connection):
+    """切断時の socket_id での更新用インデックス"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_socket_id ON users (socket_id)")
+
+
+# 全文検索の索引の rowid は (部屋ID << SEARCH_ROOM_SHIFT) + メッセージID
+SEARCH_ROOM_SHIFT = 40
+
+
+def migrate_search_index(conn: sqlite3.Connection):
+    """メッセージの全文検索用インデックス(FTS5)を作成し、既存のメッセージを登録"""
+    # 索引の rowid を部屋ごとの範囲に分け、部屋内の検索では rowid の範囲だけを読む
+    # (本文はビュー経由で messages を参照するので索引にだけ持つ)
+    conn.execute(
+        f"""
+        CREATE VIEW IF NOT EXISTS messages_search AS
+        SELECT (room_id << {SEARCH_ROOM_SHIFT}) + id AS id, message FROM messages
+        """
+    )
+    # 日本語は単語の区切りがないので3文字ずつ(trigram)で索引を作る
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+            message,
+            content = 'messages_search',
+            content_rowid = 'id',
+            tokenize = 'trigram'
+        )
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trigger_messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, message)
+            VALUES ((NEW.room_id << {SEARCH_ROOM_SHIFT}) + NEW.id, NEW.message);
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trigger_messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message)
+            VALUES (
+                'delete', (OLD.room_id << {SEARCH_ROOM_SHIFT}) + OLD.id, OLD.message
+            );
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trigger_messages_fts_update
+        AFTER UPDATE OF room_id, message ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message)
+            VALUES (
+                'delete', (OLD.room_id << {SEARCH_ROOM_SHIFT}) + OLD.id, OLD.message
+            );
+            INSERT INTO messages_fts (rowid, message)
+            VALUES ((NEW.room_id << {SEARCH_ROOM_SHIFT}) + NEW.id, NEW.message);
+        END
+        """
+    )
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+MIGRATIONS = [
+    migrate_timeline,
+    migrate_image_blobs,
+    migrate_socket_index,
+    migrate_search_index,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    """未適用のスキーマ変更を適用"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {i}")
+
+
+def insert_timeline(
+    conn: sqlite3.Connection,
+    id: int,
+    kind: str,
+    ref_id: int,
+    room_id: int,
+    user_id: int,
+):
+    """タイムラインに登録"""
+    conn.execute(
         """
-        SELECT id, save_name
-        FROM files
-        WHERE id NOT IN (
-            SELECT id
+        INSERT INTO timeline (id, room_id, user_id, kind, ref_id)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (id, room_id, user_id, kind, ref_id),
+    )
+
+
+def get_history(
+    conn: sqlite3.Connection, room_id: int, limit: int, before: int | None = None
+):
+    """ルームの過去ログを新しい順に取得
+
+    before を指定するとそのIDより古いものを取得する。
+    Returns: (過去ログのリスト, さらに古いログがあるか)
+    """
+    condition = "room_id = ?" if before is None else "room_id = ? AND id < ?"
+    params = (room_id,) if before is None else (room_id, before)
+    messages = conn.execute(
+        f"""
+        SELECT
+            t.id, u.name AS user, m.message, i.digest, f.filename, f.link, t.timestamp
+        FROM (
+            SELECT id, user_id, kind, ref_id, created_at AS timestamp
+            FROM timeline
+            WHERE {condition}
+            ORDER BY id DESC
+            LIMIT ?
+        ) t
+        JOIN users u ON u.id = t.user_id
+        LEFT JOIN messages m ON t.kind = 'message' AND m.id = t.ref_id
+        LEFT JOIN images i ON t.kind = 'image' AND i.id = t.ref_id
+        LEFT JOIN files f ON t.kind = 'file' AND f.id = t.ref_id
+        ORDER BY t.id DESC
+        """,
+        (*params, limit + 1),
+    ).fetchall()
+    messages = [dict(m) for m in messages]
+    for message in messages:
+        digest = message.pop("digest")
+        message["image_url"] = digest and get_image_link(digest)
+        message["thumbnails"] = digest and get_thumbnail_links(digest)
+    return messages[:limit], len(messages) > limit
+
+
+def parse_search_query(query: str):
+    """検索語を FTS5 のクエリ(3文字以上の語)と LIKE で絞り込む語(2文字以下)に分ける
+
+    trigram の索引は2文字以下の語を引けないため、それらは索引で絞り込んだ結果
+    (すべて2文字以下なら部屋のメッセージ全体)から LIKE で探す。
+    Returns: (検索語のリスト, FTS5のクエリ, LIKEのパターンのリスト)
+    """
+    terms = query.split()
+    if not terms:
+        raise ValueError("query is required.")
+    match = " ".join(
+        '"' + term.replace('"', '""') + '"' for term in terms if len(term) >= 3
+    )
+    likes = [
+        "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+        for term in terms
+        if len(term) < 3
+    ]
+    return terms, match, likes
+
+
+def bm25_scores(texts: list[str], terms: list[str], k1=1.2, b=0.75):
+    """各メッセージの BM25 のスコア
+
+    候補はすべての語を含むので、語の重み(IDF)は同じとして出現回数と長さで決まる。
+    """
+    if not texts:
+        return []
+    terms = [term.lower() for term in terms]
+    average = sum(len(text) for text in texts) / len(texts) or 1
+    scores = []
+    for text in texts:
+        norm = k1 * (1 - b + b * len(text) / average)
+        text = text.lower()
+        scores.append(
+            sum(
+                tf * (k1 + 1) / (tf + norm)
+                for tf in (text.count(term) for term in terms)
+            )
+        )
+    return scores
+
+
+def search_messages(
+    conn: sqlite3.Connection, room_id: int, query: str, limit: int, offset: int = 0
+):
+    """ルームのメッセージを全文検索し、関連度の高い順に取得
+
+    FTS5 組み込みの bm25() は語ごとにテーブル全体の一致数を数えるため部屋が多いと重い。
+    索引では部屋の rowid の範囲から新しい順に SEARCH_RANK_LIMIT 件までの一致を取り、
+    それらを BM25 で並べる。2文字以下の語だけの検索は新しい順に返す。
+    Returns: (検索結果のリスト, 続きがあるか)
+    """
+    terms, match, likes = parse_search_query(query)
+    like_condition = "".join(" AND m.message LIKE ? ESCAPE '\\'" for _ in likes)
+    if match:
+        first = room_id << SEARCH_ROOM_SHIFT
+        candidates = conn.execute(
+            f"""
+            SELECT m.id, m.message
             FROM (
-                SELECT id
-                FROM files
-                ORDER BY created_at DESC
+                SELECT rowid FROM messages_fts
+                WHERE messages_fts MATCH ? AND rowid BETWEEN ? AND ?
+                ORDER BY rowid DESC
                 LIMIT ?
-            )
+            ) f
+            JOIN messages m ON m.id = f.rowid - ?
+            WHERE TRUE{like_condition}
+            """,
+            (
+                match,
+                first,
+                first + (1 << SEARCH_ROOM_SHIFT) - 1,
+                SEARCH_RANK_LIMIT,
+                first,
+                *likes,
+            ),
+        ).fetchall()
+        scores = bm25_scores([c["message"] for c in candidates], terms)
+        ranked = sorted(
+            zip(scores, (c["id"] for c in candidates)),
+            key=lambda hit: (-hit[0], -hit[1]),
         )
-        ORDER BY created_at ASC
+        ids = [id for _, id in ranked[offset : offset + limit + 1]]
+    else:
+        ids = [
+            row["id"]
+            for row in conn.execute(
+                f"""
+                SELECT m.id
+                FROM timeline t
+                JOIN messages m ON m.id = t.ref_id
+                WHERE t.room_id = ? AND t.kind = 'message'{like_condition}
+                ORDER BY t.id DESC
+                LIMIT ? OFFSET ?
+                """,
+                (room_id, *likes, limit + 1, offset),
+            )
+        ]
+
+    rows = conn.execute(
+        f"""
+        SELECT m.id AS message_id, t.id, u.name AS user, m.message,
+            t.created_at AS timestamp
+        FROM messages m
+        JOIN timeline t ON t.kind = 'message' AND t.ref_id = m.id
+        JOIN users u ON u.id = m.user_id
+        WHERE m.id IN ({", ".join("?" * len(ids))})
         """,
-        (MAX_FILES,),
+        ids,
     ).fetchall()
-    for file in delete_files:
-        try:
-            os.remove(file["save_name"])
-            conn.execute("DELETE FROM files WHERE id = ?", (file["id"],))
-        except Exception:
-            pass
+    by_id = {row["message_id"]: row for row in rows}
+    messages = []
+    for id in ids[:limit]:
+        message = dict(by_id[id])
+        del message["message_id"]
+        messages.append(message)
+    return messages, len(ids) > limit
+
+
+def insert_message(
+    conn: sqlite3.Connection,
+    room_id: int,
+    user_id: int,
+    message: str,
+    timeline_id: int,
+):
+    """メッセージを保存"""
+    message_id = conn.execute(
+        "INSERT INTO messages (room_id, user_id, message) VALUES (?, ?, ?)",
+        (room_id, user_id, message),
+    ).lastrowid
+    insert_timeline(conn, timeline_id, "message", message_id, room_id, user_id)
+
+
+def insert_image(
+    conn: sqlite3.Connection,
+    room_id: int,
+    user_id: int,
+    digest: str,
+    timeline_id: int,
+):
+    """画像情報を保存(画像本体は store_image で保存済み)"""
+    image_id = conn.execute(
+        "INSERT INTO images (room_id, user_id, image, digest) VALUES (?, ?, '', ?)",
+        (room_id, user_id, digest),
+    ).lastrowid
+    insert_timeline(conn, timeline_id, "image", image_id, room_id, user_id)
+
+
+def insert_file(
+    conn: sqlite3.Connection,
+    room_id: int,
+    user_id: int,
+    filename: str,
+    timeline_id: int,
+):
+    """ファイル情報を保存してファイルIDを返す"""
+    file_id = conn.execute(
+        "INSERT INTO files (room_id, user_id, filename) VALUES (?, ?, ?)",
+        (room_id, user_id, filename),
+    ).lastrowid
+    conn.execute(
+        "UPDATE files SET save_name = ?, link = ? WHERE id = ?",
+        (get_file_path(file_id, filename), get_file_link(file_id, filename), file_id),
+    )
+    insert_timeline(conn, timeline_id, "file", file_id, room_id, user_id)
+    return file_id
+
+
+def delete_file(conn: sqlite3.Connection, id: int):
+    """保存できなかったファイルの登録を取り消す(タイムラインはトリガーで消える)"""
+    conn.execute("DELETE FROM files WHERE id = ?", (id,))
+
+
+def get_file_path(id: int, filename: str):
+    """ファイルの保存先"""
+    return os.path.join(FILE_FOLDER, f"{id}_{filename}")
+
+
+def get_file_link(id: int, filename: str):
+    """ファイルのダウンロードリンク"""
+    return f"/files/{id}/{filename}"
+
+
+@transact
+def select_file_path(conn: sqlite3.Connection, id: int, filename: str):
+    file = conn.execute(
+        "SELECT save_name FROM files WHERE id = ? AND filename = ?", (id, filename)
+    ).fetchone()
+    if file is None:
+        raise FileNotFoundError(get_file_link(id, filename))
+    return file["save_name"]
+
+
+@lru_cache(maxsize=FILE_CACHE_SIZE)
+def find_file_path(id: int, filename: str):
+    """ダウンロードリンクから保存先を取得(見つからなければ FileNotFoundError)
+
+    登録済みのファイルは変わらないのでキャッシュし、DBは古いファイルの削除時のみ参照し直す。
+    未登録の結果は例外なのでキャッシュされない。
+    """
+    return select_file_path(id, filename)
+
+
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+    b"BM": "image/bmp",
+    b"II*\x00": "image/tiff",
+    b"MM\x00*": "image/tiff",
+}
+
+
+def to_bytes(data: bytes | str):
+    """バイナリ添付はそのまま、旧クライアントのbase64文字列はデコードして返す"""
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    return base64.b64decode(data.split(",")[-1])
+
+
+def store_image(data: bytes | str):
+    """画像をハッシュ値のパスに保存してハッシュ値を返す"""
+    decoded = to_bytes(data)
+    digest = hashlib.sha256(decoded).hexdigest()
+    image_path = get_image_path(digest)
+    if not os.path.exists(image_path):
+        # 同じ画像は同じパスになるので、書きかけを読まれないよう一時ファイルから置き換える
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(image_path), delete=False
+        ) as f:
+            f.write(decoded)
+        os.replace(f.name, image_path)
+    return digest
+
+
+def is_image_digest(digest: str):
+    return re.fullmatch(r"[0-9a-f]{64}", digest) is not None
+
+
+def get_image_path(digest: str):
+    """画像の保存先"""
+    return os.path.join(IMAGE_FOLDER, digest[:2], digest)
+
+
+def get_image_link(digest: str):
+    """画像のリンク"""
+    return f"/images/{digest}"
+
+
+THUMBNAIL_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+
+def get_thumbnail_name(digest: str, size: int):
+    """縮小画像のファイル名(元画像のハッシュ値・サイズ・形式で決まる)"""
+    return f"{digest}_{size}.{THUMBNAIL_EXTENSIONS[THUMBNAIL_FORMAT]}"
+
+
+def parse_thumbnail_name(name: str):
+    """縮小画像のファイル名から (元画像のハッシュ値, サイズ) を取得"""
+    extension = THUMBNAIL_EXTENSIONS[THUMBNAIL_FORMAT]
+    match = re.fullmatch(rf"([0-9a-f]{{64}})_(\d+)\.{extension}", name)
+    if match is None:
+        return None
+    return match[1], int(match[2])
+
+
+def get_thumbnail_path(name: str):
+    """縮小画像の保存先"""
+    return os.path.join(IMAGE_FOLDER, "thumbnails", name[:2], name)
+
+
+def get_thumbnail_links(digest: str):
+    """縮小画像のダウンロードリンク(小さい順)"""
+    return [
+        {"size": size, "url": f"/thumbnails/{get_thumbnail_name(digest, size)}"}
+        for size in sorted(THUMBNAIL_SIZES)
+    ]
+
+
+def get_image_mimetype(image_path: str):
+    """画像の先頭バイトからMIMEタイプを判定"""
+    with open(image_path, "rb") as f:
+        header = f.read(12)
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mimetype in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return mimetype
+    return "application/octet-stream"
+
+
+UPLOAD_SUFFIX = ".part"
+
+
+def open_upload_file():
+    """分割アップロードの受信先の一時ファイルを作成し (ファイル, パス) を返す"""
+    fd, path = tempfile.mkstemp(dir=FILE_FOLDER, suffix=UPLOAD_SUFFIX)
+    return os.fdopen(fd, "w+b"), path
+
+
+def decode_file(data: bytes | str):
+    """送信されたファイルを一時ファイルに書き込んでパスを返す"""
+    file, path = open_upload_file()
+    with file:
+        file.write(to_bytes(data))
+    return path
+
+
+def save_file(temp_path: str, filename: str, id: int):
+    """受信済みの一時ファイルを保存先に移動"""
+    file_path = get_file_path(id, filename)
+    os.replace(temp_path, file_path)
+    if sweeper is not None:
+        sweeper.notify()
+    return file_path
+
+
+@transact
+def sweep_files(conn: sqlite3.Connection, max_files: int):
+    """新しい max_files 件を残して古いファイルの行を削除し、保存先の一覧を返す"""
+    # IDは登録順なので主キーの順で境界を求め、範囲でまとめて削除する
+    boundary = conn.execute(
+        "SELECT id FROM files ORDER BY id DESC LIMIT 1 OFFSET ?", (max_files,)
+    ).fetchone()
+    if boundary is None:
+        return []
+    files = conn.execute(
+        "SELECT save_name FROM files WHERE id <= ?", (boundary["id"],)
+    ).fetchall()
+    conn.execute("DELETE FROM files WHERE id <= ?", (boundary["id"],))
+    return [file["save_name"] for file in files if file["save_name"]]
+
+
+class FileSweeper:
+    """保存ファイル数の上限を超えた古いファイルを削除するスレッド
+
+    保存のたびに notify() で数え、threshold 件ごとに起こされて削除する。
+    """
+
+    def __init__(self, max_files: int, threshold: int):
+        self.max_files = max_files
+        self.threshold = max(1, threshold)
+        self._saved = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="storage-sweeper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def notify(self):
+        """ファイルの保存を通知"""
+        with self._lock:
+            self._saved += 1
+            if self._saved < self.threshold:
+                return
+            self._saved = 0
+        self._wakeup.set()
+
+    def sweep(self):
+        """上限を超えた古いファイルを削除"""
+        save_names = sweep_files(self.max_files)
+        if save_names:
+            find_file_path.cache_clear()
+        for save_name in save_names:
+            try:
+                os.remove(save_name)
+            except FileNotFoundError:
+                pass
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"file sweep failed: {e!r}")
 
 
 def init():
-    init_db()
-    os.makedirs(FILE_FOLDER, exist_ok=True)
-    delete_limited_files()
+    global writer, timeline_ids, sweeper
+
+    if WAL_MODE:
+        with pool.connection() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+    if WORKER_INDEX == 0:
+        # 複数ワーカーでは最初のワーカーだけが初期化する(他のワーカーの接続を消さない)
+        init_db()
+        os.makedirs(FILE_FOLDER, exist_ok=True)
+        os.makedirs(IMAGE_FOLDER, exist_ok=True)
+        # 前回の起動時に受信途中だった一時ファイル
+        for name in os.listdir(FILE_FOLDER):
+            if name.endswith(UPLOAD_SUFFIX):
+                os.remove(os.path.join(FILE_FOLDER, name))
+    if sweeper is None:
+        sweeper = FileSweeper(MAX_FILES, FILE_SWEEP_THRESHOLD)
+        sweeper.sweep()
+        sweeper.start()
+        atexit.register(sweeper.stop)
+    with pool.connection() as conn:
+        timeline_ids = IdAllocator(conn, "timeline", WORKER_INDEX)
+    if WAL_MODE and writer is None:
+        writer = BatchWriter(pool.connect, WRITE_BATCH_LATENCY / 1000, WRITE_BATCH_SIZE)
+        writer.start()
+        atexit.register(writer.stop)
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from libs.concurrency import offload
+from libs.config import (
+    THUMBNAIL_FAILED_CACHE,
+    THUMBNAIL_FORMAT,
+    THUMBNAIL_QUALITY,
+    THUMBNAIL_SIZES,
+    THUMBNAIL_WORKERS,
+)
+from libs.storage import get_image_path, get_thumbnail_name, get_thumbnail_path
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# 作り直しても同じ結果になる(元画像を画像として読めない)例外
+DECODE_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError)
+
+
+def make_thumbnails(digest: str):
+    """元画像から設定された各サイズの縮小画像を作成"""
+    with Image.open(get_image_path(digest)) as image:
+        image = ImageOps.exif_transpose(image)
+        if THUMBNAIL_FORMAT == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        for size in THUMBNAIL_SIZES:
+            path = get_thumbnail_path(get_thumbnail_name(digest, size))
+            if os.path.exists(path):
+                continue
+            thumbnail = image.copy()
+            # 元画像より大きくはしない
+            thumbnail.thumbnail((size, size))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(path), delete=False
+            ) as f:
+                thumbnail.save(f, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+            os.replace(f.name, path)
+
+
+class ThumbnailPool:
+    """縮小画像を作成するワーカープール
+
+    同じ画像の作成中に再度要求された場合は作成中のFutureを返す。
+    画像として読めなかった画像は最近の failed_cache 件まで再度作成せず、同じ例外を返す。
+    ディスクの空き不足などそれ以外の失敗は覚えず、次の要求で作り直す。
+    """
+
+    def __init__(self, workers: int, failed_cache: int):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="thumbnail")
+        self._lock = threading.Lock()
+        self._pending: dict[str, Future] = {}
+        self._failed: OrderedDict[str, Future] = OrderedDict()
+        self.failed_cache = failed_cache
+
+    def submit(self, digest: str) -> Future:
+        """縮小画像の作成を投入"""
+        with self._lock:
+            future = self._pending.get(digest)
+            if future is not None:
+                return future
+            future = self._failed.get(digest)
+            if future is not None:
+                self._failed.move_to_end(digest)
+                return future
+            # 画像処理はイベントループを止めないようネイティブスレッドで行う
+            future = self._executor.submit(offload, make_thumbnails, digest)
+            self._pending[digest] = future
+        future.add_done_callback(lambda future: self._done(digest, future))
+        return future
+
+    def _done(self, digest: str, future: Future):
+        error = future.exception()
+        with self._lock:
+            self._pending.pop(digest, None)
+            if isinstance(error, DECODE_ERRORS) and self.failed_cache > 0:
+                self._failed[digest] = future
+                while len(self._failed) > self.failed_cache:
+                    self._failed.popitem(last=False)
+        if error is not None:
+            print(f"thumbnail failed: {digest} {error!r}")
+
+
+thumbnails = ThumbnailPool(THUMBNAIL_WORKERS, THUMBNAIL_FAILED_CACHE)
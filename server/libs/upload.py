@@ -0,0 +1,160 @@
+import os
+import secrets
+import threading
+import time
+
+from flask_socketio import SocketIO
+from libs.config import UPLOAD_IDLE_TIMEOUT, UPLOAD_MAX_PENDING
+from libs.storage import open_upload_file
+
+
+class TooManyUploads(Exception):
+    """1接続で同時に受信できる数を超えた"""
+
+
+class Upload:
+    """分割アップロードで受信中のファイル"""
+
+    def __init__(self, sid: str, filename: str, size: int):
+        self.sid = sid
+        self.filename = filename
+        self.size = size
+        self.received = 0
+        # 書き込み済みの範囲 [(開始, 終了)](重なる・隣接する範囲はまとめる)
+        self.ranges = []
+        self.file, self.path = open_upload_file()
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def complete(self):
+        """ファイル全体を受信したか"""
+        return self.size == 0 or self.ranges == [(0, self.size)]
+
+    def write(self, offset: int, data: bytes):
+        """チャンクを offset の位置に書き込み、受信済みのバイト数を返す
+
+        チャンクは別スレッドで処理され前後することがあるため、位置を指定して書き込む。
+        再送などで同じ範囲を書き込んでも受信済みのバイト数は重ねて数えない。
+        """
+        with self._lock:
+            if self.file.closed:
+                raise ValueError("upload is already closed.")
+            if offset < 0 or offset + len(data) > self.size:
+                raise ValueError("chunk is out of range.")
+            self.file.seek(offset)
+            self.file.write(data)
+            self.updated = time.monotonic()
+            if data:
+                self._add_range(offset, offset + len(data))
+            return self.received
+
+    def _add_range(self, start: int, end: int):
+        ranges = []
+        for first, last in self.ranges:
+            if last < start or first > end:
+                ranges.append((first, last))
+            else:
+                start, end = min(first, start), max(last, end)
+        ranges.append((start, end))
+        ranges.sort()
+        self.ranges = ranges
+        self.received = sum(last - first for first, last in ranges)
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+    def discard(self):
+        """受信を中止して一時ファイルを削除"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRegistry:
+    """接続ごとの受信中ファイル(スレッドセーフ)
+
+    1接続で同時に受信できるのは max_pending 個まで。
+    idle_timeout 秒チャンクが届かないものは一時ファイルごと破棄する。
+    """
+
+    def __init__(self, max_pending: int, idle_timeout: float):
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.socketio = None
+        self._lock = threading.Lock()
+        self._uploads: dict[str, Upload] = {}
+
+    def init_app(self, socketio: SocketIO):
+        self.socketio = socketio
+        if self.idle_timeout > 0:
+            socketio.start_background_task(self._run)
+
+    def start(self, sid: str, filename: str, size: int):
+        """受信を開始し upload_id を返す(上限に達していれば TooManyUploads)"""
+        upload_id = secrets.token_hex(16)
+        with self._lock:
+            pending = sum(upload.sid == sid for upload in self._uploads.values())
+            if pending >= self.max_pending:
+                raise TooManyUploads(
+                    f"up to {self.max_pending} uploads can be in progress at once."
+                )
+            self._uploads[upload_id] = Upload(sid, filename, size)
+        return upload_id
+
+    def get(self, sid: str, upload_id: str) -> Upload | None:
+        """sid が開始した受信中のファイルを取得"""
+        upload = self._uploads.get(upload_id)
+        if upload is None or upload.sid != sid:
+            return None
+        return upload
+
+    def pop(self, sid: str, upload_id: str) -> Upload | None:
+        """sid が開始した受信中のファイルを一覧から外して返す"""
+        with self._lock:
+            upload = self.get(sid, upload_id)
+            if upload is not None:
+                del self._uploads[upload_id]
+            return upload
+
+    def discard_all(self, sid: str):
+        """切断時に sid の受信中のファイルをすべて破棄"""
+        with self._lock:
+            upload_ids = [
+                upload_id
+                for upload_id, upload in self._uploads.items()
+                if upload.sid == sid
+            ]
+            discarded = [self._uploads.pop(upload_id) for upload_id in upload_ids]
+        for upload in discarded:
+            upload.discard()
+
+    def sweep(self):
+        """idle_timeout 秒チャンクが届いていない受信を破棄し、破棄した数を返す"""
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            upload_ids = [
+                upload_id
+                for upload_id, upload in self._uploads.items()
+                if upload.updated < deadline
+            ]
+            discarded = [self._uploads.pop(upload_id) for upload_id in upload_ids]
+        for upload in discarded:
+            upload.discard()
+        return len(discarded)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.idle_timeout / 2)
+            try:
+                swept = self.sweep()
+                if swept:
+                    print(f"discarded {swept} idle uploads")
+            except Exception as e:
+                print(f"upload sweep failed: {e!r}")
+
+
+uploads = UploadRegistry(UPLOAD_MAX_PENDING, UPLOAD_IDLE_TIMEOUT)
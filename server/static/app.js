@@ -1,5 +1,7 @@
 let socket = null;
 let currentRoom = null;
+let rooms = [];
+let roomsVersion = null;
 
 // ユーザー名を入力して接続を開始する
 function connect() {
@@ -40,11 +42,29 @@ function setupSocketListeners() {
         alert(data.message);
     });
 
-    // ロビーのルーム一覧を取得
-    socket.on('rooms', (data) => {
+    // ロビーのルーム一覧の差分を適用(版番号が飛んだら全件を再要求)
+    socket.on('rooms_delta', (data) => {
+        if (data.full) {
+            if (roomsVersion !== null && data.version < roomsVersion) return;
+            rooms = data.rooms;
+        } else {
+            if (roomsVersion === null || data.version <= roomsVersion) return;
+            if (data.version !== roomsVersion + 1) {
+                socket.emit('sync_rooms');
+                return;
+            }
+            const counts = new Map(rooms.map(room => [room.name, room.count]));
+            data.rooms.forEach(room => counts.set(room.name, room.count));
+            rooms = [...counts]
+                .filter(([, count]) => count > 0)
+                .map(([name, count]) => ({ name, count }))
+                .sort((a, b) => b.count - a.count);
+        }
+        roomsVersion = data.version;
+
         const roomList = document.getElementById('room-list');
         roomList.innerHTML = "";
-        data.forEach(room => {
+        rooms.forEach(room => {
             const listItem = document.createElement('li');
             listItem.textContent = `${room.name} (${room.count}人)`;
             listItem.onclick = () => joinRoom(room.name);
@@ -52,22 +72,23 @@ function setupSocketListeners() {
         });
     });
 
-    // ユーザーの入室通知
-    socket.on('joined', (messages) => {
+    // 入室時の過去ログ(新しい順)
+    socket.on('history', (data) => {
         document.getElementById('chat-log').innerHTML = "";
-        messages.forEach(msg => addMessage(msg.user, msg.message));
+        data.messages.slice().reverse().forEach(showMessage);
     });
 
     // メッセージ受信
-    socket.on('message', (data) => {
-        if (data.message) addMessage(data.user, data.message);
-        if (data.image) addImage(data.user, data.image);
-        if (data.filename) addFile(data.user, data.filename, data.link);
-    });
+    socket.on('message', showMessage);
+
+    // サーバがまとめて送ったメッセージ
+    socket.on('messages', (data) => data.messages.forEach(showMessage));
 }
 
 // ルームに参加
 function joinRoom(roomName) {
+    // ロビーを離れる間の差分は届かないので、退出時に全件を受け取り直す
+    roomsVersion = null;
     socket.emit('join', { room: roomName });
     currentRoom = roomName;
     document.getElementById('lobby').style.display = 'none';
@@ -109,6 +130,31 @@ function sendFile() {
     reader.readAsDataURL(file);
 }
 
+// ルーム内のメッセージ検索(more なら前回の続きを追加)
+let searchOffset = 0;
+
+function searchMessages(more = false) {
+    const query = document.getElementById('search-input').value;
+    const results = document.getElementById('search-results');
+    if (!more) {
+        searchOffset = 0;
+        results.innerHTML = "";
+    }
+    socket.emit('search', { query, offset: searchOffset }, (page) => {
+        if (page.error) {
+            alert(page.error.message);
+            return;
+        }
+        page.messages.forEach((msg) => {
+            const item = document.createElement('li');
+            item.textContent = `[${msg.timestamp}] ${msg.user}: ${msg.message}`;
+            results.appendChild(item);
+        });
+        searchOffset += page.messages.length;
+        document.getElementById('search-more').style.display = page.has_more ? 'inline' : 'none';
+    });
+}
+
 function createRoom() {
     const roomName = prompt("新しいルーム名を入力してください:");
     if (roomName) joinRoom(roomName);
@@ -120,6 +166,12 @@ function leaveRoom() {
     document.getElementById('lobby').style.display = 'block';
 }
 
+function showMessage(data) {
+    if (data.message) addMessage(data.user, data.message);
+    if (data.image_url) addImage(data.user, data.image_url, data.thumbnails);
+    if (data.filename) addFile(data.user, data.filename, data.link);
+}
+
 function addMessage(user, message) {
     const chatLog = document.getElementById('chat-log');
     const messageItem = document.createElement('div');
@@ -127,10 +179,13 @@ function addMessage(user, message) {
     chatLog.appendChild(messageItem);
 }
 
-function addImage(user, imageData) {
+function addImage(user, imageUrl, thumbnails) {
     const chatLog = document.getElementById('chat-log');
     const imageItem = document.createElement('div');
-    imageItem.innerHTML = `<strong>${user}</strong>: <img src="${imageData}" alt="image" style="max-width: 200px;">`;
+    // 表示は縮小画像、クリックで元画像を開く
+    const thumbnail = (thumbnails || []).find(t => t.size >= 200);
+    const src = thumbnail ? thumbnail.url : imageUrl;
+    imageItem.innerHTML = `<strong>${user}</strong>: <a href="${imageUrl}" target="_blank"><img src="${src}" alt="image" style="max-width: 200px;"></a>`;
     chatLog.appendChild(imageItem);
 }
 
@@ -0,0 +1,46 @@
+"""テスト共通の設定
+
+serverフォルダで `python -m pytest` として実行する。
+libs.configは読み込み時に環境変数を参照するため、DB・保存先を一時ディレクトリに向けてから読み込む。
+"""
+
+import os
+import sys
+
+import pytest
+
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER)
+
+from benchmarks import use_temp_storage  # noqa: E402
+
+use_temp_storage("simple_chat_test_")
+
+
+@pytest.fixture(scope="session")
+def server():
+    """アプリと SocketIO(DB初期化済み)"""
+    from app import app, socketio
+    from libs import storage
+
+    storage.init()
+    return app, socketio
+
+
+@pytest.fixture
+def client(server):
+    """部屋 test に参加した接続"""
+    app, socketio = server
+    clients = []
+
+    def connect(name: str, room: str = "test"):
+        client = socketio.test_client(app, query_string=f"name={name}")
+        client.emit("join", {"room": room})
+        client.get_received()
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        if client.is_connected():
+            client.disconnect()
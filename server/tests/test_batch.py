@@ -0,0 +1,52 @@
+"""部屋へのメッセージ送信のまとめ"""
+
+import random
+import threading
+import time
+
+from libs.batch import MessageBatcher
+
+
+class RecordingSocketIO:
+    """送信に時間のかかる SocketIO の代わり(送信した順に記録)"""
+
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        time.sleep(random.random() * 0.002)
+        self.emitted.append((to, data["messages"]))
+
+    def start_background_task(self, target):
+        threading.Thread(target=target, daemon=True).start()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+def test_messages_stay_in_order_per_sender():
+    socketio = RecordingSocketIO()
+    batcher = MessageBatcher(0.001, 3)
+    batcher.init_app(socketio)
+
+    def sender(name: str):
+        for i in range(100):
+            batcher.send({"user": name, "seq": i}, "room")
+
+    threads = [threading.Thread(target=sender, args=(f"u{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.flush()
+    # 他のスレッドが送信中の部屋のまとめは、flush から戻った後にそのスレッドが送る
+    end = time.monotonic() + 5
+    while sum(len(batch) for _, batch in socketio.emitted) < 400:
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+    received = [m for _, batch in socketio.emitted for m in batch]
+    assert len(received) == 400
+    for name in ("u0", "u1", "u2", "u3"):
+        seqs = [m["seq"] for m in received if m["user"] == name]
+        assert seqs == list(range(100))
@@ -0,0 +1,110 @@
+"""複数ワーカーでの動作"""
+
+import os
+import pickle
+import queue
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import socketio
+from conftest import SERVER
+from libs.cluster import decode, encode
+
+PORT = 5570
+
+
+@pytest.fixture(scope="module")
+def workers():
+    """launcher.py で2ワーカーを起動し、各ワーカーのURLを返す"""
+    launcher = subprocess.Popen(
+        [sys.executable, "launcher.py", "-w", "2", "-p", str(PORT), "--no-proxy"],
+        cwd=SERVER,
+        env=dict(os.environ, LOG_SYSTEM="False"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        for line in launcher.stdout:
+            if "workers on ports" in line:
+                threading.Thread(target=launcher.stdout.read, daemon=True).start()
+                socket_path = line.rsplit("unix://", 1)[1].rstrip(")\n")
+                break
+        else:
+            pytest.fail("launcher exited")
+        yield {
+            "urls": [f"http://127.0.0.1:{PORT + 1 + i}" for i in range(2)],
+            "socket": socket_path,
+        }
+    finally:
+        launcher.terminate()
+        launcher.wait(10)
+
+
+class Client:
+    def __init__(self, url: str, name: str, room: str):
+        self.received = queue.Queue()
+        self.history = queue.Queue()
+        self.sio = socketio.Client()
+        self.sio.on("message", self.received.put)
+        self.sio.on("messages", self.on_messages)
+        self.sio.on("history", self.history.put)
+        self.sio.connect(f"{url}?name={name}", transports=["websocket"])
+        self.sio.emit("join", {"room": room})
+        self.joined = self.history.get(timeout=10)
+
+    def on_messages(self, data):
+        for message in data["messages"]:
+            self.received.put(message)
+
+    def wait_for(self, text: str, timeout: float = 10):
+        end = time.time() + timeout
+        while time.time() < end:
+            message = self.received.get(timeout=max(0.01, end - time.time()))
+            if message.get("message") == text:
+                return message
+        raise TimeoutError(text)
+
+
+def test_history_order_across_workers(workers):
+    """後のワーカーに送ったメッセージが、先に多く送ったワーカーのメッセージより新しくなる"""
+    a = Client(workers["urls"][0], "cluster_a", "cluster")
+    b = Client(workers["urls"][1], "cluster_b", "cluster")
+    try:
+        for i in range(20):
+            a.sio.emit("message", {"message": f"from a {i}"})
+        b.wait_for("from a 19")
+        b.sio.emit("message", {"message": "LATEST from b"})
+        latest = a.wait_for("LATEST from b")
+
+        c = Client(workers["urls"][0], "cluster_c", "cluster")
+        c.sio.disconnect()
+        messages = [m for m in c.joined["messages"] if m["user"] != "system"]
+        ids = [m["id"] for m in messages]
+        assert sorted(ids) == ids or sorted(ids, reverse=True) == ids
+        newest = max(messages, key=lambda m: m["id"])
+        assert newest["message"] == "LATEST from b"
+        assert newest["id"] == latest["id"]
+    finally:
+        a.sio.disconnect()
+        b.sio.disconnect()
+
+
+def test_broker_socket_is_private(workers):
+    """内蔵ブローカーのソケットは本人のみアクセスできるディレクトリにある"""
+    directory = os.path.dirname(workers["socket"])
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    assert os.path.exists(workers["socket"])
+
+
+def test_queue_messages_are_json():
+    """キューのメッセージは JSON で、pickle などは受け付けない"""
+    data = {"method": "emit", "event": "message", "callback": None}
+    assert decode(encode(data)) == data
+    for message in (pickle.dumps(data), b"[1, 2]", b"not json"):
+        with pytest.raises(ValueError):
+            decode(message)
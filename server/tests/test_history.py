@@ -0,0 +1,26 @@
+"""HTTPでの過去ログ取得"""
+
+
+def get_history(server, client, room: str):
+    app, socketio = server
+    headers = {}
+    if client is not None:
+        sid = socketio.server.manager.sid_from_eio_sid(client.eio_sid, "/")
+        headers["X-Socket-Id"] = sid
+    return app.test_client().get(f"/rooms/{room}/history", headers=headers)
+
+
+def test_history_requires_membership(client, server):
+    member = client("history_member", "history")
+    member.emit("message", {"message": "秘密の話"})
+    other = client("history_other", "history_other")
+
+    response = get_history(server, member, "history")
+    assert response.status_code == 200
+    assert [m["message"] for m in response.json["messages"]][-1] == "秘密の話"
+
+    for requester in (None, other):
+        response = get_history(server, requester, "history")
+        assert response.status_code == 403
+        assert response.json["code"] == "NOT_IN_ROOM"
+    assert get_history(server, member, "no_such_room").status_code == 403
@@ -0,0 +1,49 @@
+"""HTTPでのファイルアップロード"""
+
+import io
+
+import pytest
+from libs.routes import http
+
+
+@pytest.fixture
+def upload(client, server):
+    """部屋に参加した接続として POST /files を送る"""
+    app, socketio = server
+    sender = client("http_sender", "http")
+    sid = socketio.server.manager.sid_from_eio_sid(sender.eio_sid, "/")
+
+    def post(data: dict):
+        return app.test_client().post("/files", headers={"X-Socket-Id": sid}, data=data)
+
+    return post
+
+
+def test_upload(upload):
+    response = upload({"file": (io.BytesIO(b"abc"), "a.txt")})
+    assert response.status_code == 201
+    assert response.json["link"].endswith("/a.txt")
+
+
+def test_large_form_field_is_rejected(upload):
+    response = upload(
+        {
+            "file": (io.BytesIO(b"abc"), "a.txt"),
+            "note": "x" * (http.MAX_FORM_MEMORY_SIZE + 1),
+        }
+    )
+    assert response.status_code == 413
+
+
+def test_too_many_form_parts_are_rejected(upload):
+    fields = {f"field{i}": "x" for i in range(http.MAX_FORM_PARTS + 1)}
+    response = upload({"file": (io.BytesIO(b"abc"), "a.txt"), **fields})
+    assert response.status_code == 413
+
+
+def test_large_file_is_rejected(upload, monkeypatch):
+    monkeypatch.setattr(http, "MAX_UPLOAD_SIZE", 100)
+    assert upload({"file": (io.BytesIO(b"x" * 100), "a.txt")}).status_code == 201
+    response = upload({"file": (io.BytesIO(b"x" * 101), "a.txt")})
+    assert response.status_code == 413
+    assert response.json["code"] == "TOO_LARGE"
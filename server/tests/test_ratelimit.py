@@ -0,0 +1,84 @@
+"""送信の上限"""
+
+import io
+import time
+
+import pytest
+from libs.ratelimit import limiter
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """上限を有効にして、1接続あたり毎秒1件・続けて2件まで(画像・ファイルも1件まで)"""
+    monkeypatch.setattr(limiter, "enabled", True)
+    monkeypatch.setattr(limiter, "burst", 2)
+    monkeypatch.setattr(
+        limiter,
+        "limits",
+        {
+            ("socket", "text"): (1, 0),
+            ("socket", "media"): (0.5, 0),
+            ("room", "text"): (0, 0),
+            ("room", "media"): (0, 0),
+        },
+    )
+    monkeypatch.setattr(limiter, "_buckets", {"socket": {}, "room": {}})
+
+
+def received(client, name: str):
+    """name のイベントの内容(emit と SocketIO.emit で args の形が違う)"""
+    events = [m["args"] for m in client.get_received() if m["name"] == name]
+    return [args[0] if isinstance(args, list) else args for args in events]
+
+
+def test_rate_limited_is_not_fatal(client, limits):
+    sender = client("limit_sender", "limit")
+    watcher = client("limit_watcher", "limit")
+    for i in range(4):
+        sender.emit("message", {"message": f"m{i}"})
+    errors = received(sender, "error")
+    assert [error["code"] for error in errors] == ["RATE_LIMITED"] * 2
+    assert errors[0]["scope"] == "socket" and errors[0]["kind"] == "text"
+    assert errors[0]["retry_after"] > 0
+    assert [m["message"] for m in received(watcher, "message")] == ["m0", "m1"]
+
+    # 断られても接続は続き、待てば送信できる
+    assert sender.is_connected()
+    time.sleep(errors[-1]["retry_after"])
+    sender.emit("message", {"message": "after wait"})
+    assert received(sender, "error") == []
+    assert [m["message"] for m in received(watcher, "message")] == ["after wait"]
+
+
+def test_media_budget_is_separate(client, limits):
+    sender = client("limit_media", "limit_media")
+    for i in range(2):
+        sender.emit("message", {"message": f"m{i}"})
+    sender.emit("message", {"filename": "a.txt", "file_data": b"abc"})
+    sender.emit("message", {"filename": "b.txt", "file_data": b"abc"})
+    errors = received(sender, "error")
+    assert [(error["code"], error["kind"]) for error in errors] == [
+        ("RATE_LIMITED", "media")
+    ]
+    result = sender.emit("upload_start", {"filename": "c", "size": 1}, callback=True)
+    assert result["error"]["code"] == "RATE_LIMITED"
+
+
+def test_upload_bytes_are_charged_before_receiving(client, server, limits, monkeypatch):
+    """分割アップロードは開始時に size を、HTTPは本文の長さを数える"""
+    monkeypatch.setitem(limiter.limits, ("socket", "media"), (100, 100))
+    sender = client("limit_bytes", "limit_bytes")
+    result = sender.emit("upload_start", {"filename": "a", "size": 150}, callback=True)
+    assert "upload_id" in result
+    result = sender.emit("upload_start", {"filename": "b", "size": 100}, callback=True)
+    assert result["error"]["code"] == "RATE_LIMITED"
+
+    app, socketio = server
+    sid = socketio.server.manager.sid_from_eio_sid(sender.eio_sid, "/")
+    response = app.test_client().post(
+        "/files",
+        headers={"X-Socket-Id": sid},
+        data={"file": (io.BytesIO(b"x" * 100), "c.txt")},
+    )
+    assert response.status_code == 429
+    assert response.json["kind"] == "media"
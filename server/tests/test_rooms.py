@@ -0,0 +1,22 @@
+"""部屋への参加・退出"""
+
+from libs import storage
+from libs.routes import ws
+
+
+def test_system_messages_are_written_after_commit(client, monkeypatch):
+    """入退室のメッセージは部屋のトランザクションを閉じてから書き込みに渡す"""
+    calls = []
+
+    def write(func, *args):
+        conn = getattr(storage._local, "conn", None)
+        calls.append(conn is not None and conn.in_transaction)
+        return storage.write(func, *args)
+
+    monkeypatch.setattr(ws, "LOG_SYSTEM", True)
+    monkeypatch.setattr(ws, "write", write)
+    member = client("rooms_alice", "rooms")
+    member.emit("leave")
+    member.emit("join", {"room": "rooms"})
+    member.disconnect()
+    assert calls == [False, False, False, False]
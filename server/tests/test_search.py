@@ -0,0 +1,39 @@
+"""部屋内のメッセージ検索"""
+
+
+def test_search(client):
+    sender = client("search_sender", "search")
+    sender.emit("message", {"message": "デプロイは明日です"})
+    page = sender.emit("search", {"query": "デプロイ"}, callback=True)
+    assert [m["message"] for m in page["messages"]] == ["デプロイは明日です"]
+
+
+def test_invalid_query_is_an_ack_error(client):
+    sender = client("search_blank", "search")
+    for query in ("   ", ""):
+        page = sender.emit("search", {"query": query}, callback=True)
+        assert page["error"]["code"] == "INVALID_QUERY"
+    assert sender.is_connected()
+
+
+def test_http_search_requires_membership(client, server):
+    app, socketio = server
+    member = client("search_member", "search_http")
+    member.emit("message", {"message": "部屋の中だけの話"})
+    other = client("search_other", "search_other")
+
+    def search(requester):
+        sid = socketio.server.manager.sid_from_eio_sid(requester.eio_sid, "/")
+        return app.test_client().get(
+            "/search",
+            query_string={"room": "search_http", "q": "部屋"},
+            headers={"X-Socket-Id": sid},
+        )
+
+    response = search(member)
+    assert response.status_code == 200
+    assert [m["message"] for m in response.json["messages"]] == ["部屋の中だけの話"]
+    response = search(other)
+    assert response.status_code == 403
+    assert response.json["code"] == "NOT_IN_ROOM"
+    assert app.test_client().get("/search?room=search_http&q=x").status_code == 403
@@ -0,0 +1,61 @@
+"""縮小画像"""
+
+import io
+import time
+
+from libs import storage
+from libs.thumbnail import ThumbnailPool
+from PIL import Image
+
+
+def send_image(client, data: bytes):
+    client.emit("message", {"image": data})
+    events = [m["args"] for m in client.get_received() if m["name"] == "message"]
+    return [args[0] if isinstance(args, list) else args for args in events][-1]
+
+
+def wait_idle(pool: ThumbnailPool):
+    """作成の完了後の後始末(done callback)を待つ"""
+    while pool._pending:
+        time.sleep(0.01)
+
+
+def test_thumbnail(client, server):
+    app, _ = server
+    image = io.BytesIO()
+    Image.new("RGB", (640, 480), "red").save(image, format="PNG")
+    message = send_image(client("thumb_sender", "thumb"), image.getvalue())
+    response = app.test_client().get(message["thumbnails"][0]["url"])
+    assert response.status_code == 200
+    assert max(Image.open(io.BytesIO(response.data)).size) == 80
+
+
+def test_thumbnail_of_non_image_is_404(client, server, capsys):
+    app, _ = server
+    message = send_image(client("thumb_broken", "thumb"), b"not an image")
+    http = app.test_client()
+    for thumbnail in message["thumbnails"] * 2:
+        assert http.get(thumbnail["url"]).status_code == 404
+    assert capsys.readouterr().out.count("thumbnail failed") == 1
+    # 元の画像はそのまま取得できる
+    assert http.get(message["image_url"]).data == b"not an image"
+
+
+def test_failed_cache_is_bounded_and_only_for_decode_errors():
+    pool = ThumbnailPool(1, 2)
+    broken = [storage.store_image(f"broken {i}".encode()) for i in range(3)]
+    for digest in broken:
+        pool.submit(digest).exception()
+    wait_idle(pool)
+    assert list(pool._failed) == broken[1:]
+    assert pool.submit(broken[1]) is pool.submit(broken[1])
+
+    # 元画像がないなどの失敗は覚えずに作り直す
+    missing = "0" * 64
+    first = pool.submit(missing)
+    assert isinstance(first.exception(), FileNotFoundError)
+    wait_idle(pool)
+    second = pool.submit(missing)
+    assert second is not first
+    second.exception()
+    wait_idle(pool)
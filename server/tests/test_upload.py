@@ -0,0 +1,120 @@
+"""分割アップロード・ファイルの送信"""
+
+import os
+import time
+
+from libs import messages, storage
+from libs.config import FILE_FOLDER
+from libs.upload import uploads
+
+
+def start(client, size: int):
+    return client.emit(
+        "upload_start", {"filename": "a.bin", "size": size}, callback=True
+    )["upload_id"]
+
+
+def chunk(client, upload_id: str, offset, data: bytes):
+    return client.emit(
+        "upload_chunk",
+        {"upload_id": upload_id, "offset": offset, "data": data},
+        callback=True,
+    )
+
+
+def test_resent_chunk_is_not_counted_twice(client):
+    sender = client("upload_alice")
+    upload_id = start(sender, 4)
+    assert chunk(sender, upload_id, 0, b"ab") == {"received": 2}
+    assert chunk(sender, upload_id, 0, b"ab") == {"received": 2}
+    result = sender.emit("upload_end", {"upload_id": upload_id}, callback=True)
+    assert result["error"]["code"] == "INCOMPLETE_UPLOAD"
+
+
+def test_overlapping_and_unordered_chunks(client, server):
+    sender = client("upload_bob")
+    upload_id = start(sender, 6)
+    assert chunk(sender, upload_id, 4, b"ef") == {"received": 2}
+    assert chunk(sender, upload_id, 1, b"bcd") == {"received": 5}
+    assert chunk(sender, upload_id, 0, b"abc") == {"received": 6}
+    result = sender.emit("upload_end", {"upload_id": upload_id}, callback=True)
+    assert "error" not in result
+    app, _ = server
+    assert app.test_client().get(result["link"]).data == b"abcdef"
+
+
+def test_invalid_offset(client):
+    sender = client("upload_carol")
+    upload_id = start(sender, 4)
+    for offset in (None, "0", 1.5, True):
+        result = chunk(sender, upload_id, offset, b"ab")
+        assert result["error"]["code"] == "INVALID_CHUNK"
+    assert chunk(sender, upload_id, 3, b"ab")["error"]["code"] == "INVALID_CHUNK"
+
+
+@storage.transact
+def count_files(conn, filename: str):
+    return conn.execute(
+        """
+        SELECT COUNT(*) FROM files
+        JOIN timeline ON timeline.kind = 'file' AND timeline.ref_id = files.id
+        WHERE filename = ?
+        """,
+        (filename,),
+    ).fetchone()[0]
+
+
+def test_failed_save_is_rolled_back(client, monkeypatch):
+    """保存先に移動できなければ登録を取り消し、送信者に error を送る"""
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(messages, "save_file", fail)
+    before = count_files("a.bin")
+    sender = client("upload_dave")
+    sender.emit("message", {"filename": "lost.txt", "file_data": b"abc"})
+    errors = [e["args"] for e in sender.get_received() if e["name"] == "error"]
+    assert errors
+    error = errors[0][0] if isinstance(errors[0], list) else errors[0]
+    assert error["code"] == "UPLOAD_FAILED"
+
+    upload_id = start(sender, 2)
+    chunk(sender, upload_id, 0, b"ab")
+    result = sender.emit("upload_end", {"upload_id": upload_id}, callback=True)
+    assert result["error"]["code"] == "UPLOAD_FAILED"
+
+    assert count_files("lost.txt") == 0
+    assert count_files("a.bin") == before
+    parts = [n for n in os.listdir(FILE_FOLDER) if n.endswith(storage.UPLOAD_SUFFIX)]
+    assert not parts
+
+
+def test_pending_uploads_are_limited(client, monkeypatch):
+    monkeypatch.setattr(uploads, "max_pending", 2)
+    sender = client("upload_erin")
+    first = start(sender, 4)
+    start(sender, 4)
+    result = sender.emit("upload_start", {"filename": "c", "size": 4}, callback=True)
+    assert result["error"]["code"] == "TOO_MANY_UPLOADS"
+    # 他の接続は影響を受けない
+    assert "upload_id" in client("upload_frank").emit(
+        "upload_start", {"filename": "d", "size": 4}, callback=True
+    )
+    sender.emit("upload_abort", {"upload_id": first})
+    assert start(sender, 4)
+
+
+def test_idle_uploads_are_swept(client, monkeypatch):
+    sender = client("upload_grace")
+    idle = start(sender, 4)
+    active = start(sender, 4)
+    path = uploads._uploads[idle].path
+    monkeypatch.setattr(uploads, "idle_timeout", 0.2)
+    time.sleep(0.3)
+    chunk(sender, active, 0, b"ab")
+    assert uploads.sweep() == 1
+    assert not os.path.exists(path)
+    result = chunk(sender, idle, 0, b"ab")
+    assert result["error"]["code"] == "UNKNOWN_UPLOAD"
+    assert chunk(sender, active, 2, b"cd") == {"received": 4}